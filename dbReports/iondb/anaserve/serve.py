@@ -39,9 +39,11 @@ blocked), the job server will raise an exception and terminate.
 This module requires Twisted's XMLRPC server. On Ubuntu, this can be installed
 with ``sudo apt-get install python-twisted``.
 """
+import collections
 import datetime
 import json
 import simplejson
+import multiprocessing
 import os
 import uuid
 from os import path
@@ -51,6 +53,7 @@ import subprocess
 import sys
 import threading
 import tempfile
+import time
 import traceback
 import logging
 from logging import handlers as loghandlers
@@ -63,8 +66,8 @@ import urllib2
 from twisted.internet import utils, reactor
 from twisted.web import xmlrpc, server
 from twisted.application import service
-from twisted.internet import defer, utils
-from twisted.python import log
+from twisted.internet import defer, utils, threads
+from twisted.python import log, failure
 import shutil
 from random import choice
 import string
@@ -87,6 +90,8 @@ REFERENCE_LIBRARY_TEMP_DIR = "/results/referenceLibrary/temp/"
 
 import iondb.anaserve.djangoinit
 import iondb.rundb.models
+from iondb.utils import gridstatus
+from ion.utils.sysutils import available_memory
 
 __version__ = filter(str.isdigit, "$Revision$")
 
@@ -173,6 +178,21 @@ except (ImportError, AttributeError):
 # regexps
 SCRIPTNAME_RE = re.compile(r'^ion_analysis_(\d+)\.py$')
 
+# admission control of the AnalysisQueue, per analysis class; each of these
+# can be overridden by a dict of the same name in settings.py
+GB = 1024 * 1024 * 1024
+# number of analyses of a class running at the same time, classes not listed
+# are not limited; the grid queues decide how many analyses run at once
+ANALYSIS_SLOTS = {}
+# lower values start first, within a priority analyses start in request order
+ANALYSIS_PRIORITY = {'thumbnail': 0, 'fromBasecalling': 1, 'fromWells': 1, 'fromRaw': 1, 'composite': 2}
+# free memory the host needs to start another analysis of the class
+ANALYSIS_MEMORY = {'thumbnail': 2 * GB, 'composite': 8 * GB, 'fromRaw': 4 * GB, 'fromWells': 4 * GB, 'fromBasecalling': 2 * GB}
+# expected run time in seconds, until real run times have been recorded
+ANALYSIS_DURATION = {'thumbnail': 3600, 'composite': 8 * 3600, 'fromRaw': 4 * 3600, 'fromWells': 3 * 3600, 'fromBasecalling': 2 * 3600}
+# no analysis is started while the 1 minute load average per core is higher
+ANALYSIS_MAX_LOAD = getattr(settings, 'ANALYSIS_MAX_LOAD', 2.0)
+
 
 # utility functions
 def index2scriptname(index):
@@ -197,6 +217,48 @@ def writeint(fname, n):
     safewrite(fname, "%d" % n)
 
 
+def analysis_setting(name, defaults):
+    return dict(defaults, **getattr(settings, name, {}))
+
+
+def analysis_class(job_type, params):
+    """Admission class of an analysis: thumbnail, composite (tiled chip from raw data),
+    fromRaw (single chip from raw data), fromWells or fromBasecalling (reports built
+    from existing reads)"""
+    if job_type == 'thumbnail':
+        return 'thumbnail'
+    if isinstance(params, basestring):
+        try:
+            params = json.loads(params)
+        except ValueError:
+            params = {}
+    if not isinstance(params, dict):
+        params = {}
+    block_args = params.get('blockArgs') or 'fromRaw'
+    if block_args == 'fromWells':
+        return 'fromWells'
+    if block_args == 'fromRaw' and job_type != 'combineAlignments':
+        # the TLScript of a tiled (Proton) chip runs until all its blocks are done
+        if params.get('rawdatastyle', 'single') != 'single':
+            return 'composite'
+        return 'fromRaw'
+    return 'fromBasecalling'
+
+
+def host_busy(required_memory, max_load):
+    """Reason why the host cannot take another analysis, None if it can"""
+    memory = available_memory()
+    if required_memory and memory is not None and memory < required_memory:
+        return "waiting for memory, %.1f of %.1f GB available" % (float(memory) / GB, float(required_memory) / GB)
+    try:
+        load = os.getloadavg()[0] / multiprocessing.cpu_count()
+    except (OSError, NotImplementedError):
+        return None
+    if max_load and load > max_load:
+        return "waiting for CPU, load %.2f per core" % load
+    return None
+
+
 def have_drmaa(host):
     return HAVE_DRMAA
 
@@ -242,6 +304,10 @@ class Analysis(object):
                 assert isinstance(ele, (str, unicode))
         self.files = files
         self.job_type = job_type
+        self.analysis_class = analysis_class(job_type, params)
+        self.priority = None
+        self.queued_time = None
+        self.start_time = None
 
     def get_id(self):
         """Returns the running job's ID number given by the underlying
@@ -551,6 +617,27 @@ class LocalAnalysis(Analysis):
         return self.proc.pid
 
 
+def _files_in_use(pk, started, running=()):
+    """Job start and end event for data management, blocks or releases the
+    removal of the files of result ``pk``. Analyses still ``running`` are
+    marked again, they may share signal processing files with ``pk``."""
+    from django.db import connection
+    from iondb.rundb.data import dmfilestat_utils
+    try:
+        if started:
+            dmfilestat_utils.set_files_in_use([pk], analysis=True)
+        else:
+            dmfilestat_utils.release_files_in_use([pk], analysis=True)
+            if running:
+                dmfilestat_utils.set_files_in_use(running, analysis=True)
+    except:
+        logger.error("Unable to update files in use for %s" % pk)
+        logger.error(traceback.format_exc())
+    finally:
+        # runs in the analysis monitor thread
+        connection.close()
+
+
 class AnalysisQueue(object):
     """
     The ``AnalysisQueue`` is responsible for managing and monitoring
@@ -575,12 +662,17 @@ class AnalysisQueue(object):
        the analysis object's ``conclude()`` method to clean up.
 
     The reason for acquiring a lock is to allow the ``AnalysisQueue`` to keep
-    track of which analyses are running, and to make it easier to implement
-    queuing in the future. For example, it would be straightforward to
-    have the ``AnalysisQueue``'s main thread wait until there are less than
-    N analyses running before initiating another.
+    track of which analyses are running.
+
+    Analyses are admitted by the main thread when a slot of their class
+    (``ANALYSIS_SLOTS``, unlimited unless configured) is free. Waiting analyses are started by priority
+    class (``ANALYSIS_PRIORITY``), then in request order. While any analysis
+    is running, another one is only started if the host has the memory for
+    its class (``ANALYSIS_MEMORY``) and the load per core is below
+    ``ANALYSIS_MAX_LOAD``; these are re-checked every ``recheck_interval``
+    seconds.
     """
-    def __init__(self, rootdir):
+    def __init__(self, rootdir, recheck_interval=30):
         if rootdir.startswith("../"):
             rootdir = path.join(os.getcwd(), rootdir)
         self.cv = threading.Condition()
@@ -590,6 +682,17 @@ class AnalysisQueue(object):
         self.running = {}
         self.rootdir = rootdir
         self.start_time = None
+        self.recheck_interval = recheck_interval
+        self.slots = analysis_setting('ANALYSIS_SLOTS', ANALYSIS_SLOTS)
+        self.priorities = analysis_setting('ANALYSIS_PRIORITY', ANALYSIS_PRIORITY)
+        self.memory = analysis_setting('ANALYSIS_MEMORY', ANALYSIS_MEMORY)
+        self.durations = analysis_setting('ANALYSIS_DURATION', ANALYSIS_DURATION)
+        # analyses started and not concluded, by class
+        self.admitted = {}
+        # recent run times by class, for start time estimates
+        self.run_times = {}
+        # reason the first waiting analysis was not started
+        self.waiting_reason = ""
 
     def is_running(self, pk):
         """Determine if an analysis identified by ``pk`` is in progress."""
@@ -598,6 +701,12 @@ class AnalysisQueue(object):
     def run_analysis(self, a):
         """Spawn a thread which attempts to start an analysis."""
         def go():
+            try:
+                run()
+            finally:
+                self._release(a)
+
+        def run():
             # acquire a lock while initiating
             self.cv.acquire()
             try:
@@ -609,6 +718,7 @@ class AnalysisQueue(object):
                 logger.info("%s successfully started" % str(a.name))
                 assert a.pk not in self.running
                 self.running[a.pk] = a
+                _files_in_use(a.pk, True)
                 # wait for analysis to conclude
                 comm_result = waiter.communicate()
                 # acquire lock before terminating
@@ -618,8 +728,11 @@ class AnalysisQueue(object):
                 finally:
                     if a.pk in self.running:
                         del self.running[a.pk]
+                    running = self.running.keys()
                     self.cv.release()
+                    _files_in_use(a.pk, False, running)
                 logger.info("%s completed" % str(a.name))
+                self._record_run_time(a)
             else:
                 # bail, initiation failed
                 logger.error("%s failed to start" % str(a.name))
@@ -638,26 +751,123 @@ class AnalysisQueue(object):
         def _loop():
             while not self.exit_event.isSet():
                 self.cv.acquire()
-                while len(self.q) == 0:
-                    self.cv.wait()
-                    if self.exit_event.is_set():
-                        logger.info("Main loop exiting")
-                        return  # leave loop if we're done
-                a = self.q.pop(0)
-                self.cv.release()
+                try:
+                    a = self._admit()
+                    while a is None:
+                        # woken up by new analyses and finished ones, host resources are re-checked periodically
+                        self.cv.wait(self.recheck_interval if self.q else None)
+                        if self.exit_event.is_set():
+                            logger.info("Main loop exiting")
+                            return  # leave loop if we're done
+                        a = self._admit()
+                finally:
+                    self.cv.release()
                 self.run_analysis(a)
         tr = threading.Thread(target=_loop)
         tr.setDaemon(True)
         tr.start()
         return tr
 
-    def add_analysis(self, a):
+    def _ordered(self):
+        """Waiting analyses in the order they will be considered for a start"""
+        return sorted(self.q, key=lambda a: (a.priority, a.queued_time))
+
+    def _admit(self):
+        """Remove and return the next analysis that can be started, None if no
+        analysis can start now. Called with the lock held."""
+        reasons = []
+        for a in self._ordered():
+            cls = a.analysis_class
+            if self.slots.get(cls) is not None and self.admitted.get(cls, 0) >= self.slots[cls]:
+                reasons.append("%s waiting for a %s slot" % (a.name, cls))
+                continue
+            # host checks only while something runs, nothing else will free resources
+            busy = host_busy(self.memory.get(cls), ANALYSIS_MAX_LOAD) if sum(self.admitted.values()) else None
+            if busy:
+                reasons.append("%s %s" % (a.name, busy))
+                continue
+            self.q.remove(a)
+            self.admitted[cls] = self.admitted.get(cls, 0) + 1
+            a.start_time = time.time()
+            logger.info("Starting %s analysis %s after %d seconds in queue" % (cls, a.name, a.start_time - a.queued_time))
+            self.waiting_reason = ""
+            return a
+        if reasons and reasons[0] != self.waiting_reason:
+            logger.info("Analysis queue: %s" % reasons[0])
+        self.waiting_reason = reasons[0] if reasons else ""
+        return None
+
+    def _release(self, a):
+        """Free the slot of a finished analysis"""
+        self.cv.acquire()
+        try:
+            self.admitted[a.analysis_class] -= 1
+            self.cv.notify()
+        finally:
+            self.cv.release()
+
+    def _record_run_time(self, a):
+        run_times = self.run_times.setdefault(a.analysis_class, collections.deque(maxlen=10))
+        run_times.append(time.time() - a.start_time)
+
+    def expected_run_time(self, cls):
+        run_times = self.run_times.get(cls)
+        if run_times:
+            return sum(run_times) / len(run_times)
+        return self.durations.get(cls, 3600)
+
+    def add_analysis(self, a, priority=None):
         """Add an analysis to the queue."""
         self.cv.acquire()
+        a.priority = self.priorities.get(a.analysis_class, 1) if priority is None else priority
+        a.queued_time = time.time()
         self.q.append(a)
         self.cv.notify()
         self.cv.release()
-        logger.info("Added analysis %s" % a.name)
+        logger.info("Added %s analysis %s with priority %s" % (a.analysis_class, a.name, a.priority))
+
+    def queue_info(self):
+        """Position, class, priority and estimated start of each waiting analysis.
+
+        The estimate assumes the slots of a class are the only limit: running
+        analyses end after their class's expected run time, and the analyses
+        ahead in the queue take a slot each as soon as one is free. Analyses of
+        classes without a slot limit are estimated to start now.
+        """
+        self.cv.acquire()
+        try:
+            now = time.time()
+            # per class, the times at which its slots become free
+            free_at = {}
+            for a in self.running.values():
+                free_at.setdefault(a.analysis_class, []).append(
+                    max(now, (a.start_time or now) + self.expected_run_time(a.analysis_class)))
+            info = []
+            for position, a in enumerate(self._ordered()):
+                cls = a.analysis_class
+                if self.slots.get(cls) is None:
+                    # no slot limit, starts when the host has room
+                    start = now
+                else:
+                    slots = free_at.setdefault(cls, [])
+                    while len(slots) < self.slots[cls]:
+                        slots.append(now)
+                    slots.sort()
+                    start = slots.pop(0)
+                    slots.append(start + self.expected_run_time(cls))
+                info.append({
+                    'name': a.name,
+                    'pk': a.pk,
+                    'position': position + 1,
+                    'class': cls,
+                    'priority': a.priority,
+                    'queued_seconds': int(now - a.queued_time),
+                    'estimated_start_seconds': int(start - now),
+                    'estimated_start': datetime.datetime.fromtimestamp(start).isoformat(),
+                })
+            return info
+        finally:
+            self.cv.release()
 
     def stop(self):
         """Terminate the main loop."""
@@ -669,8 +879,11 @@ class AnalysisQueue(object):
         at 'save_path'."""
         self.cv.acquire()
         try:
+            queued = [a for a in self._ordered() if a.pk == pk]
             if pk in self.running:
                 ret = (True, self.running[pk].status_string())
+            elif queued:
+                ret = (True, "Queued, position %d" % (self._ordered().index(queued[0]) + 1))
             else:
                 fname = path.join(save_path, "status.txt")
                 if not path.exists(fname):
@@ -733,28 +946,282 @@ class AnalysisQueue(object):
             return LocalAnalysis
 
 
+def _drmaa_jobstatus(jobid):
+    """DRMAA status of a grid job, "DRMAA BUG" if it cannot be determined"""
+    try:
+        status = _session.jobStatus(jobid)
+    except:
+        logger.error("Job Status failure for %s" % jobid)
+        status = "DRMAA BUG"
+    return status
+
+# job states from one qstat snapshot per interval, DRMAA for the rest
+_status_cache = gridstatus.JobStatusCache(_drmaa_jobstatus)
+
+
+def job_status(jobid):
+    return _status_cache.status(jobid)
+
+
+class JobWatcher(object):
+    """Notifies clients when grid jobs end.
+
+    Clients call ``wait()`` (xmlrpc ``waitjobs``) with the job ids they are
+    interested in. The request is answered as soon as at least one of the jobs
+    has ended, or with an empty result after the timeout. The watcher thread
+    queries the status of the watched jobs only, at ``poll_interval``, so
+    clients do not need to poll ``jobstatus`` for every job themselves.
+    """
+    ENDED = ('done', 'failed', 'DRMAA BUG')
+    # ended jobs are remembered this long for clients asking late
+    KEEP_ENDED = 60 * 60
+
+    def __init__(self, poll_interval=2):
+        self.poll_interval = poll_interval
+        self.cv = threading.Condition()
+        self.exit_event = threading.Event()
+        # list of [jobids, deferred, timeout call], only changed in the reactor thread
+        self.waiters = []
+        # jobid -> (status, time ended)
+        self.ended = {}
+
+    def _ended_of(self, jobids):
+        self.cv.acquire()
+        try:
+            return dict((jobid, self.ended[jobid][0]) for jobid in jobids if jobid in self.ended)
+        finally:
+            self.cv.release()
+
+    def wait(self, jobids, timeout):
+        """Returns a dict jobid:status of the ended jobs, or a Deferred firing with it"""
+        jobids = [str(jobid) for jobid in jobids]
+        ended = self._ended_of(jobids)
+        if ended:
+            return ended
+        waiter = [set(jobids), defer.Deferred(), None]
+        waiter[2] = reactor.callLater(timeout, self._expire, waiter)
+        self.cv.acquire()
+        try:
+            self.waiters.append(waiter)
+            self.cv.notify()
+        finally:
+            self.cv.release()
+        return waiter[1]
+
+    def _remove(self, waiter):
+        self.cv.acquire()
+        try:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+        finally:
+            self.cv.release()
+
+    def _expire(self, waiter):
+        self._remove(waiter)
+        waiter[1].callback({})
+
+    def _notify(self):
+        # runs in the reactor thread
+        for waiter in list(self.waiters):
+            ended = self._ended_of(waiter[0])
+            if ended:
+                self._remove(waiter)
+                waiter[2].cancel()
+                waiter[1].callback(ended)
+
+    def _watched(self):
+        self.cv.acquire()
+        try:
+            while not self.waiters and not self.exit_event.is_set():
+                self.cv.wait()
+            watched = set()
+            for waiter in self.waiters:
+                watched.update(waiter[0])
+            return watched
+        finally:
+            self.cv.release()
+
+    def _loop(self):
+        while not self.exit_event.is_set():
+            watched = self._watched()
+            ended = {}
+            notify = False
+            if watched & set(self.ended):
+                # ended while the waiter was being registered
+                notify = True
+            watched = list(watched - set(self.ended))
+            for jobid, status in zip(watched, _status_cache.status_many(watched)):
+                if status in self.ENDED:
+                    ended[jobid] = (status, time.time())
+            self.cv.acquire()
+            try:
+                self.ended.update(ended)
+                expired = time.time() - self.KEEP_ENDED
+                for jobid in [jobid for jobid, (status, t) in self.ended.items() if t < expired]:
+                    del self.ended[jobid]
+            finally:
+                self.cv.release()
+            if ended:
+                logger.debug("Jobs ended: %s" % ended)
+            if ended or notify:
+                reactor.callFromThread(self._notify)
+            self.exit_event.wait(self.poll_interval)
+
+    def start(self):
+        tr = threading.Thread(target=self._loop)
+        tr.setDaemon(True)
+        tr.start()
+        return tr
+
+    def stop(self):
+        self.exit_event.set()
+        self.cv.acquire()
+        self.cv.notify()
+        self.cv.release()
+
+
+def _close_db_after(fn, *args):
+    # runs in a reactor pool thread, which holds its own database connection
+    from django.db import connection
+    try:
+        return fn(*args)
+    finally:
+        connection.close()
+
+
+class MetricsUploader(object):
+    """Runs the database uploads of analysis metrics on the reactor thread pool.
+
+    Uploads for the same result (same primary key file) are serialized in the
+    order they were requested, with one ``DeferredLock`` per result. Uploads of
+    different results run in parallel. While they run, the reactor keeps
+    serving job submissions and status requests.
+    """
+    LATENCY_SAMPLES = 100
+
+    def __init__(self):
+        self.locks = {}
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        # (seconds waiting, seconds running) of the recent uploads
+        self.latencies = collections.deque(maxlen=self.LATENCY_SAMPLES)
+
+    def submit(self, key, fn, *args):
+        """Run fn(*args) in a thread once all earlier uploads for key are done,
+        returns a Deferred with its result"""
+        lock = self.locks.setdefault(key, defer.DeferredLock())
+        times = [time.time()]
+        self.queued += 1
+
+        def run():
+            self.queued -= 1
+            self.running += 1
+            times.append(time.time())
+            return threads.deferToThread(_close_db_after, fn, *args)
+
+        def done(result):
+            self.running -= 1
+            now = time.time()
+            self.latencies.append((times[1] - times[0], now - times[1]))
+            if isinstance(result, failure.Failure):
+                self.failed += 1
+                logger.error("Metrics upload %s for %s failed: %s" % (fn.__name__, key, result.getErrorMessage()))
+            else:
+                self.completed += 1
+            if not lock.locked and self.locks.get(key) is lock:
+                del self.locks[key]
+            return result
+
+        d = lock.run(run)
+        d.addBoth(done)
+        return d
+
+    def status(self):
+        waiting = [w for w, r in self.latencies]
+        running = [r for w, r in self.latencies]
+        return {
+            'queued': self.queued,
+            'running': self.running,
+            'results': len(self.locks),
+            'completed': self.completed,
+            'failed': self.failed,
+            'avg_wait_seconds': sum(waiting) / len(waiting) if waiting else 0,
+            'max_wait_seconds': max(waiting) if waiting else 0,
+            'avg_run_seconds': sum(running) / len(running) if running else 0,
+            'max_run_seconds': max(running) if running else 0,
+        }
+
+
+def _update_status(primarykeyPath, status, reportLink):
+    from ion.reports import uploadMetrics
+    try:
+        uploadMetrics.updateStatus(primarykeyPath, status, reportLink)
+    except Exception as err:
+        logger.error("Update status failed")
+        return traceback.format_exc()
+    return 0
+
+
+def _upload_metrics(tfmapperstats_outputfile, procPath, beadPath,
+                    ionstats_alignment_json_path, ionParamsPath, peakOut,
+                    ionstats_basecaller_json_path, BaseCallerJsonPath,
+                    primarykeyPath, uploadStatusPath, STATUS, reportLink, cwd):
+    from ion.reports import uploadMetrics
+    try:
+        return_message = uploadMetrics.writeDbFromFiles(
+            tfmapperstats_outputfile,
+            procPath,
+            beadPath,
+            ionstats_alignment_json_path,
+            ionParamsPath,
+            STATUS,
+            peakOut,
+            ionstats_basecaller_json_path,
+            BaseCallerJsonPath,
+            primarykeyPath,
+            uploadStatusPath,
+            cwd)
+
+        # this will replace the five progress squares with a re-analysis button
+        uploadMetrics.updateStatus(primarykeyPath, STATUS, reportLink)
+    except Exception as err:
+        logger.error("Upload Analysis Metrics failed: %s", err)
+        return traceback.format_exc()
+
+    return return_message
+
+
+def _upload_analysis_metrics(beadPath, primarykeyPath):
+    logger.info("Updating bead find metrics for %s" % primarykeyPath)
+    from ion.reports import uploadMetrics
+    try:
+        message = uploadMetrics.updateAnalysisMetrics(beadPath, primarykeyPath)
+        logger.info("Completed Upload Analysis Metrics")
+    except Exception as err:
+        logger.error("Upload Analysis Metrics failed: %s", err)
+        message = traceback.format_exc()
+    return message
+
+
 class AnalysisServer(xmlrpc.XMLRPC):
     """Remote procedure call server that links the database with the
     analysis queue.
 
     Built on top of Twisted's XMLRPC server.
     """
-    def __init__(self, analysis_queue):
+    def __init__(self, analysis_queue, job_watcher=None):
         xmlrpc.XMLRPC.__init__(self)
         self.q = analysis_queue
+        self.job_watcher = job_watcher
+        self.uploader = MetricsUploader()
 
     def xmlrpc_updatestatus(self,
                             primarykeyPath,
                             status,
                             reportLink):
-
-        from ion.reports import uploadMetrics
-        try:
-            uploadMetrics.updateStatus(primarykeyPath, status, reportLink)
-        except Exception as err:
-            logger.error("Update status failed")
-            return traceback.format_exc()
-        return 0
+        return self.uploader.submit(primarykeyPath, _update_status, primarykeyPath, status, reportLink)
 
     def xmlrpc_uploadmetrics(self,
                              tfmapperstats_outputfile,
@@ -771,40 +1238,27 @@ class AnalysisServer(xmlrpc.XMLRPC):
                              reportLink,
                              cwd):
         """Upload Metrics to the database"""
-
-        from ion.reports import uploadMetrics
-        try:
-            return_message = uploadMetrics.writeDbFromFiles(
-                tfmapperstats_outputfile,
-                procPath,
-                beadPath,
-                ionstats_alignment_json_path,
-                ionParamsPath,
-                STATUS,
-                peakOut,
-                ionstats_basecaller_json_path,
-                BaseCallerJsonPath,
-                primarykeyPath,
-                uploadStatusPath,
-                cwd)
-
-            # this will replace the five progress squares with a re-analysis button
-            uploadMetrics.updateStatus(primarykeyPath, STATUS, reportLink)
-        except Exception as err:
-            logger.error("Upload Analysis Metrics failed: %s", err)
-            return traceback.format_exc()
-
-        return return_message
+        return self.uploader.submit(primarykeyPath, _upload_metrics,
+                                    tfmapperstats_outputfile,
+                                    procPath,
+                                    beadPath,
+                                    ionstats_alignment_json_path,
+                                    ionParamsPath,
+                                    peakOut,
+                                    ionstats_basecaller_json_path,
+                                    BaseCallerJsonPath,
+                                    primarykeyPath,
+                                    uploadStatusPath,
+                                    STATUS,
+                                    reportLink,
+                                    cwd)
 
     def xmlrpc_uploadanalysismetrics(self, beadPath, primarykeyPath):
-        logger.info("Updating bead find metrics for %s" % primarykeyPath)
-        from ion.reports import uploadMetrics
-        try:
-            message = uploadMetrics.updateAnalysisMetrics(beadPath, primarykeyPath)
-            logger.info("Completed Upload Analysis Metrics")
-        except Exception as err:
-            logger.error("Upload Analysis Metrics failed: %s", err)
-        return message
+        return self.uploader.submit(primarykeyPath, _upload_analysis_metrics, beadPath, primarykeyPath)
+
+    def xmlrpc_uploadstatus(self):
+        """Number of queued and running metrics uploads, and their recent wait and run times"""
+        return self.uploader.status()
 
     def xmlrpc_submitjob(self, jt_nativeSpecification, jt_remoteCommand,
                          jt_workingDirectory, jt_outputPath,
@@ -823,23 +1277,49 @@ class AnalysisServer(xmlrpc.XMLRPC):
 
     def xmlrpc_jobstatus(self, jobid):
         """Get the status of the job"""
-        try:
-            logger.debug("xmlrpc jobstatus for %s" % jobid)
-            status = _session.jobStatus(jobid)
-        except:
-            logger.error("Job Status failure for %s" % jobid)
-            status = "DRMAA BUG"
-        return status
-
-    def xmlrpc_startanalysis(self, name, script, parameters, files, savePath, pk, chipType, chips, job_type):
+        logger.debug("xmlrpc jobstatus for %s" % jobid)
+        # may run qstat and DRMAA calls, keep it off the reactor
+        return threads.deferToThread(job_status, jobid)
+
+    def xmlrpc_jobstatus_many(self, jobids):
+        """Get the status of several jobs, in the order of ``jobids``"""
+        logger.debug("xmlrpc jobstatus_many for %d jobs" % len(jobids))
+        # a snapshot refresh runs qstat, keep it off the reactor
+        return threads.deferToThread(_status_cache.status_many, jobids)
+
+    def xmlrpc_waitjobs(self, jobids, timeout=60):
+        """Wait until at least one of the jobs has ended, at most ``timeout`` seconds.
+        Returns a dict jobid:status of the ended jobs, empty on timeout."""
+        if self.job_watcher is None:
+            d = threads.deferToThread(_status_cache.status_many, jobids)
+            d.addCallback(lambda statuses: dict((str(jobid), status) for jobid, status in
+                                                zip(jobids, statuses) if status in JobWatcher.ENDED))
+            return d
+        return self.job_watcher.wait(jobids, timeout)
+
+    def xmlrpc_startanalysis(self, name, script, parameters, files, savePath, pk, chipType, chips, job_type, priority=None):
         """Add an analysis to the ``AnalysisQueue``'s queue of waiting
-        analyses."""
+        analyses. ``priority`` overrides the priority of the analysis class,
+        lower values start first."""
         logger.debug("Analysis request received: %s" % name)
         ACls = self.q.best_analysis_class()
         la = ACls(name, script, parameters, files, savePath, pk, chipType, chips, job_type)
-        self.q.add_analysis(la)
+        self.q.add_analysis(la, priority)
         return name
 
+    def xmlrpc_queue(self):
+        """Return the waiting analyses in start order, with queue position
+        and estimated start time."""
+        return self.q.queue_info()
+
+    def xmlrpc_queue_position(self, pk):
+        """Return queue position and estimated start time of the waiting
+        analysis ``pk``, False if it is not waiting."""
+        for info in self.q.queue_info():
+            if info['pk'] == pk:
+                return info
+        return False
+
     def xmlrpc_status(self, save_path, pk):
         """Get the status of the job specified by ``pk`` from the
         ``AnalysisQueue``."""
@@ -912,7 +1392,10 @@ if __name__ == '__main__':
         aq = AnalysisQueue(settings.ANALYSIS_ROOT)
         aq.loop()
 
-        r = AnalysisServer(aq)
+        jw = JobWatcher()
+        jw.start()
+
+        r = AnalysisServer(aq, jw)
         reactor.listenTCP(settings.JOBSERVER_PORT, server.Site(r))
         reactor.run()
     except Exception as err:
@@ -17,6 +17,11 @@ The crawler runs in a loop, and in each iteration performs the following tasks:
    then the experiment has already been added to the database. Otherwise,
    the experiment does not exist in the database, and a new record is created.
 
+Folders are crawled concurrently by a bounded pool of threads (``CrawlWorkers``),
+so a slow file server does not hold up discovery on the other rigs. A
+``RunState`` per folder remembers the last check; folders whose files did not
+change since are skipped with a few stat calls.
+
 Throughout the loop, the crawler generates logging information as well as
 status information that can be accessed over XMLRPC. The ``Status`` class
 provides the XMLRPC access.
@@ -24,6 +29,7 @@ provides the XMLRPC access.
 This module uses the Twisted XMLRPC server, which on Ubuntu can be installed
 with ``sudo apt-get install python-twisted``.
 """
+import collections
 import datetime
 import glob
 import json
@@ -60,9 +66,18 @@ RUN_STATUS_COMPLETE = "Complete"
 RUN_STATUS_MISSING = "Missing File(s)"
 RUN_STATUS_ABORT = "User Aborted"
 RUN_STATUS_SYS_CRIT = "Lost Chip Connection"
+# runs with these statuses are not crawled anymore
+RUN_STATUS_ENDED = [RUN_STATUS_COMPLETE, RUN_STATUS_ABORT, RUN_STATUS_MISSING, RUN_STATUS_SYS_CRIT]
 
 DO_THUMBNAIL = True
 
+# folders crawled at the same time
+CRAWL_WORKERS = getattr(settings, 'CRAWLER_WORKERS', 4)
+# seconds a folder may take before it is given up for this pass
+CRAWL_FOLDER_TIMEOUT = getattr(settings, 'CRAWLER_FOLDER_TIMEOUT', 300)
+# unchanged folders are checked completely this often anyway, seconds
+RUN_STATE_RECHECK = 600
+
 
 class CrawlLog(object):
     """``CrawlLog`` objects store and log metadata about the main crawl loop.
@@ -84,6 +99,8 @@ class CrawlLog(object):
         self.state = '(none)'
         self.state_time = datetime.datetime.now()
         self.exp_errors = {}
+        # CrawlWorkers of the crawl loop
+        self.workers = None
         # set up debug logging
         self.errors = logging.getLogger('crawler')
         self.errors.propagate = False
@@ -162,6 +179,13 @@ class CrawlLog(object):
         self.lock.release()
         return ret
 
+    def worker_progress(self):
+        """Return (worker, folder, seconds, timed out) of the crawl workers,
+        folder is '(none)' for idle workers."""
+        if self.workers is None:
+            return []
+        return self.workers.progress_info()
+
 
 class Status(xmlrpc.XMLRPC):
     """The ``Status`` class provides access to a ``CrawlLog`` through
@@ -195,6 +219,10 @@ class Status(xmlrpc.XMLRPC):
         '''Return hostname'''
         return socket.gethostname()
 
+    def xmlrpc_workers(self):
+        '''Return list of crawl workers: (name, folder, seconds on folder, timed out)'''
+        return self.logger.worker_progress()
+
     def xmlrpc_exp_errors(self):
         '''Return list of errors: (date, exp folder, error msg)'''
         exp_errors = self.logger.get_exp_errors()
@@ -216,23 +244,73 @@ def tdelt2secs(td):
     return  day_seconds + float(td.seconds) + ms_seconds
 
 
-def construct_crawl_directories(logger):
+class CrawlDirectories(object):
+    """Run folders of the rigs, kept between crawl passes.
+
+    A rig folder is listed again only when its mtime changed, and only new
+    entries are checked to be directories. The folders of runs whose transfer
+    has ended are remembered per rig, each pass asks the database only about
+    the other folders. All ended runs are read again from the database every
+    ``full_refresh`` seconds, which picks up runs reset to be crawled again.
+    """
+    # rig folders modified this close to the listing may change again within the same mtime
+    MTIME_GRANULARITY = 2
+
+    def __init__(self, full_refresh=3600):
+        self.full_refresh = full_refresh
+        self.refresh_time = 0
+        # rig folder -> (mtime, set of entries, set of run folders)
+        self.listings = {}
+        # rig folder -> set of run folders whose transfer has ended
+        self.completed = {}
+
+    def run_folders(self, rig_folder):
+        """Return the set of directories in ``rig_folder``."""
+        listtime = time.time()
+        mtime = os.stat(rig_folder).st_mtime
+        known_mtime, known_entries, folders = self.listings.get(rig_folder, (None, set(), set()))
+        if mtime != known_mtime:
+            entries = set(os.path.join(rig_folder, subd) for subd in os.listdir(rig_folder))
+            folders = (folders & entries) | set(subd for subd in entries - known_entries if os.path.isdir(subd))
+            if listtime - mtime < self.MTIME_GRANULARITY:
+                mtime = None
+            self.listings[rig_folder] = (mtime, entries, folders)
+        return folders
+
+    def pending(self, rig_folder, folders, full):
+        """Return the folders whose transfer has not ended, by the database."""
+        if full or rig_folder not in self.completed:
+            exps = models.Experiment.objects.filter(expDir__startswith=rig_folder)
+            self.completed[rig_folder] = set()
+        else:
+            exps = models.Experiment.objects.filter(expDir__in=list(folders - self.completed[rig_folder]))
+        completed = self.completed[rig_folder]
+        completed.update(exps.filter(ftpStatus__in=RUN_STATUS_ENDED).values_list('expDir', flat=True))
+        # forget removed folders
+        completed &= folders
+        return folders - completed
+
+    def forget(self, rig_folders):
+        """Drop the state of rig folders which are not crawled anymore"""
+        for rig_folder in set(self.listings) - set(rig_folders):
+            del self.listings[rig_folder]
+        for rig_folder in set(self.completed) - set(rig_folders):
+            del self.completed[rig_folder]
+
+
+def construct_crawl_directories(logger, crawl_dirs):
     """Query the database and build a list of directories to crawl.
     Returns an array.
     For every Rig in the database, construct a filesystem path and
-    get all subdirectories in that path."""
-    def dbase_isComplete(name, explist):
-        '''
-        explist consists of tuples containing experiment name and ftpstatus
-        '''
-        for item in explist:
-            if name == item[0]:
-                if item[1] in [RUN_STATUS_COMPLETE, RUN_STATUS_ABORT, RUN_STATUS_MISSING, RUN_STATUS_SYS_CRIT]:
-                    return True
-        return False
+    get all subdirectories in that path whose ftp transfer is not complete.
+    ``crawl_dirs`` is the ``CrawlDirectories`` state of the previous passes."""
+    full = time.time() - crawl_dirs.refresh_time > crawl_dirs.full_refresh
+    if full:
+        crawl_dirs.refresh_time = time.time()
 
     fserves = models.FileServer.objects.all()
     ret = []
+    rig_folders = []
     for fs in fserves:
         l = fs.location
         rigs = models.Rig.objects.filter(location=l)
@@ -242,18 +320,15 @@ def construct_crawl_directories(logger):
             rig_folder = os.path.join(fs.filesPrefix, r.name)
             if os.path.exists(rig_folder):
                 logger.errors.debug("Checking %s" % rig_folder)
-                exp_val_list = models.Experiment.objects.filter(expDir__startswith=rig_folder).values_list('expDir', 'ftpStatus')
+                rig_folders.append(rig_folder)
                 try:
-                    subdir_bases = os.listdir(rig_folder)
-                    # create array of paths for all directories in Rig's directory
-                    s1 = [os.path.join(rig_folder, subd) for subd in subdir_bases]
-                    s2 = [subd for subd in s1 if os.path.isdir(subd)]
-                    # create array of paths of not complete ftp transfer only
-                    s3 = [subd for subd in s2 if dbase_isComplete(subd, exp_val_list) is False]
-                    ret.extend(s3)
+                    folders = crawl_dirs.run_folders(rig_folder)
+                    # array of paths of not complete ftp transfer only
+                    ret.extend(sorted(crawl_dirs.pending(rig_folder, folders, full)))
                 except:
                     logger.errors.error(traceback.format_exc())
                     logger.set_state('error')
+    crawl_dirs.forget(rig_folders)
     return ret
 
 
@@ -545,9 +620,143 @@ def reports_exist(exp):
     return composite, thumbnail
 
 
-def crawl(folders, logger):
+class RunState(object):
+    """What the crawler found in a run folder at its last complete check"""
+
+    def __init__(self):
+        self.signature = None
+        self.checked = 0
+        # False if the last check started something that needs a follow up
+        self.settled = False
+        self.file_count = None
+        # composite, thumbnail report exist
+        self.reports = (False, False)
+
+    def unchanged(self, signature):
+        return self.settled and signature == self.signature and time.time() - self.checked < RUN_STATE_RECHECK
+
+
+def run_signature(folder):
+    """mtimes of a run folder, its thumbnail folder and explog_final.txt, None
+    if missing. New acq files, explog files and the thumbnail folder change it."""
+    ret = []
+    for path in (folder, os.path.join(folder, 'thumbnail'), os.path.join(folder, LOG_FINAL_BASENAME)):
+        try:
+            ret.append(os.stat(path).st_mtime)
+        except OSError:
+            ret.append(None)
+    return tuple(ret)
+
+
+class CrawlWorkers(object):
+    """Bounded pool of threads crawling folders concurrently.
+
+    A folder still being crawled after ``folder_timeout`` seconds is given up:
+    its thread is replaced, the pass ends without waiting for it and the
+    folder is not crawled again until that thread returns.
+    """
+    CHECK_INTERVAL = 5
+
+    def __init__(self, logger, size=CRAWL_WORKERS, folder_timeout=CRAWL_FOLDER_TIMEOUT):
+        self.logger = logger
+        self.size = size
+        self.folder_timeout = folder_timeout
+        self.cv = threading.Condition()
+        self.queue = collections.deque()
+        self.pending = 0
+        self.count = 0
+        # worker name -> (folder, start time), folder is None while idle
+        self.progress = {}
+        # workers given up on, and their folders
+        self.timed_out = set()
+        self.stuck = set()
+
+    def _start_worker(self):
+        self.count += 1
+        name = 'crawl-%d' % self.count
+        self.progress[name] = (None, time.time())
+        thread = threading.Thread(target=self._work, name=name)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _work(self):
+        name = threading.current_thread().name
+        while True:
+            self.cv.acquire()
+            try:
+                while not self.queue:
+                    self.cv.wait()
+                folder, fn = self.queue.popleft()
+                self.progress[name] = (folder, time.time())
+                self.logger.current_folder = folder
+            finally:
+                self.cv.release()
+            try:
+                fn(folder)
+            except:
+                self.logger.errors.exception(traceback.format_exc())
+            finally:
+                connection.close()
+            self.cv.acquire()
+            try:
+                if name in self.timed_out:
+                    self.logger.errors.warn("%s finished %s after its timeout" % (name, folder))
+                    self.timed_out.discard(name)
+                    self.stuck.discard(folder)
+                    del self.progress[name]
+                    return
+                self.progress[name] = (None, time.time())
+                self.pending -= 1
+                self.cv.notify_all()
+            finally:
+                self.cv.release()
+
+    def run(self, folders, fn):
+        """Call ``fn(folder)`` for all folders in the worker threads, return
+        when all are done or given up."""
+        self.cv.acquire()
+        try:
+            while len(self.progress) - len(self.timed_out) < self.size:
+                self._start_worker()
+            for folder in folders:
+                if folder in self.stuck:
+                    self.logger.errors.info("still waiting for %s" % folder)
+                    continue
+                self.queue.append((folder, fn))
+                self.pending += 1
+            self.cv.notify_all()
+            while self.pending:
+                self.cv.wait(self.CHECK_INTERVAL)
+                now = time.time()
+                for name, (folder, start) in self.progress.items():
+                    if folder is None or name in self.timed_out or now - start < self.folder_timeout:
+                        continue
+                    msg = "Crawling %s did not finish in %d seconds" % (folder, self.folder_timeout)
+                    self.logger.errors.error("%s: %s" % (name, msg))
+                    self.logger.add_exp_error(folder, msg)
+                    self.timed_out.add(name)
+                    self.stuck.add(folder)
+                    self.pending -= 1
+                    self._start_worker()
+        finally:
+            self.cv.release()
+
+    def progress_info(self):
+        self.cv.acquire()
+        try:
+            now = time.time()
+            return sorted((name, folder or '(none)', now - start, name in self.timed_out)
+                          for name, (folder, start) in self.progress.items())
+        finally:
+            self.cv.release()
+
+
+def crawl(folders, logger, run_states=None, workers=None):
     """Crawl over ``folders``, reporting information to the ``CrawlLog``
-    ``logger``."""
+    ``logger``. ``run_states`` maps folders to the ``RunState`` of previous
+    passes, folders are crawled concurrently by ``workers`` if given."""
+    if run_states is None:
+        run_states = {}
 
     def get_expobj(_folder):
         '''Returns Experiment object associated with given folder'''
@@ -568,6 +777,7 @@ def crawl(folders, logger):
             _expobj.log = json.dumps(parse_log(exptxt), indent=4)
         else:
             # explog_final exists, but is not readable yet.
+            run_states[folder].settled = False
             return
 
         # Set FTP transfer status to complete
@@ -583,11 +793,13 @@ def crawl(folders, logger):
         return
 
 
-    def update_expobj_ftptransfer(_expobj):
+    def update_expobj_ftptransfer(_expobj, state):
         '''Update Experiment object with in-transfer ftp status'''
         if _expobj.ftpStatus != RUN_STATUS_MISSING:
-            _expobj.ftpStatus = get_filecount(_expobj)
-            _expobj.save()
+            state.file_count = get_filecount(_expobj)
+            if _expobj.ftpStatus != str(state.file_count):
+                _expobj.ftpStatus = state.file_count
+                _expobj.save()
             logger.errors.info("FTP status: Transferring")
         return
 
@@ -603,6 +815,7 @@ def crawl(folders, logger):
             if ready_to_process(exp) or check_for_completion(exp):
                 logger.errors.info("  Start a whole chip auto-run analysis job")
                 generate_http_post(exp, logger)
+                run_states[folder].settled = False
             else:
                 logger.errors.info("  Do not start a whole chip auto-run job yet")
         else:
@@ -624,6 +837,7 @@ def crawl(folders, logger):
             if ready_to_process_thumbnail(exp) or check_for_completion(exp):
                 logger.errors.info("  Start a thumbnail auto-run analysis job")
                 generate_http_post(exp, logger, DO_THUMBNAIL)
+                run_states[folder].settled = False
             else:
                 logger.errors.info("  Do not start a thumbnail auto-run job yet")
         else:
@@ -633,50 +847,71 @@ def crawl(folders, logger):
     def explog_exists(folder):
         return os.path.isfile(os.path.join(folder, LOG_BASENAME))
     
+    def crawl_folder(folder):
+        state = run_states.setdefault(folder, RunState())
+        signature = run_signature(folder)
+        if state.unchanged(signature):
+            logger.errors.debug("unchanged directory %s" % folder)
+            return
+        state.signature = signature
+        state.checked = time.time()
+        # a folder changing right now may change again within the same mtime
+        state.settled = state.checked - max(signature) > 2
+
+        logger.errors.info("checking directory %s" % folder)
+        exp = get_expobj(folder)
+
+        if exp is None:
+            if explog_exists(folder):
+                logger.errors.info("Updating the database records: %s" % (folder))
+                generate_updateruninfo_post(folder, logger)
+                state.settled = False
+            else:
+                logger.errors.debug("Missing %s" % os.path.join(folder, LOG_BASENAME))
+        else:
+            #--------------------------------
+            # Update FTP Transfer Status
+            #--------------------------------
+            if check_for_completion(exp):
+                update_expobj_ftpcompleted(exp, folder)
+            else:
+                update_expobj_ftptransfer(exp, state)
+
+            #--------------------------------
+            # Handle auto-run analysis
+            # Conditions for starting auto-analysis:
+            #     #. ftpStatus is not one of the complete states
+            #     #. no report(s) exist.
+            # i.e. - if a user deletes all reports after ftp transfer is complete, do not start auto-analysis.
+            #--------------------------------
+            if not logger.disableautoanalysis:
+                if state.reports != (True, True):
+                    state.reports = reports_exist(exp)
+                composite_exists, thumbnail_exists = state.reports
+                handle_composite_report(folder, composite_exists, exp)
+                handle_thumbnail_report(folder, thumbnail_exists, exp)
+            else:
+                logger.errors.info("auto-analysis start has been disabled")
+
     #-----------------------------------------------------------
     #Main
     #-----------------------------------------------------------
     if folders:
         logger.errors.info("checking %d directories" % len(folders))
 
-    for folder in folders:
-        try:
-            logger.errors.info("checking directory %s" % folder)
-            logger.current_folder = folder
-
-            exp = get_expobj(folder)
+    # runs no longer crawled
+    for folder in set(run_states) - set(folders):
+        del run_states[folder]
 
-            if exp is None:
-                if explog_exists(folder):
-                    logger.errors.info("Updating the database records: %s" % (folder))
-                    generate_updateruninfo_post(folder, logger)
-                else:
-                    logger.errors.debug("Missing %s" % os.path.join(folder, LOG_BASENAME))
-            else:
-                #--------------------------------
-                # Update FTP Transfer Status
-                #--------------------------------
-                if check_for_completion(exp):
-                    update_expobj_ftpcompleted(exp, folder)
-                else:
-                    update_expobj_ftptransfer(exp)
-
-                #--------------------------------
-                # Handle auto-run analysis
-                # Conditions for starting auto-analysis:
-                #     #. ftpStatus is not one of the complete states
-                #     #. no report(s) exist.
-                # i.e. - if a user deletes all reports after ftp transfer is complete, do not start auto-analysis.
-                #--------------------------------
-                if not logger.disableautoanalysis:
-                    composite_exists, thumbnail_exists = reports_exist(exp)
-                    handle_composite_report(folder, composite_exists, exp)
-                    handle_thumbnail_report(folder, thumbnail_exists, exp)
-                else:
-                    logger.errors.info("auto-analysis start has been disabled")
-
-        except:
-            logger.errors.exception(traceback.format_exc())
+    if workers is not None:
+        workers.run(folders, crawl_folder)
+    else:
+        for folder in folders:
+            try:
+                logger.current_folder = folder
+                crawl_folder(folder)
+            except:
+                logger.errors.exception(traceback.format_exc())
 
     logger.current_folder = '(none)'
 
@@ -684,13 +919,16 @@ def crawl(folders, logger):
 def loop(logger, end_event, delay):
     """Outer loop of the crawl thread, calls ``crawl`` every minute."""
     logger.start()
+    crawl_dirs = CrawlDirectories()
+    run_states = {}
+    logger.workers = CrawlWorkers(logger)
     while not end_event.isSet():
         connection.close()  # Close any db connection to force new one.
         try:
             logger.set_state('working')
             start = datetime.datetime.now()
-            folders = construct_crawl_directories(logger)
-            crawl(folders, logger)
+            folders = construct_crawl_directories(logger, crawl_dirs)
+            crawl(folders, logger, run_states, logger.workers)
             logger.set_state('sleeping')
 
         except KeyboardInterrupt:
@@ -1,13 +1,12 @@
 #!/usr/bin/env python
 # Copyright (C) 2014 Ion Torrent Systems, Inc. All Rights Reserved
 '''
-There is a single cached.filelist file in the report directory.  All four file categories
+There is a single cached.fileindex file in the report directory.  All four file categories
 use this file.
 '''
 import os
 import sys
 import argparse
-from cPickle import Unpickler
 
 from iondb.bin import djangoinit
 from iondb.rundb import models
@@ -15,13 +14,15 @@ from iondb.rundb.data import dmactions_types as dmtypes
 
 try:
     from dm_utils import get_walk_filelist, _file_selector
+    from file_index import FileIndex, INDEX_FILENAME
 except:
     from iondb.rundb.data.dm_utils import get_walk_filelist, _file_selector
+    from iondb.rundb.data.file_index import FileIndex, INDEX_FILENAME
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
 
     
 def validate_report(reportname, print_files = False):
-    '''Validate cached.filelist for the given report'''
+    '''Validate cached.fileindex for the given report'''
     try:
         result = models.Results.objects.get(resultsName=reportname)
     except ObjectDoesNotExist:
@@ -35,10 +36,10 @@ def validate_report(reportname, print_files = False):
     
     
 def validate_result(result, filter_plugins = True, print_files = False):
-    '''Validate cached.filelist for the given result'''
+    '''Validate cached.fileindex for the given result'''
         
     path_to_report_dir = result.get_report_dir()
-    path_to_file = os.path.join(path_to_report_dir, 'cached.filelist')
+    path_to_file = os.path.join(path_to_report_dir, INDEX_FILENAME)
     print "validating %s" % path_to_file
     
     if result.isThumbnail:
@@ -52,25 +53,24 @@ def validate_result(result, filter_plugins = True, print_files = False):
 #            return None
     dmfs = result.get_filestat(dmtypes.SIG)
 
-    # Get the cached filelist from cached.filelist file
-    try:
-        with open(path_to_file, 'rb') as fhandle:
-            pickle = Unpickler(fhandle)
-            cached_filelist = pickle.load()
-    except IOError as ioerror:
-        print "%s" % ioerror
-        return None
-    
     # Get a list of files on the filesystem currently
     dirs = [dmfs.result.get_report_dir(), dmfs.result.experiment.expDir]
+
+    # Get the cached filelist from cached.fileindex file, as it is without refreshing it
+    if not os.path.exists(path_to_file):
+        print "No such file: %s" % path_to_file
+        return None
+    index = FileIndex(path_to_file)
+    try:
+        cached_filelist = index.paths(dirs)
+    finally:
+        index.close()
     current_fs_filelist = get_walk_filelist(dirs)
 
     # Ignore plugin_out directories
     if filter_plugins:
         current_fs_filelist = [filename for filename in current_fs_filelist if not '/plugin_out' in filename]
         
-    # Ignore the cached.filelist file
-    current_fs_filelist = [filename for filename in current_fs_filelist if not 'cached.filelist' in filename]
     # Ignore the status.txt file
     current_fs_filelist = [filename for filename in current_fs_filelist if not 'status.txt' in filename]
     # Ignore the serialized_*.json file
@@ -79,18 +79,18 @@ def validate_result(result, filter_plugins = True, print_files = False):
                 
     # See if there are differences
     #leftovers = list(set(cached_filelist) - set(current_fs_filelist))
-    #N.B. This difference here will tell us, "Of the files in the filesystem right now, how many are NOT in the cached.filelist file"
-    #Even if the cached.filelist contains more files than are currently on the filesystem.
+    #N.B. This difference here will tell us, "Of the files in the filesystem right now, how many are NOT in the cached.fileindex file"
+    #Even if the cached.fileindex contains more files than are currently on the filesystem.
     #I am thinking this means we do not care if any action_state is not 'L'.  It doesn't matter because we are looking for deficient
-    #cached.filelist.
+    #cached.fileindex.
     leftovers = list(set(current_fs_filelist) - set(cached_filelist))
     if print_files:
         for i, item in enumerate(leftovers):
-            if not i: print "FILES MISSING FROM CACHED.FILELIST:"
+            if not i: print "FILES MISSING FROM CACHED.FILEINDEX:"
             print item
     else:
         if len(leftovers) > 0:
-            print "FILES MISSING FROM CACHED.FILELIST: %d" % len(leftovers)
+            print "FILES MISSING FROM CACHED.FILEINDEX: %d" % len(leftovers)
     print "- %s\n" % ("Not valid" if len(leftovers) > 0 else "Valid")
                 
     return None
@@ -111,7 +111,7 @@ def main(max_items = 0, print_files = False):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='''
 dm_cached_fl_validator
-CLI tool to validate existing cached.filelist files
+CLI tool to validate existing cached.fileindex files
 ''')
     parser.add_argument('--report',
                         default = None,
@@ -15,6 +15,7 @@ from iondb.bin import djangoinit
 from iondb.rundb import models
 from iondb.rundb.data import dmactions_types as dmtypes
 from iondb.rundb.data.dm_utils import get_walk_filelist, _file_selector
+from iondb.rundb.data.file_index import INDEX_FILENAME
 from iondb.rundb.data.dmactions import _get_keeper_list
 
 # Global progress bar indicator variable
@@ -81,8 +82,8 @@ def search_for_files(dmfilestats, reset, report):
                                      'action_text':logs[len(logs)-1].text})
                     if reset:
                         try:
-                            print "Deleting the cached.filelist file"
-                            cachefilename = os.path.join(dmfs.result.get_report_dir(), "cached.filelist")
+                            print "Deleting the %s file" % INDEX_FILENAME
+                            cachefilename = os.path.join(dmfs.result.get_report_dir(), INDEX_FILENAME)
                             if os.path.exists(cachefilename):
                                 #os.unlink(cachefilename)
                                 os.rename(cachefilename, cachefilename+".hide")
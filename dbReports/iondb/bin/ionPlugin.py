@@ -2,21 +2,25 @@
 # Copyright (C) 2010 Ion Torrent Systems, Inc. All Rights Reserved
 
 from twisted.web import xmlrpc, server
+from twisted.internet import threads
 import sys
 import os
 import httplib2
 import datetime
 import traceback
+import tempfile
 import json
 
 from djangoinit import settings
 #from iondb.plugins.config import config
 from iondb.plugins.runner import PluginRunner
 from iondb.plugins.manager import pluginmanager
-from iondb.plugins.launch_utils import get_plugins_to_run, add_hold_jid
-from iondb.plugins.plugin_json import make_plugin_json
+from iondb.plugins.launch_utils import get_plugins_to_run, get_pluginresults, add_hold_jid
+from iondb.plugins.plugin_json import make_plugin_json, make_plugin_context
 
-from iondb.rundb.models import Results, PluginResult, User
+from iondb.rundb.models import Results, PluginResult, User, touch_models
+from iondb.rundb.data import dmfilestat_utils
+from iondb.utils import gridstatus
 #from django import db
 from django.db import IntegrityError
 
@@ -144,6 +148,76 @@ except (ImportError, AttributeError):
     HAVE_DRMAA = False
     InvalidJob = ValueError
 
+
+def _drmaa_jobstatus(jobid):
+    try:
+        return _session.jobStatus(jobid)
+    except:
+        logging.error(traceback.format_exc())
+        return "DRMAA BUG"
+
+# job states from one qstat snapshot per interval, DRMAA for the rest
+_status_cache = gridstatus.JobStatusCache(_drmaa_jobstatus)
+
+
+def _write_launch_files(start_json, launcher):
+    """
+    Creates the plugin output folder and writes the launch wrapper script and startplugin.json
+    Returns (launch wrapper, startplugin.json), or None if the plugin script does not exist
+    """
+    os.umask(0000)
+
+    plugin_output = start_json['runinfo']['results_dir']
+    #Make sure the dirs exist
+    if not os.path.exists(plugin_output):
+        os.makedirs(plugin_output, 0775)
+
+    plugin = start_json['runinfo']['plugin']
+    logger.info("Preparing for SGE submission - plugin %s --v%s on result %s (%s)",
+                plugin['name'], plugin['version'], start_json['expmeta']['results_name'], start_json['runinfo']['pk'])
+
+    # Branch for launch.sh vs 3.0 plugin class
+    #logger.debug("Finding plugin definition: '%s':'%s'", plugin['name'], plugin['path'])
+    (launch, isCompat) = pluginmanager.find_pluginscript(plugin['path'], plugin['name'])
+    analysis_name = os.path.basename(start_json['runinfo']['analysis_dir'])
+    if not launch or not os.path.exists(launch):
+        logger.error("Analysis: %s. Path to plugin script: '%s' Does Not Exist!", analysis_name, launch)
+        return None
+
+    # Create individual launch script from template and plugin launch.sh
+    if isCompat:
+        launchScript = launcher.createPluginWrapper(launch, start_json)
+    else:
+        start_json.update({'command': ["python %s -vv" % launch]})
+        launchScript = launcher.createPluginWrapper(None, start_json)
+    launchWrapper = launcher.writePluginLauncher(plugin_output, plugin['name'], launchScript)
+    # Returns filename of startpluginjson file, passed to script below
+    startpluginjson = launcher.writePluginJson(start_json)
+    return (launchWrapper, startpluginjson)
+
+
+def _job_template(plugin, launchWrapper, startpluginjson, hold):
+    # Prepare drmaa Job - SGE/gridengine only
+    jt = _session.createJobTemplate()
+    jt.nativeSpecification = " -q %s" % ("plugin.q")
+    if Feature.EXPORT in plugin['features']:
+        jt.nativeSpecification += ' -l ep=1 '
+
+    hold_jid = plugin.get('hold_jid', [])
+    if hold_jid:
+        jt.nativeSpecification += " -hold_jid " + ','.join(str(jobid) for jobid in hold_jid)
+
+    jt.joinFiles = True # Merge stdout and stderr
+
+    # Plugin command is: ion_pluginname_launch.sh -j startplugin.json
+    jt.remoteCommand = launchWrapper
+    jt.args = [ "-j", startpluginjson ]
+
+    if hold:
+        jt.jobSubmissionState = drmaa.JobSubmissionState.HOLD_STATE
+    return jt
+
+
 def SGEPluginJob(start_json, hold=False):
     """
     Spawn a thread that will start a SGE job, and wait for it to return
@@ -152,60 +226,20 @@ def SGEPluginJob(start_json, hold=False):
     args is a dict of all the args that are needed by for the plugin to run
     """
     try:
-        os.umask(0000)
-
-        plugin_output = start_json['runinfo']['results_dir']
-        #Make sure the dirs exist
-        if not os.path.exists(plugin_output):
-            os.makedirs(plugin_output, 0775)
+        launch_files = _write_launch_files(start_json, PluginRunner())
+        if not launch_files:
+            return None
 
         plugin = start_json['runinfo']['plugin']
-        logger.info("Preparing for SGE submission - plugin %s --v%s on result %s (%s)",
-                    plugin['name'], plugin['version'], start_json['expmeta']['results_name'], start_json['runinfo']['pk'])
-
-        # Branch for launch.sh vs 3.0 plugin class
-        #logger.debug("Finding plugin definition: '%s':'%s'", plugin['name'], plugin['path'])
-        (launch, isCompat) = pluginmanager.find_pluginscript(plugin['path'], plugin['name'])
-        analysis_name = os.path.basename(start_json['runinfo']['analysis_dir'])
-        if not launch or not os.path.exists(launch):
-            logger.error("Analysis: %s. Path to plugin script: '%s' Does Not Exist!", analysis_name, launch)
-            return 1
-
-        # Create individual launch script from template and plugin launch.sh
-        launcher = PluginRunner()
-        if isCompat:
-            launchScript = launcher.createPluginWrapper(launch, start_json)
-        else:
-            start_json.update({'command': ["python %s -vv" % launch]})
-            launchScript = launcher.createPluginWrapper(None, start_json)
-        launchWrapper = launcher.writePluginLauncher(plugin_output, plugin['name'], launchScript)
-        # Returns filename of startpluginjson file, passed to script below
-        startpluginjson = launcher.writePluginJson(start_json)
-
-        # Prepare drmaa Job - SGE/gridengine only
-        jt = _session.createJobTemplate()
-        jt.nativeSpecification = " -q %s" % ("plugin.q")
-        if Feature.EXPORT in plugin['features']:
-            jt.nativeSpecification += ' -l ep=1 '
-
-        hold_jid = plugin.get('hold_jid', [])
-        if hold_jid:
-            jt.nativeSpecification += " -hold_jid " + ','.join(str(jobid) for jobid in hold_jid)
-
+        plugin_output = start_json['runinfo']['results_dir']
+        jt = _job_template(plugin, launch_files[0], launch_files[1], hold)
         jt.workingDirectory = plugin_output
         jt.outputPath = ":" + os.path.join(plugin_output, "drmaa_stdout.txt")
-        jt.joinFiles = True # Merge stdout and stderr
-
-        # Plugin command is: ion_pluginname_launch.sh -j startplugin.json
-        jt.remoteCommand = launchWrapper
-        jt.args = [ "-j", startpluginjson ]
-
-        if hold:
-            jt.jobSubmissionState = drmaa.JobSubmissionState.HOLD_STATE
 
         # Submit the job to drmaa
         jobid = _session.runJob(jt)
 
+        analysis_name = os.path.basename(start_json['runinfo']['analysis_dir'])
         logger.info("Analysis: %s. Plugin: %s. Job: %s Queued." % (analysis_name, plugin['name'], jobid))
 
         _session.deleteJobTemplate(jt)
@@ -214,6 +248,46 @@ def SGEPluginJob(start_json, hold=False):
         logger.exception("SGEPluginJob method failure")
         raise
 
+
+def SGEPluginArrayJob(start_jsons, hold=False):
+    """
+    Submit one plugin on several blocks as a single SGE array job, start_jsons has one entry per block.
+    Task N runs in block_tasks.*/N below the pluginresult output folder, a link to the output folder of block N.
+    Returns the array job id, which holds and controls all tasks.
+    """
+    try:
+        launcher = PluginRunner(result=start_jsons[0]['runinfo']['pk'])
+        launch_files = [_write_launch_files(start_json, launcher) for start_json in start_jsons]
+        if not all(launch_files):
+            return None
+
+        plugin = start_jsons[0]['runinfo']['plugin']
+        if not os.path.exists(plugin['results_dir']):
+            os.makedirs(plugin['results_dir'], 0775)
+        # new folder for each submission, queued tasks of an earlier array job keep their links
+        tasks_dir = tempfile.mkdtemp(prefix='block_tasks.', dir=plugin['results_dir'])
+        os.chmod(tasks_dir, 0775)
+        for task, start_json in enumerate(start_jsons, 1):
+            os.symlink(start_json['runinfo']['results_dir'], os.path.join(tasks_dir, str(task)))
+
+        # the wrapper script is the same for all blocks, startplugin.json is read from the task folder
+        jt = _job_template(plugin, launch_files[0][0], os.path.basename(launch_files[0][1]), hold)
+        jt.workingDirectory = os.path.join(tasks_dir, drmaa.JobTemplate.PARAMETRIC_INDEX)
+        jt.outputPath = ":" + os.path.join(tasks_dir, drmaa.JobTemplate.PARAMETRIC_INDEX, "drmaa_stdout.txt")
+
+        # Submit all blocks with one drmaa call, task ids are <jobid>.<task>
+        taskids = _session.runBulkJobs(jt, 1, len(start_jsons), 1)
+        jobid = taskids[0].split('.')[0]
+
+        analysis_name = os.path.basename(start_jsons[0]['runinfo']['analysis_dir'])
+        logger.info("Analysis: %s. Plugin: %s. Array job: %s with %d blocks Queued." % (analysis_name, plugin['name'], jobid, len(taskids)))
+
+        _session.deleteJobTemplate(jt)
+        return jobid
+    except:
+        logger.exception("SGEPluginArrayJob method failure")
+        raise
+
 class Plugin(xmlrpc.XMLRPC):
     """Provide a way to add plugings to SGE from the API
         Also have a way to keep track of the job
@@ -241,6 +315,8 @@ class Plugin(xmlrpc.XMLRPC):
         """
         Launch multiple plugins with dependencies
         For multi-runlevel plugins the input 'plugins' is common for all runlevels
+        At BLOCK runlevel each plugin runs on all blocks in params['blockIds'] (or params['blockId'])
+        as a single SGE array job
         """
         msg = ''
         logger.debug("[launchPlugins] result %s requested plugins: %s" % (result_pk, ','.join(plugins.keys())) )
@@ -265,35 +341,26 @@ class Plugin(xmlrpc.XMLRPC):
             except User.DoesNotExist:
                 user = User.objects.get(pk=1)
                 logger.error("Invalid user specified for plugin launch: %s, will use %s" % (username, user.username) )
-            
+
+            if runlevel == RunLevel.BLOCK:
+                block_ids = params.get('blockIds') or [params.get('blockId','')]
+            else:
+                block_ids = [params.get('blockId','')]
+
+            # prepared PluginResults of all plugins, new ones are created in one query
+            pluginresults = get_pluginresults(result, plugins, plugins_to_run, params, user)
+            # startplugin.json values common to all plugins and blocks
+            context = make_plugin_context(result_pk, report_dir)
+            launched = []
+
             for name in plugins_to_run:
+                pr = None
                 try:
                     p = plugins[name]
-                    # get params for this plugin, make empty json value if doesn't exist
-                    plugin_params = params.setdefault('plugins',{}).setdefault(name,{})
-                    
-                    # Get pluginresult for multi-runlevel plugins or if specified to be reused by manual launch
-                    pr = None
-                    pluginresult_pk = p.get('pluginresult') or plugin_params.get('pluginresult')
-                    
-                    if pluginresult_pk:
-                        logger.debug("Searching for PluginResult: %s", pluginresult_pk)
-                        try:
-                            pr = result.pluginresult_set.get(pk=pluginresult_pk)
-                        except:
-                            logger.error("Failed to find pluginresult for plugin %s, result %s: %s" % (name, result.resultsName, pluginresult_pk) )
-                            pr = None
-                    elif Feature.EXPORT in p.get('features',[]):
-                        # Export plugins rerun in place to enable resuming upload
-                        pr = result.pluginresult_set.filter(plugin=p['id'])
-                        if pr.count() > 0:
-                            pr = pr[0]
-                            pr.owner = user
-
-                    # Create new pluginresult - this is the most common path
-                    if not pr:
-                        pr = PluginResult.objects.create(result_id=result_pk, plugin_id=p['id'], owner=user)
-                        logger.debug("New pluginresult id=%s created for plugin %s and result %s." % (pr.pk, name, result.resultsName) )
+                    plugin_params = params['plugins'][name]
+                    (pr, created) = pluginresults[name]
+
+                    if created:
                         # Always create new, unique output folder.
                         # Never fallback to old *_out format.
                         plugin_output = pr.path(create=True, fallback=False)
@@ -304,43 +371,45 @@ class Plugin(xmlrpc.XMLRPC):
                     p['results_dir'] = plugin_output
                     p['pluginresult'] = pr.pk
                     p = add_hold_jid(p, plugins, runlevel)
-                    
-                    start_json = make_plugin_json(result_pk, report_dir, p, plugin_output, net_location, url_root, username,
-                        runlevel, params.get('blockId',''), params.get('block_dirs',["."]), plugin_params.get('instance_config',{}) )
 
-                    # Pass on run_mode (launch source - manual/instance, pipeline)
-                    start_json['runplugin']['run_mode'] = params.get('run_mode', '')
-                    
-                    # add dependency info to startplugin json
-                    if p.get('depends') and isinstance(p['depends'],list):
-                        start_json['depends'] = {}
-                        for depends_name in p['depends']:
-                            if depends_name in satisfied_dependencies:
-                                start_json['depends'][depends_name] = satisfied_dependencies[depends_name]
-                            elif depends_name in plugins and plugins[depends_name].get('pluginresult'):
-                                start_json['depends'][depends_name] = {
-                                    'pluginresult': plugins[depends_name]['pluginresult'],
-                                    'version': plugins[depends_name].get('version',''),
-                                    'pluginresult_path': plugins[depends_name].get('results_dir')
-                                }
-
-                    # prepare for launch: updates config, sets pluginresults status, generates api key
-                    pr.prepare(config = start_json['pluginconfig'])
-                    pr.save()
-                    # update startplugin json with pluginresult info
-                    start_json['runinfo']['pluginresult'] = pr.pk
-                    start_json['runinfo']['api_key'] = pr.apikey
-
-                    # NOTE: Job is held on start, and subsequently released
+                    start_jsons = []
+                    for block_id in block_ids:
+                        start_json = make_plugin_json(result_pk, report_dir, p, plugin_output, net_location, url_root, username,
+                            runlevel, block_id, params.get('block_dirs',["."]), plugin_params.get('instance_config',{}), context)
+
+                        # Pass on run_mode (launch source - manual/instance, pipeline)
+                        start_json['runplugin']['run_mode'] = params.get('run_mode', '')
+
+                        # add dependency info to startplugin json
+                        if p.get('depends') and isinstance(p['depends'],list):
+                            start_json['depends'] = {}
+                            for depends_name in p['depends']:
+                                if depends_name in satisfied_dependencies:
+                                    start_json['depends'][depends_name] = satisfied_dependencies[depends_name]
+                                elif depends_name in plugins and plugins[depends_name].get('pluginresult'):
+                                    start_json['depends'][depends_name] = {
+                                        'pluginresult': plugins[depends_name]['pluginresult'],
+                                        'version': plugins[depends_name].get('version',''),
+                                        'pluginresult_path': plugins[depends_name].get('results_dir')
+                                    }
+
+                        # update startplugin json with pluginresult info
+                        start_json['runinfo']['pluginresult'] = pr.pk
+                        start_json['runinfo']['api_key'] = pr.apikey
+                        start_jsons.append(start_json)
+
+                    # NOTE: Job is held on start, and released once all plugins are submitted
                     # to avoid any race condition on updating job queue status
                     # launch plugin
-                    jid = SGEPluginJob(start_json, hold=True)
+                    if len(start_jsons) > 1:
+                        jid = SGEPluginArrayJob(start_jsons, hold=True)
+                    else:
+                        jid = SGEPluginJob(start_jsons[0], hold=True)
 
-                    if jid:
-                        # Update pluginresult status
-                        PluginResult.objects.filter(pk=pr.pk).update(state='Queued', jobid=jid)
-                        # Release now that jobid and queued state are set.
-                        _session.control(jid, drmaa.JobControlAction.RELEASE) # no return value
+                    if jid is None:
+                        # submission failed, mark the PluginResult as Error and record no jid
+                        raise Exception("Unable to submit job for plugin %s" % name)
+                    launched.append((pr.pk, jid))
 
                     msg += 'Launched plugin %s: jid %s, depends %s, hold_jid %s \n' % \
                            (p['name'], jid, p['depends'], p['hold_jid'])
@@ -352,10 +421,24 @@ class Plugin(xmlrpc.XMLRPC):
                     
                 except:
                     logger.error(traceback.format_exc())
-                    msg += 'ERROR: Plugin %s failed to launch.\n' % p['name']
-                    pr = PluginResult.objects.get(pk=pr.pk)
-                    pr.complete('Error')
-                    pr.save()
+                    msg += 'ERROR: Plugin %s failed to launch.\n' % name
+                    if pr:
+                        pr = PluginResult.objects.get(pk=pr.pk)
+                        pr.complete('Error')
+                        pr.save()
+
+            # Update pluginresult status
+            for pk, jid in launched:
+                PluginResult.objects.filter(pk=pk).update(state='Queued', jobid=jid)
+            if launched:
+                touch_models(PluginResult)
+            # Release now that jobid and queued state are set.
+            for pk, jid in launched:
+                try:
+                    _session.control(jid, drmaa.JobControlAction.RELEASE) # no return value
+                except:
+                    logger.error(traceback.format_exc())
+                    msg += 'ERROR: Failed to release plugin job %s.\n' % jid
         except:
             logger.error(traceback.format_exc())
             msg += 'ERROR: Failed to launch requested plugins.'
@@ -404,18 +487,16 @@ class Plugin(xmlrpc.XMLRPC):
             jids = [jids]
             return_list = False
         
-        ret = []
-        for jobid in jids:
-            try:
-                jobid = str(jobid)
-                logging.debug("jobstatus for %s" % jobid)
-                status = _session.jobStatus(jobid)
-                ret.append(_decodestatus[status])
-            except:
-                logging.error(traceback.format_exc())
-                ret.append("DRMAA BUG")
-        
-        return ret if return_list else ret[0]
+        logging.debug("jobstatus for %s" % jids)
+
+        def decode(statuses):
+            ret = [_decodestatus.get(status, "DRMAA BUG") for status in statuses]
+            return ret if return_list else ret[0]
+
+        # a snapshot refresh runs qstat, keep it off the reactor
+        d = threads.deferToThread(_status_cache.status_many, jids)
+        d.addCallback(decode)
+        return d
 
     def xmlrpc_createPR(self, resultpk, pluginpk, username=None, config={}):
         if username is None:
@@ -443,16 +524,22 @@ class Plugin(xmlrpc.XMLRPC):
         try:
             # with transaction.atomic():
             pr = PluginResult.objects.get(id=pk)
+            event = None
             if (state is not None) and (state != pr.state):
                 # Caller provided state change, trigger special events
                 if state in ('Completed', 'Error'):
                     pr.complete(state=state)
+                    event = dmfilestat_utils.release_files_in_use
                 elif state == 'Started':
                     pr.start(jobid=jobid)
+                    event = dmfilestat_utils.set_files_in_use
             if store is not None:
                 # Validate JSON?
                 pr.store = store
             pr.save()
+            if event is not None:
+                # report files used by running plugins are protected from data management actions
+                event([pr.result_id])
         except:
             logger.exception("Unable to update pluginresult %d: %s [%s]", pk, state, store[0:20])
             return False
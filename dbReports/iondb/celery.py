@@ -47,6 +47,7 @@ app.conf.update(
     # Allow tasks the generous run-time of six hours before they're killed.
     CELERYD_TASK_TIME_LIMIT=21600,
     # Restart celery each time to ensure imported plugin data is fresh
+    # The plugins node overrides this in celeryd, it loads plugins in forked children
     CELERYD_MAX_TASKS_PER_CHILD = 1,
 
     CELERY_IMPORTS =  (
@@ -0,0 +1,165 @@
+# Copyright (C) 2014 Ion Torrent Systems, Inc. All Rights Reserved
+
+# Plugin introspection in forked interpreters, with an info cache
+#
+# Loading a plugin module runs arbitrary plugin code, which must not stay in the
+# celery worker. interrogate() forks the worker, which has django and the ion
+# modules imported already, once per plugin and loads the plugin in the child;
+# up to INTROSPECTION_WORKERS plugins are loaded in parallel.
+# The info is cached by plugin script and the newest mtime below the plugin
+# folder, so a rescan of unchanged plugins does not load any plugin module.
+import os
+import json
+import time
+import errno
+import select
+import signal
+import hashlib
+import logging
+
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+INTROSPECTION_WORKERS = 4
+# seconds a plugin module may take to load
+INTROSPECTION_TIMEOUT = 60
+CACHE_TIMEOUT = 7 * 24 * 3600
+
+
+def _newest_mtime(plugindir):
+    """ Newest mtime of plugindir and the files and folders below it, compiled modules excepted """
+    newest = os.stat(plugindir).st_mtime
+    for root, dirs, files in os.walk(plugindir):
+        for name in dirs + [f for f in files if not f.endswith(('.pyc', '.pyo'))]:
+            try:
+                newest = max(newest, os.lstat(os.path.join(root, name)).st_mtime)
+            except OSError:
+                pass
+    return newest
+
+
+def _cache_key(script):
+    try:
+        signature = (script, os.stat(script).st_mtime, _newest_mtime(os.path.dirname(script)))
+    except (OSError, TypeError, AttributeError):
+        return None
+    return "plugininfo_" + hashlib.md5(repr(signature)).hexdigest()
+
+
+def cached_info(scripts):
+    """ Returns {script: info} of the scripts with cached info """
+    keys = {}
+    for script in scripts:
+        key = _cache_key(script)
+        if key:
+            keys[key] = script
+    if not keys:
+        return {}
+    try:
+        found = cache.get_many(keys.keys())
+    except:
+        logger.exception("Failed to read plugin info cache")
+        return {}
+    return dict((keys[key], info) for key, info in found.items())
+
+
+def store_info(infos):
+    """ Caches {script: info}, plugins which failed to load are not cached """
+    values = {}
+    for script, info in infos.items():
+        key = _cache_key(script)
+        if key and info:
+            values[key] = info
+    try:
+        cache.set_many(values, CACHE_TIMEOUT)
+    except:
+        logger.exception("Failed to write plugin info cache")
+
+
+def _load_plugin(name, script, fd):
+    """ Runs in the forked child: writes the plugin info as json to fd and exits """
+    status = 1
+    try:
+        try:
+            # the database connections belong to the parent, open new ones if a plugin queries
+            from django.db import connections
+            for conn in connections.all():
+                conn.connection = None
+
+            from iondb.plugins.tasks import get_info_from_script
+            info = get_info_from_script(name, script)
+            data = json.dumps(info.todict() if info is not None else None)
+            status = 0
+        except:
+            logger.exception("Failed to load plugin '%s' from '%s'", name, script)
+            data = json.dumps(None)
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        # skip the atexit handlers and buffers of the parent
+        os._exit(status)
+
+
+def _reap(pid):
+    try:
+        os.waitpid(pid, 0)
+    except OSError as e:
+        if e.errno != errno.ECHILD:
+            raise
+
+
+def interrogate(plugins, workers=INTROSPECTION_WORKERS, timeout=INTROSPECTION_TIMEOUT):
+    """
+    Loads each (name, script) in a forked child, at most workers at a time.
+    Returns {script: info dict}, info is None for plugins which failed to load.
+    """
+    ret = {}
+    pending = list(plugins)
+    running = {}
+    while pending or running:
+        while pending and len(running) < workers:
+            (name, script) = pending.pop(0)
+            rfd, wfd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(rfd)
+                _load_plugin(name, script, wfd)
+            os.close(wfd)
+            running[rfd] = (pid, name, script, [], time.time())
+
+        try:
+            readable = select.select(running.keys(), [], [], 1)[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = []
+
+        for fd in readable:
+            (pid, name, script, chunks, started) = running[fd]
+            data = os.read(fd, 65536)
+            if data:
+                chunks.append(data)
+                continue
+            del running[fd]
+            os.close(fd)
+            _reap(pid)
+            try:
+                ret[script] = json.loads(''.join(chunks))
+            except ValueError:
+                logger.error("Invalid info from plugin '%s' at '%s'", name, script)
+                ret[script] = None
+
+        now = time.time()
+        for fd, (pid, name, script, chunks, started) in running.items():
+            if now - started > timeout:
+                logger.error("Loading plugin '%s' from '%s' timed out after %d seconds", name, script, timeout)
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                del running[fd]
+                os.close(fd)
+                _reap(pid)
+                ret[script] = None
+    return ret
@@ -1,8 +1,9 @@
 # Copyright (C) 2013 Ion Torrent Systems, Inc. All Rights Reserved
 
 import json
-from iondb.rundb.models import Plugin, PluginResult
-from ion.plugin.constants import RunLevel
+from iondb.rundb.models import Plugin, PluginResult, touch_models
+from iondb.plugins.plugin_json import get_pluginconfig
+from ion.plugin.constants import Feature, RunLevel
 
 import logging
 logger = logging.getLogger(__name__)
@@ -173,3 +174,62 @@ def add_hold_jid(plugin, plugins_dict, runlevel):
         plugin['hold_jid'] = [p['jid'] for p in plugins_dict.values() if p.get('jid')]
     
     return plugin
+
+
+def get_pluginresults(result, plugins, plugins_to_run, params, user):
+    """
+    Returns {name: (PluginResult, created)} for plugins_to_run, prepared for launch:
+    state Pending, new api key and the launch config.
+    Reused PluginResults are saved one by one, new ones are created with a single query.
+    """
+    pluginresults = {}
+    new = []
+    plugin_objs = Plugin.objects.in_bulk([plugins[name]['id'] for name in plugins_to_run])
+    for name in plugins_to_run:
+        p = plugins[name]
+        # get params for this plugin, make empty json value if doesn't exist
+        plugin_params = params.setdefault('plugins',{}).setdefault(name,{})
+        config = get_pluginconfig(p, plugin_params.get('instance_config',{}))
+
+        # Get pluginresult for multi-runlevel plugins or if specified to be reused by manual launch
+        pr = None
+        pluginresult_pk = p.get('pluginresult') or plugin_params.get('pluginresult')
+
+        if pluginresult_pk:
+            logger.debug("Searching for PluginResult: %s", pluginresult_pk)
+            try:
+                pr = result.pluginresult_set.get(pk=pluginresult_pk)
+            except:
+                logger.error("Failed to find pluginresult for plugin %s, result %s: %s" % (name, result.resultsName, pluginresult_pk) )
+                pr = None
+        elif Feature.EXPORT in p.get('features',[]):
+            # Export plugins rerun in place to enable resuming upload
+            pr = result.pluginresult_set.filter(plugin=p['id'])
+            if pr.count() > 0:
+                pr = pr[0]
+                pr.owner = user
+
+        if pr:
+            pr.prepare(config=config)
+            pr.save()
+            pluginresults[name] = (pr, False)
+        elif p['id'] in plugin_objs:
+            # Create new pluginresult - this is the most common path
+            pr = PluginResult(result=result, plugin=plugin_objs[p['id']], owner=user)
+            pr.prepare(config=config)
+            new.append((name, pr))
+        else:
+            logger.error("Plugin %s (%s) no longer exists", name, p['id'])
+
+    if new:
+        PluginResult.objects.bulk_create([pr for name, pr in new])
+        # no post_save for bulk_create, invalidate the cached API pages here
+        touch_models(PluginResult)
+        # bulk_create does not set primary keys, the new api keys identify the rows
+        pks = dict(PluginResult.objects.filter(apikey__in=[pr.apikey for name, pr in new]).values_list('apikey', 'pk'))
+        for name, pr in new:
+            pr.pk = pks[pr.apikey]
+            pluginresults[name] = (pr, True)
+            logger.debug("New pluginresult id=%s created for plugin %s and result %s." % (pr.pk, name, result.resultsName) )
+
+    return pluginresults
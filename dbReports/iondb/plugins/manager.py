@@ -18,6 +18,7 @@ import zeroinstall.zerostore
 import iondb.rundb.tasks  ## circular import
 
 import iondb.plugins.tasks
+import iondb.plugins.introspection
 
 import json
 import datetime
@@ -130,7 +131,7 @@ class PluginManager(object):
             return None
 
         pluginlist = [ (pluginname, pluginscript, context) ]
-        infoasync = iondb.plugins.tasks.scan_all_plugins.apply_async(args=[pluginlist],timeout=300)
+        infoasync = iondb.plugins.tasks.scan_all_plugins.apply_async(args=[pluginlist], kwargs={'use_cache': use_cache}, timeout=300)
 
         if use_cache and context and 'plugin' in context:
             # Return current content immediately without waiting
@@ -152,10 +153,12 @@ class PluginManager(object):
 
 
     def get_plugininfo_list(self, updatelist, gettimeout=29):
-        info = {}
+        # Unchanged plugins are answered from the info cache, only the rest go to celery
+        info = iondb.plugins.introspection.cached_info([data[1] for data in updatelist])
+        updatelist = [data for data in updatelist if data[1] not in info]
         if updatelist:
             try:
-                info = iondb.plugins.tasks.scan_all_plugins.apply_async(args=[updatelist],timeout=300).get(gettimeout)
+                info.update(iondb.plugins.tasks.scan_all_plugins.apply_async(args=[updatelist],timeout=300).get(gettimeout))
             except celery.exceptions.TimeoutError:
                 logger.info("Plugin info query timed out: %s", updatelist, exc_info=True)
         return info
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # Copyright (C) 2011 Ion Torrent Systems, Inc. All Rights Reserved
 import os
+import copy
 import traceback
 import json
 from ion.utils.explogparser import getparameter, getparameter_minimal
@@ -8,7 +9,7 @@ from ion.plugin.constants import RunLevel
 
 from iondb.rundb.models import Chip, Results
 
-def get_runinfo(ion_params, primary_key, report_dir, plugin, plugin_out_dir, net_location, url_root, username, runlevel, blockId):
+def get_runinfo(ion_params, primary_key, report_dir, plugin, plugin_out_dir, net_location, url_root, username, runlevel, blockId, chipDescription=None):
 
     raw_data_dir = ion_params['pathToRaw']
     
@@ -61,14 +62,18 @@ def get_runinfo(ion_params, primary_key, report_dir, plugin, plugin_out_dir, net
         "username": username,
     }
     
-    try:
-        chipDescription = Chip.objects.filter(name=ion_params.get('chipType','')).values_list('description',flat=True)[0]
-    except:
-        chipDescription = ''
+    if chipDescription is None:
+        chipDescription = get_chipdescription(ion_params)
     d['chipDescription'] = chipDescription
         
     return d
     
+def get_chipdescription(ion_params):
+    try:
+        return Chip.objects.filter(name=ion_params.get('chipType','')).values_list('description',flat=True)[0]
+    except:
+        return ''
+
 def get_runplugin(ion_params, runlevel, blockId, block_dirs):
     d = {
         "run_type": ion_params.get('report_type','unknown'),
@@ -196,22 +201,38 @@ def get_datamanagement(pk, result=None):
     return retval
 
 
-def make_plugin_json(primary_key, report_dir, plugin, plugin_out_dir, net_location, url_root, username,
-                    runlevel=RunLevel.DEFAULT, blockId='', block_dirs=["."], instance_config={}):
+def make_plugin_context(primary_key, report_dir):
+    """ Values of startplugin.json which are the same for every plugin launched on a result """
     try:
         ion_params,warn = getparameter(os.path.join(report_dir,'ion_params_00.json'))
     except:
         ion_params = getparameter_minimal(os.path.join(report_dir,'ion_params_00.json'))
-        
+
+    return {
+        "ion_params": ion_params,
+        "chipDescription": get_chipdescription(ion_params),
+        "expmeta": get_expmeta(ion_params, report_dir),
+        "plan": get_plan(ion_params),
+        "sampleinfo": ion_params.get("sampleInfo",{}),
+        "datamanagement": get_datamanagement(primary_key),
+    }
+
+def make_plugin_json(primary_key, report_dir, plugin, plugin_out_dir, net_location, url_root, username,
+                    runlevel=RunLevel.DEFAULT, blockId='', block_dirs=["."], instance_config={}, context=None):
+    # context from make_plugin_context() saves reading it again for each plugin and block
+    if context is None:
+        context = make_plugin_context(primary_key, report_dir)
+    ion_params = context["ion_params"]
+
     json_obj={
-        "runinfo":get_runinfo(ion_params, primary_key, report_dir, plugin, plugin_out_dir, net_location, url_root, username, runlevel, blockId),
+        "runinfo":get_runinfo(ion_params, primary_key, report_dir, plugin, plugin_out_dir, net_location, url_root, username, runlevel, blockId, context["chipDescription"]),
         "runplugin":get_runplugin(ion_params, runlevel, blockId, block_dirs),
-        "expmeta": get_expmeta(ion_params, report_dir),
+        "expmeta": copy.deepcopy(context["expmeta"]),
         "pluginconfig":get_pluginconfig(plugin, instance_config),
         "globalconfig":get_globalconfig(),
-        "plan":get_plan(ion_params),
-        "sampleinfo": ion_params.get("sampleInfo",{}),
-        "datamanagement": get_datamanagement(primary_key),
+        "plan": copy.deepcopy(context["plan"]),
+        "sampleinfo": copy.deepcopy(context["sampleinfo"]),
+        "datamanagement": dict(context["datamanagement"]),
     }
     # IonReporterUploader_V1_0 compatibility shim
     if plugin["name"] == "IonReporterUploader_V1_0" and plugin.get("userInput",""):
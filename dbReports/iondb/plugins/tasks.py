@@ -79,14 +79,16 @@ def drop_privileges(uid_name='nobody', gid_name='nogroup'):
 
 ## Query all plugins for their info/inspect json block
 @task(queue="plugins")
-def scan_all_plugins(pluginlist):
+def scan_all_plugins(pluginlist, use_cache=True):
     """
     Pass in list of (plugin, scriptpath) pairs, and all will be instantiated an interrogated.
     Note: They do not need to be installed yet. Just name, script pairs, or name, script, context tuples.
+    Plugins are loaded in forked children, in parallel, and unchanged plugins are answered from the info cache
+    unless use_cache is False.
     """
-    ret = {}
+    from iondb.plugins import introspection
 
-    count = 0
+    plugins = []
     for data in pluginlist:
         if len(data) == 2:
             (name, path) = data
@@ -96,18 +98,25 @@ def scan_all_plugins(pluginlist):
 
         if os.path.isdir(path):
             path = find_pluginscript(path, name)
-        try:
-            info = get_info_from_script(name, path, context)
-            if info is not None:
-                info = info.todict()
-        except:
-            logger.exception("Failed to load plugin '%s' from '%s'", name, path)
-            info = None
+        plugins.append((name, path, context))
 
+    cached = {}
+    if use_cache:
+        cached = introspection.cached_info([path for (name, path, context) in plugins])
+    try:
+        loaded = introspection.interrogate([(name, path) for (name, path, context) in plugins
+                                            if path and path not in cached])
+        introspection.store_info(loaded)
+    except:
+        logger.exception("Failed to load plugins")
+        loaded = {}
+
+    ret = {}
+    for (name, path, context) in plugins:
+        info = cached.get(path) or loaded.get(path)
         if info is None:
             logger.info("Failed to get plugininfo: '%s' from '%s'", name, path)
         ret[path] = info
-        count += 1
 
         if info and context and 'plugin' in context:
             ppk = context["plugin"].pk
@@ -122,7 +131,7 @@ def scan_all_plugins(pluginlist):
             except:
                 logger.exception("Failed to save info to plugin db cache")
 
-    logger.info("Rescanned %d plugins", count)
+    logger.info("Rescanned %d plugins, %d from cache", len(plugins), len(cached))
     return ret
 
 # Helper task to invoke PluginManager rescan, used to rescan after a delay
@@ -6,6 +6,7 @@ from tastypie.api import Api
 import StringIO
 import csv
 import uuid
+import hashlib
 import json
 from tastypie.utils.formatting import format_datetime
 from tastypie.resources import ModelResource as _ModelResource, Resource, ModelDeclarativeMetaclass
@@ -81,6 +82,8 @@ import operator
 
 from django.conf import settings
 from django.http import HttpResponse, HttpResponseNotFound, HttpResponseRedirect, Http404
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date
 
 try:
     from django.conf.urls import url
@@ -198,9 +201,58 @@ class MyModelDeclarativeMetaclass(ModelDeclarativeMetaclass):
 
         return new_class
 
+def conditional_response(request, response):
+    """Adds an ETag of the content to successful GET responses, returns 304 if the client has it"""
+    if request.method != 'GET' or response.status_code != 200 or response.has_header('ETag'):
+        return response
+    etag = '"%s"' % hashlib.md5(response.content).hexdigest()
+    if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+        response = HttpNotModified()
+    response['ETag'] = etag
+    # clients revalidate every time, unchanged content costs a 304
+    patch_cache_control(response, no_cache=True)
+    return response
+
+
 class ModelResource(_ModelResource):
+    """
+    GET responses carry an ETag, see conditional_response.
+    Resources with Meta.cache_models also keep serialized pages in the cache until their
+    model or one of cache_models changes (models.model_versions), or for Meta.cache_timeout seconds.
+    """
     __metaclass__ = MyModelDeclarativeMetaclass
 
+    def create_response(self, request, data, response_class=HttpResponse, **response_kwargs):
+        response = super(ModelResource, self).create_response(request, data, response_class, **response_kwargs)
+        return conditional_response(request, response)
+
+    def get_list(self, request, **kwargs):
+        return self.cached_response(request, super(ModelResource, self).get_list, **kwargs)
+
+    def get_detail(self, request, **kwargs):
+        return self.cached_response(request, super(ModelResource, self).get_detail, **kwargs)
+
+    def cached_response(self, request, view, **kwargs):
+        cache_models = getattr(self._meta, 'cache_models', None)
+        if cache_models is None:
+            return view(request, **kwargs)
+
+        versions = models.model_versions([self._meta.object_class] + list(cache_models))
+        key = "api_page_%s" % hashlib.md5(repr((
+            self._meta.resource_name, request.get_full_path(), request.META.get('HTTP_ACCEPT'),
+            request.user.pk, versions))).hexdigest()
+        page = cache.get(key)
+        if page is None:
+            response = view(request, **kwargs)
+            if request.method != 'GET' or response.status_code != 200:
+                return response
+            page = (response.content, response['Content-Type'])
+            cache.set(key, page, getattr(self._meta, 'cache_timeout', 300))
+        content, content_type = page
+        response = conditional_response(request, HttpResponse(content, content_type=content_type))
+        response['Last-Modified'] = http_date(max(versions))
+        return response
+
 
 class GlobalConfigResource(ModelResource):
     class Meta:
@@ -665,9 +717,9 @@ class ResultsResource(BaseMetadataResource):
             if runlevel == RunLevel.BLOCK:
                 plugin_runlevels = sum([(p.get('runlevel') or [RunLevel.DEFAULT]) for p in plugins_dict.values()], [])
                 if RunLevel.BLOCK in plugin_runlevels and report_type == RunType.COMPOSITE:
-                    for blockId in blockIds:
-                        params['blockId'] = blockId
-                        plugins_dict, msg = remote.call_launchPluginsXMLRPC(result.pk, plugins_dict, net_location, user.username, runlevel, params)
+                    # all blocks in one call, each plugin is submitted as an array job
+                    params['blockIds'] = blockIds
+                    plugins_dict, msg = remote.call_launchPluginsXMLRPC(result.pk, plugins_dict, net_location, user.username, runlevel, params)
             else:
                 plugins_dict, msg = remote.call_launchPluginsXMLRPC(result.pk, plugins_dict, net_location, user.username, runlevel, params)
 
@@ -753,7 +805,7 @@ class ResultsResource(BaseMetadataResource):
         major = request.GET.get('major', None)
 
         # In the order they were generated, newest plugin entry first.
-        pluginresults = results.pluginresult_set.all().order_by('-starttime')
+        pluginresults = results.pluginresult_set.select_related('plugin').order_by('-starttime')
         if major is not None:
             major = (major.lower() == "true")
             pluginresults = pluginresults.filter(plugin__majorBlock=major)
@@ -765,17 +817,27 @@ class ResultsResource(BaseMetadataResource):
         seen = {}
         show_plugins = request.session.setdefault("show_plugins", {})
         for pr in pluginresults:
-            outputpath = pr.path(create=False)
+            # Output files from the manifest written on completion, list the folder only if it changed since
+            manifest = pr.current_manifest()
+            if manifest is None:
+                manifest = pr.update_manifest()
+                if manifest and pr.state not in models.PluginResult.RUNNING_STATES:
+                    models.PluginResult.objects.filter(pk=pr.pk).update(manifest=manifest)
+
+            if manifest:
+                outputpath = manifest['path']
+            else:
+                outputpath = pr.path(create=False)
             base_path = os.path.basename(outputpath)
             #logger.debug("Plugin %s v%s - searching %s", pr.plugin.name, pr.plugin.version, outputpath)
-            if not os.path.exists(outputpath):
+            if not manifest:
                 logger.info("Plugin %s v%s has no plugin_out folder", pr.plugin.name, pr.plugin.version)
                 outputpath = None
                 pr.state = pr.state + ' [Missing]'
 
             if outputpath:
                 # Got a matching path, populate list of files
-                all_files = [pfile for pfile in os.listdir(outputpath) if (pfile.endswith(".html") or pfile.endswith(".php"))]
+                all_files = manifest['files']
                 outputfiles = all_files
                 seen[base_path] = True
                 seen[os.path.basename(outputpath)] = True
@@ -1444,6 +1506,9 @@ class RigResource(ModelResource):
         return self.dispatch('status', request, **kwargs)
 
     def get_status(self, request, **kwargs):
+        return self.cached_response(request, self._get_status, **kwargs)
+
+    def _get_status(self, request, **kwargs):
         bundle = self.build_bundle(request=request)
         rig = self.cached_obj_get(bundle, **self.remove_api_resource_names(kwargs))
         if rig is None:
@@ -1507,6 +1572,7 @@ class RigResource(ModelResource):
 
         authentication = IonAuthentication()
         authorization = DjangoAuthorization()
+        cache_models = [models.Location]
         status_allowed_methods = ['get', 'put']
         config_allowed_methods = ['get']
 
@@ -1871,6 +1937,8 @@ class PluginResultResource(ModelResource):
         field_list = models.PluginResult._meta.get_all_field_names()
         field_list.extend(['result','plugin', 'path', 'duration', 'id']),
         #excludes = ['apikey',]
+        # maintained by the model, see PluginResult.update_manifest
+        excludes = ['manifest',]
         ordering = field_list
         filtering = field_dict(field_list)
 
@@ -2212,72 +2280,15 @@ class PlannedExperimentResource(PlannedExperimentDbResource):
         return self.create_response(request, status)
 
 
-    def dehydrate(self, bundle):
-        try:
-            experiment = bundle.obj.experiment
-            bundle.data['autoAnalyze'] = experiment.autoAnalyze
-            bundle.data['chipType'] = experiment.chipType
-            bundle.data['flows'] = experiment.flows
-            bundle.data['flowsInOrder'] = experiment.flowsInOrder
-            bundle.data['notes'] = experiment.notes
-            bundle.data['sequencekitname'] = experiment.sequencekitname
-            bundle.data['platform'] = experiment.platform
-
-            latest_eas = bundle.obj.latestEAS
-            if not latest_eas:
-                latest_eas = experiment.get_EAS()
-
-            bundle.data['barcodedSamples'] = latest_eas.barcodedSamples if latest_eas else ""
-            bundle.data['barcodeId'] = latest_eas.barcodeKitName if latest_eas else ""
-            bundle.data['bedfile'] = latest_eas.targetRegionBedFile if latest_eas else ""
-            bundle.data['forward3primeadapter'] = latest_eas.threePrimeAdapter if latest_eas else ""
-            bundle.data['library'] = latest_eas.reference if latest_eas else ""
-            bundle.data['libraryKey'] = latest_eas.libraryKey if latest_eas else ""
-            bundle.data['tfKey'] = latest_eas.tfKey if latest_eas else ""
-            bundle.data['librarykitname'] = latest_eas.libraryKitName if latest_eas else ""
-            bundle.data['regionfile'] = latest_eas.hotSpotRegionBedFile if latest_eas else ""
-            bundle.data['isDuplicateReads'] = latest_eas.isDuplicateReads if latest_eas else False
-            bundle.data['base_recalibration_mode'] = latest_eas.base_recalibration_mode if latest_eas else "no_recal"
-            bundle.data['realign'] = latest_eas.realign if latest_eas else False
-
-            bundle.data['beadfindargs'] = latest_eas.beadfindargs if latest_eas else ""
-            bundle.data['thumbnailbeadfindargs'] = latest_eas.thumbnailbeadfindargs if latest_eas else ""
-            bundle.data['analysisargs'] = latest_eas.analysisargs if latest_eas else ""
-            bundle.data['thumbnailanalysisargs'] = latest_eas.thumbnailanalysisargs if latest_eas else ""
-            bundle.data['prebasecallerargs'] = latest_eas.prebasecallerargs if latest_eas else ""
-            bundle.data['prethumbnailbasecallerargs'] = latest_eas.prethumbnailbasecallerargs if latest_eas else ""
-            bundle.data['calibrateargs'] = latest_eas.calibrateargs if latest_eas else ""
-            bundle.data['thumbnailcalibrateargs'] = latest_eas.thumbnailcalibrateargs if latest_eas else ""
-            bundle.data['basecallerargs'] = latest_eas.basecallerargs if latest_eas else ""
-            bundle.data['thumbnailbasecallerargs'] = latest_eas.thumbnailbasecallerargs if latest_eas else ""
-            bundle.data['alignmentargs'] = latest_eas.alignmentargs if latest_eas else ""
-            bundle.data['thumbnailalignmentargs'] = latest_eas.thumbnailalignmentargs if latest_eas else ""
-
-            if latest_eas and latest_eas.barcodeKitName:
-                bundle.data['sample'] = ""
-                bundle.data['sampleDisplayedName'] = ""
-            else:
-                if experiment.samples.all():
-                    bundle.data['sample'] = experiment.samples.all()[0].name
-                    bundle.data['sampleDisplayedName'] = experiment.samples.all()[0].displayedName
-                else:
-                    bundle.data['sample'] = ""
-                    bundle.data['sampleDisplayedName'] = ""
-
-            bundle.data['selectedPlugins'] = latest_eas.selectedPlugins if latest_eas else ""
-
-            if latest_eas:
-                selectedPlugins = latest_eas.selectedPlugins
-
-                pluginInfo = selectedPlugins.get("variantCaller", {})
-
-                if pluginInfo:
-                    userInput = pluginInfo.get("userInput", {})
-                    if userInput:
-                        bundle.data['variantfrequency'] = userInput.get("variationtype", "")
+    def get_object_list(self, request):
+        # relations read by dehydrate, for the querysets of all plan resources
+        return super(PlannedExperimentResource, self).get_object_list(request).select_related(
+            'experiment', 'latestEAS', 'summary', 'sampleSet__SampleGroupType_CV', 'applicationGroup', 'sampleGrouping'
+        ).prefetch_related('projects', 'plannedexperimentqc_set__qcType')
 
-        except models.Experiment.DoesNotExist:
-            logger.error('Missing experiment for Plan %s(%s)' % (bundle.obj.planName, bundle.obj.pk))
+    def dehydrate(self, bundle):
+        # experiment, analysis settings and sample values, see models.PlanSummary
+        bundle.data.update(models.PlanSummary.get_data(bundle.obj))
 
         sampleSet = bundle.obj.sampleSet
         bundle.data['sampleSetDisplayedName'] = sampleSet.displayedName if sampleSet else ""
@@ -2626,6 +2637,12 @@ class PlannedExperimentResource(PlannedExperimentDbResource):
         return super(PlannedExperimentResource, self).obj_update(bundle, **kwargs)
 
 
+# plan listings polled by the Ion Chef and OneTouch instruments
+PLAN_CACHE_MODELS = [models.Experiment, models.ExperimentAnalysisSettings, models.Sample, models.SampleSet,
+                     models.SampleGroupType_CV, models.ApplicationGroup, models.Project,
+                     models.PlannedExperimentQC, models.QCType, models.KitInfo]
+
+
 class AvailableIonChefPlannedExperimentResource(PlannedExperimentResource):
 
     def build_filters(self, filters=None):
@@ -2647,6 +2664,7 @@ class AvailableIonChefPlannedExperimentResource(PlannedExperimentResource):
         ordering = field_list
         authentication = IonAuthentication()
         authorization = DjangoAuthorization()
+        cache_models = PLAN_CACHE_MODELS
 
 
 class AvailableIonChefPlannedExperimentSummaryResource(ModelResource):
@@ -2672,6 +2690,7 @@ class AvailableIonChefPlannedExperimentSummaryResource(ModelResource):
         filtering = field_dict(field_list)
         authentication = IonAuthentication()
         authorization = DjangoAuthorization()
+        cache_models = PLAN_CACHE_MODELS
 
         metadata_allowed_methods = ['get',]
 
@@ -2697,6 +2716,7 @@ class IonChefPlanTemplateResource(PlannedExperimentResource):
         ordering = field_list
         authentication = IonAuthentication()
         authorization = DjangoAuthorization()
+        cache_models = PLAN_CACHE_MODELS
 
 
 class IonChefPlanTemplateSummaryResource(ModelResource):
@@ -2720,6 +2740,7 @@ class IonChefPlanTemplateSummaryResource(ModelResource):
         ordering = field_list
         authentication = IonAuthentication()
         authorization = DjangoAuthorization()
+        cache_models = PLAN_CACHE_MODELS
 
         metadata_allowed_methods = ['get',]
 
@@ -2745,6 +2766,7 @@ class AvailableOneTouchPlannedExperimentResource(PlannedExperimentResource):
         ordering = field_list
         authentication = IonAuthentication()
         authorization = DjangoAuthorization()
+        cache_models = PLAN_CACHE_MODELS
 
 
 class OneTouchPlanTemplateResource(PlannedExperimentResource):
@@ -2768,6 +2790,7 @@ class OneTouchPlanTemplateResource(PlannedExperimentResource):
         ordering = field_list
         authentication = IonAuthentication()
         authorization = DjangoAuthorization()
+        cache_models = PLAN_CACHE_MODELS
 
 
 class AvailableOneTouchPlannedExperimentSummaryResource(ModelResource):
@@ -2793,6 +2816,7 @@ class AvailableOneTouchPlannedExperimentSummaryResource(ModelResource):
         filtering = field_dict(field_list)
         authentication = IonAuthentication()
         authorization = DjangoAuthorization()
+        cache_models = PLAN_CACHE_MODELS
 
         metadata_allowed_methods = ['get',]
 
@@ -2818,6 +2842,7 @@ class OneTouchPlanTemplateSummaryResource(ModelResource):
         ordering = field_list
         authentication = IonAuthentication()
         authorization = DjangoAuthorization()
+        cache_models = PLAN_CACHE_MODELS
 
         metadata_allowed_methods = ['get',]
 
@@ -2833,6 +2858,7 @@ class AvailablePlannedExperimentSummaryResource(ModelResource):
         filtering = field_dict(field_list)
         authentication = IonAuthentication()
         authorization = DjangoAuthorization()
+        cache_models = PLAN_CACHE_MODELS
 
         metadata_allowed_methods = ['get',]
 
@@ -2848,6 +2874,7 @@ class PlanTemplateSummaryResource(ModelResource):
         filtering = field_dict(field_list)
         authentication = IonAuthentication()
         authorization = DjangoAuthorization()
+        cache_models = PLAN_CACHE_MODELS
 
         metadata_allowed_methods = ['get',]
 
@@ -3806,6 +3833,11 @@ class MonitorResultResource(ModelResource):
         authentication = IonAuthentication()
         authorization = DjangoAuthorization()
         cache = SimpleCache(timeout=9)
+        cache_models = [models.Experiment, models.ExperimentAnalysisSettings, models.AnalysisMetrics,
+                        models.LibMetrics, models.QualityMetrics, models.Project, models.PlannedExperiment,
+                        models.PlannedExperimentQC, models.QCType]
+        # the monitor window moves with the clock
+        cache_timeout = 60
 
 
 class CompositePlannedExperimentResource(ModelResource):
@@ -23,7 +23,7 @@ from django.db import transaction
 
 from iondb.rundb.data import dmactions_types
 from iondb.rundb.data import dm_utils
-from iondb.rundb.data.dmactions import _copy_to_dir
+from iondb.rundb.data.dmactions import _copy_to_dir, _copy_files, COPY_BATCH_SIZE
 from iondb.rundb.data.dm_utils import get_walk_filelist
 from iondb.utils.files import getSpaceMB
 
@@ -222,18 +222,19 @@ def copy_files_to_destination(source_dir, destination, dmfileset, cached_file_li
     log('Copy files to destination: %d files, source=%s destination=%s' % (len(to_process), source_dir, destination) )
     
     plugin_warnings = {}
-    for i, filepath in enumerate(to_process):
-        log('%s' % filepath, flush=True)
-        try:
-            _copy_to_dir(filepath, source_dir, destination)
-        except Exception as e:
+    for i in range(0, len(to_process), COPY_BATCH_SIZE):
+        batch = to_process[i:i+COPY_BATCH_SIZE]
+        log('Copying files %d-%d of %d' % (i+1, i+len(batch), len(to_process)), flush=True)
+        _, failed = _copy_files(batch, source_dir, destination)
+        for filepath, e, tb in failed:
             # log and ignore errors from plugin files
             if 'plugin_out' in filepath:
                 plugin_name = filepath.split('plugin_out/')[1].split('_out')[0]
                 plugin_warnings[plugin_name] = plugin_warnings.get(plugin_name,0) + 1
-                log(traceback.format_exc())
+                log('%s: %s' % (filepath, e))
             else:
-                raise
+                # with the traceback of the failed copy
+                raise type(e), e, tb
 
     for plugin, count in plugin_warnings.items():
         add_warning('Unable to copy %d files for plugin %s' % (count,plugin))
@@ -4,8 +4,8 @@
 fileserver_space_check() is a periodic task that gets executed by celery daemon
 on a repeating schedule.  If there are any actions to take, it will execute a
 celery task called manage_data() which will archive or delete one fileset category
-for one Result object.  This function will in turn call a function to do the
-actual work in the filesystem.
+for up to AUTO_ACTION_BATCH Result objects.  This function will in turn call a function
+to do the actual work in the filesystem.
 '''
 import sys
 import os
@@ -25,7 +25,7 @@ from django.core import mail
 from django.core.exceptions import ObjectDoesNotExist
 
 from iondb.rundb.models import GlobalConfig, \
-    DMFileSet, DMFileStat, User, Experiment, Backup, Results, EventLog, Message, PluginResult
+    DMFileSet, DMFileStat, User, Experiment, Backup, Results, EventLog, Message
 from iondb.utils.TaskLock import TaskLock
 import iondb.settings as settings
 from iondb.rundb.data.tasks import delete_action, archive_action, export_action
@@ -34,10 +34,14 @@ from iondb.rundb.data import exceptions as DMExceptions
 from iondb.rundb.data import dmactions
 from iondb.rundb.data.dm_utils import slugify
 from iondb.rundb.data import dm_utils
+from iondb.rundb.data import dmfilestat_utils
 from iondb.anaserve import client
 logger = get_task_logger('data_management')
 logid = {'logid':"%s" % ('DM')}
 
+# Filesets acted upon at the same time per device and category, each action holds one lock
+AUTO_ACTION_BATCH = getattr(settings, 'DM_AUTO_ACTION_BATCH', 3)
+
 #at celeryd start-up, dump an entry into log file.
 from celery.signals import celeryd_after_setup
 @celeryd_after_setup.connect
@@ -130,39 +134,50 @@ def manage_manual_action():
     return
 
 
+def get_candidates(dmfilestats, action, threshdate, limit=1):
+    '''QuerySet of DMFileStat objects.  Returns a list of up to limit objects, in the queryset order,
+    which are not preserved, not in use and pass the action_validation test.
+    Keep flags, files in use and the age of linked Basecalling Input results are decided by the database,
+    only filesets which may be linked are validated one by one.'''
+    logger.debug("Function: %s()" % sys._getframe().f_code.co_name, extra = logid)
+    candidates = dmfilestats.filter(files_in_use='').exclude(
+        Q(dmfileset__type=dmactions_types.SIG, result__experiment__storage_options='KI') |
+        (~Q(dmfileset__type=dmactions_types.SIG) & Q(preserve_data=True)))
+    candidates = candidates.select_related('dmfileset', 'result', 'result__experiment')
+
+    # want to allow Basecalling Input delete if all results are expired
+    recent_exps = set()
+    if action == dmactions.DELETE:
+        recent_exps = set(DMFileStat.objects.filter(dmfileset__type=dmactions_types.BASE, created__gte=threshdate)
+                          .values_list('result__experiment_id', flat=True))
+
+    selected = []
+    for archiveme in candidates.iterator():
+        try:
+            if action == dmactions.DELETE and archiveme.dmfileset.type == dmactions_types.BASE \
+                    and archiveme.result.experiment_id not in recent_exps:
+                archiveme.allow_delete = True
+            else:
+                dmactions.action_validation(archiveme, action)
+            selected.append(archiveme)
+            if len(selected) >= limit:
+                break
+        except(DMExceptions.FilesInUse, DMExceptions.FilesMarkedKeep, DMExceptions.BaseInputLinked):
+            logger.debug("%s Failed action_validation.  Try next fileset" % archiveme.result.resultsName, extra = logid)
+        except:
+            logger.error(traceback.format_exc(), extra = logid)
+
+    if not selected:
+        logger.info("%d filestat objects are preserved or in use." % dmfilestats.count(), extra = logid)
+        raise DMExceptions.NoDMFileStat("NONE FOUND")
+    return selected
+
+
 @task(queue="dmmanage", expires=30, ignore_result = True)
 def manage_data(deviceid, dmfileset, pathlist, auto_acknowledge_enabled, auto_action_enabled):
     logid = {'logid':"%s" % ('manage_data')}
     logger.debug("manage_data: %s %s" % (dmfileset['auto_action'], dmfileset['type']), extra = logid)
 
-    def getfirstnotpreserved(dmfilestats, action, threshdate):
-        '''QuerySet of DMFileStat objects.  Returns first instance of an object
-        with preserve_data set to False and passes the action_validation test'''
-        logger.debug("Function: %s()" % sys._getframe().f_code.co_name, extra = logid)
-        logger.debug("Looking at %d dmfilestat objects" % dmfilestats.count(), extra = logid)
-        for archiveme in dmfilestats:
-            if not archiveme.getpreserved():
-                try:
-                    dmactions.action_validation(archiveme, action)
-                    return archiveme
-                except(DMExceptions.FilesInUse, DMExceptions.FilesMarkedKeep):
-                    logger.debug("%s Failed action_validation.  Try next fileset" % archiveme.result.resultsName, extra = logid)
-                except DMExceptions.BaseInputLinked:
-                    # want to allow Basecalling Input delete if all results are expired
-                    related_objs = DMFileStat.objects.filter(result__experiment=archiveme.result.experiment, dmfileset__type=dmactions_types.BASE)
-                    if related_objs.count() == related_objs.filter(created__lt=threshdate).count():
-                        archiveme.allow_delete = True
-                        return archiveme
-                    else:
-                        logger.debug("%s Failed action_validation.  Try next fileset" % archiveme.result.resultsName, extra = logid)
-                except:
-                    logger.error(traceback.format_exc(), extra = logid)
-            else:
-                logger.debug("Skipped a preserved fileset: %s" % archiveme.result.resultsName, extra = logid)
-
-        logger.info("%d filestat objects are preserved." % dmfilestats.count(), extra = logid)
-        raise DMExceptions.NoDMFileStat("NONE FOUND")
-
     try:
         #logger.debug("manage_data lock for %s (%d)" % (dmfileset['type'], os.getpid()), extra = logid)
         #Create lock file to prevent more than one celery task for each process_type and partition
@@ -180,11 +195,20 @@ def manage_data(deviceid, dmfileset, pathlist, auto_acknowledge_enabled, auto_ac
         logger.error(traceback.format_exc(), extra = logid)
 
 
+    # one lock per running action, the action releases it when done
+    slots = []
+    dispatched = []
     try:
+        slots = [slot for slot in [TaskLock("%s_%d" % (lock_id, i)) for i in range(AUTO_ACTION_BATCH)] if slot.lock()]
+        if not slots:
+            logger.debug("All %d action slots are in use" % AUTO_ACTION_BATCH, extra = logid)
+            return
+
         #---------------------------------------------------------------------------
         # Database object filtering
         #---------------------------------------------------------------------------
         actiondmfilestat = None
+        actiondmfilestats = []
         user_comment = "Auto Action"
         # Order by incrementing pk.  This puts them in chronological order.
         # Select DMFileStat objects of category DMFileSet.type (1/4th of all objects)
@@ -248,8 +272,9 @@ def manage_data(deviceid, dmfileset, pathlist, auto_acknowledge_enabled, auto_ac
 
             # Select first object stored on the deviceid
             try:
-                actiondmfilestat = getfirstnotpreserved(dmfilestats, dmactions.ARCHIVE, threshdate)
-                logger.info("Picked: %s" % (actiondmfilestat.result.resultsName), extra = logid)
+                actiondmfilestats = get_candidates(dmfilestats, dmactions.ARCHIVE, threshdate, len(slots))
+                actiondmfilestat = actiondmfilestats[0]
+                logger.info("Picked: %s" % ', '.join(d.result.resultsName for d in actiondmfilestats), extra = logid)
             except DMExceptions.NoDMFileStat:
                 logger.debug("No filesets to archive on this device", extra = logid)
                 applock.unlock()
@@ -259,8 +284,10 @@ def manage_data(deviceid, dmfileset, pathlist, auto_acknowledge_enabled, auto_ac
                 applock.unlock()
                 logger.debug("Worker PID %d lock_id destroyed %s" % (os.getpid(), lock_id), extra = logid)
             else:
-                applock.update(actiondmfilestat.result.resultsName)
-                archive_action('dm_agent', user_comment, actiondmfilestat, lock_id)
+                for actiondmfilestat, slot in zip(actiondmfilestats, slots):
+                    slot.update(actiondmfilestat.result.resultsName)
+                    archive_action('dm_agent', user_comment, actiondmfilestat, slot.lock_id)
+                    dispatched.append(slot)
 
         #---------------------------------------------------------------------------
         # Delete
@@ -289,8 +316,9 @@ def manage_data(deviceid, dmfileset, pathlist, auto_acknowledge_enabled, auto_ac
                     #already acknowledged but recently enabled auto-acknowledge as well.
                     #deleteme = a_list[0]
                     try:
-                        actiondmfilestat = getfirstnotpreserved(a_list, dmactions.DELETE, threshdate)
-                        logger.info("Picked: %s" % (actiondmfilestat.result.resultsName), extra = logid)
+                        actiondmfilestats = get_candidates(a_list, dmactions.DELETE, threshdate, len(slots))
+                        actiondmfilestat = actiondmfilestats[0]
+                        logger.info("Picked: %s" % ', '.join(d.result.resultsName for d in actiondmfilestats), extra = logid)
                     except DMExceptions.NoDMFileStat:
                         logger.info("No filesets to delete on this device", extra = logid)
                         applock.unlock()
@@ -304,8 +332,9 @@ def manage_data(deviceid, dmfileset, pathlist, auto_acknowledge_enabled, auto_ac
                     # Select oldest fileset regardless if its 'L','S','N','A'.  This covers situation where user
                     # recently enabled auto-acknowledge
                     try:
-                        actiondmfilestat = getfirstnotpreserved(dmfilestats, dmactions.DELETE, threshdate)
-                        logger.info("Picked: %s" % (actiondmfilestat.result.resultsName), extra = logid)
+                        actiondmfilestats = get_candidates(dmfilestats, dmactions.DELETE, threshdate, len(slots))
+                        actiondmfilestat = actiondmfilestats[0]
+                        logger.info("Picked: %s" % ', '.join(d.result.resultsName for d in actiondmfilestats), extra = logid)
                     except DMExceptions.NoDMFileStat:
                         logger.info("No filesets to delete on this device", extra = logid)
                         applock.unlock()
@@ -360,8 +389,9 @@ def manage_data(deviceid, dmfileset, pathlist, auto_acknowledge_enabled, auto_ac
                                 EventLog.objects.add_entry(dmfilestat.result, "Notification for Deletion Sent", username='dm_agent')
 
                     try:
-                        actiondmfilestat = getfirstnotpreserved(dmfilestats.filter(action_state='A'), dmactions.DELETE, threshdate)
-                        logger.info("Picked: %s" % (actiondmfilestat.result.resultsName), extra = logid)
+                        actiondmfilestats = get_candidates(dmfilestats.filter(action_state='A'), dmactions.DELETE, threshdate, len(slots))
+                        actiondmfilestat = actiondmfilestats[0]
+                        logger.info("Picked: %s" % ', '.join(d.result.resultsName for d in actiondmfilestats), extra = logid)
                     except DMExceptions.NoDMFileStat:
                         logger.info("No filesets to delete on this device", extra = logid)
                         applock.unlock()
@@ -373,8 +403,9 @@ def manage_data(deviceid, dmfileset, pathlist, auto_acknowledge_enabled, auto_ac
 
                 else:
                     try:
-                        actiondmfilestat = getfirstnotpreserved(dmfilestats, dmactions.DELETE, threshdate)
-                        logger.info("Picked: %s" % (actiondmfilestat.result.resultsName), extra = logid)
+                        actiondmfilestats = get_candidates(dmfilestats, dmactions.DELETE, threshdate, len(slots))
+                        actiondmfilestat = actiondmfilestats[0]
+                        logger.info("Picked: %s" % ', '.join(d.result.resultsName for d in actiondmfilestats), extra = logid)
                     except DMExceptions.NoDMFileStat:
                         logger.info("No filesets to delete on this device", extra = logid)
                         applock.unlock()
@@ -391,9 +422,10 @@ def manage_data(deviceid, dmfileset, pathlist, auto_acknowledge_enabled, auto_ac
                 logger.debug("Worker PID %d lock_id destroyed %s" % (os.getpid(), lock_id), extra = logid)
                 return
 
-            if actiondmfilestat is not None:
-                applock.update(actiondmfilestat.result.resultsName)
-                delete_action('dm_agent', user_comment, actiondmfilestat, lock_id, confirmed=getattr(actiondmfilestat, 'allow_delete', False) )
+            for actiondmfilestat, slot in zip(actiondmfilestats, slots):
+                slot.update(actiondmfilestat.result.resultsName)
+                delete_action('dm_agent', user_comment, actiondmfilestat, slot.lock_id, confirmed=getattr(actiondmfilestat, 'allow_delete', False) )
+                dispatched.append(slot)
 
         else:
             logger.error("Unknown or unhandled action: %s" % dmfileset['auto_action'], extra = logid)
@@ -428,6 +460,12 @@ def manage_data(deviceid, dmfileset, pathlist, auto_acknowledge_enabled, auto_ac
 
         if actiondmfilestat:
             EventLog.objects.add_entry(actiondmfilestat.result, "%s - %s" % (dmfileset['type'], msg), username='dm_agent')
+    finally:
+        # slots of actions not started, the selection lock is released once the actions are started
+        for slot in slots:
+            if slot not in dispatched:
+                slot.unlock()
+        applock.unlock()
 
     return
 
@@ -456,13 +494,6 @@ def fileserver_space_check():
         if not auto_action_enabled:
             logger.info("Data management auto-action is disabled.", extra = logid)
 
-        # update any DMFileStats that are in use by active analysis jobs
-        try:
-            update_files_in_use()
-        except:
-            logger.error('Unable to update active DMFileStats', extra = logid)
-            logger.error(traceback.format_exc(), extra = logid)
-
         # Checks for manual export and archive requests.
         manage_manual_action.delay()
 
@@ -715,47 +746,44 @@ def notify(name_list, recipient):
             logger.info("Notification email sent for user acknowledgement", extra = logid)
             return True
 
+@periodic_task(run_every=timedelta(hours=1), expires=600, queue="periodic", ignore_result = True)
+def reconcile_files_in_use():
+    '''
+    Low frequency reconciliation of files_in_use, releases filesets whose job end event was missed:
+    plugins stuck in Started for more than a day or jobs lost in a job server restart.
+    '''
+    try:
+        update_files_in_use()
+    except:
+        logger.error('Unable to update active DMFileStats', extra = logid)
+        logger.error(traceback.format_exc(), extra = logid)
+
+
 def update_files_in_use():
     """
-    Updates DMFileStats files_in_use (used in dmactions.action_validation to block file removal)
+    Rebuilds DMFileStats files_in_use (used in dmactions.action_validation to block file removal)
+    from the jobs currently active, in case job start or end events were missed.
+    files_in_use is maintained by the job server and plugin daemon as jobs start and end,
+    see dmfilestat_utils.set_files_in_use.
     Contacts jobserver to retrieve currently active analysis jobs.
     Also adds any results with active plugins.
     """
-    old_in_use = DMFileStat.objects.exclude(files_in_use='')
-
     conn = client.connect(settings.JOBSERVER_HOST, settings.JOBSERVER_PORT)
-    running = conn.running()
-    active = []
-    for item in running:
-        try:
-            result = Results.objects.get(pk=item[2])
-        except ObjectDoesNotExist:
-            logger.warn("Results object does not exist: %d" % (item[2]), extra = logid)
-            continue
-        # check the status - completed results still show up on the running list for a short time
-        if result.status == 'Completed' or result.status == 'TERMINATED':
-            continue
-        # set files_in_use for current result plus any related sigproc dmfilestats
-        dmfilestats = result.dmfilestat_set.all() | DMFileStat.objects.filter(
-                dmfileset__type=dmactions_types.SIG, result__experiment_id=result.experiment_id)
-        msg = "%s (%s), status = %s" % (result.resultsName, result.id, result.status)
-        dmfilestats.update(files_in_use = msg)
-        active.extend(dmfilestats.values_list('pk', flat=True))
-
-    # Add reports that have plugins currently running
-    # consider only plugins with state='Started' and starttime within a day
-    timerange = datetime.now(pytz.UTC) - timedelta(days=1)
-    pluginresults = PluginResult.objects.filter(state='Started', starttime__gt=timerange)
-    for pk in set(pluginresults.values_list('result__pk', flat=True)):
-        result = Results.objects.get(pk=pk)
-        dmfilestats = result.dmfilestat_set.all()
-        msg = "plugins running on %s (%s)" % (result.resultsName, result.id)
-        dmfilestats.update(files_in_use = msg)
-        active.extend(dmfilestats.values_list('pk', flat=True))
-
+    running = [item[2] for item in conn.running()]
+    # completed results still show up on the running list for a short time
+    analysis = Results.objects.filter(pk__in=running).exclude(status__in=['Completed', 'TERMINATED'])
+    analysis = dict(analysis.values_list('pk', 'resultsName'))
+    plugins = dmfilestat_utils.results_with_plugins_running()
+    plugins = dict(Results.objects.filter(pk__in=plugins).values_list('pk', 'resultsName'))
+
+    messages = [dmfilestat_utils.ANALYSIS_IN_USE % (name, pk) for pk, name in analysis.items()]
+    messages += [dmfilestat_utils.PLUGINS_IN_USE % (name, pk) for pk, name in plugins.items()]
     # reset files_in_use to blank for any non-active dmfilestats
-    num = old_in_use.exclude(pk__in=active).update(files_in_use='')
-    logger.debug('update_files_in_use(): %s dmilestats in use by active jobs, %s released for dmactions' % (len(active), num), extra = logid)
+    num = DMFileStat.objects.exclude(files_in_use='').exclude(files_in_use__in=messages).update(files_in_use='')
+
+    dmfilestat_utils.set_files_in_use(analysis.keys(), analysis=True)
+    dmfilestat_utils.set_files_in_use(plugins.keys())
+    logger.debug('update_files_in_use(): %s analysis and %s plugin results active, %s dmfilestats released for dmactions' % (len(analysis), len(plugins), num), extra = logid)
 
 
 def test_tracker():
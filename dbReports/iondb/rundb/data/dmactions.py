@@ -8,6 +8,8 @@ import errno
 import tempfile
 import traceback
 import subprocess
+import stat
+import json
 from iondb.utils.files import getSpaceMB, is_mounted
 from iondb.utils import makePDF
 from ion.utils import makeCSA
@@ -31,6 +33,15 @@ EXPORT = 'export'
 DELETE = 'delete'
 TEST = 'test'
 
+# files copied per _process_task iteration and rsync processes running at the same time
+COPY_BATCH_SIZE = 2000
+COPY_STREAMS = 4
+# files deleted or tested per checkpoint, a checkpoint is also written after CHECKPOINT_SECONDS
+DELETE_BATCH_SIZE = 500
+CHECKPOINT_SECONDS = 2
+# progress of a DM action data file, next to it
+CURSOR_EXT = '.cursor'
+
 
 def delete(user, user_comment, dmfilestat, lockfile, msg_banner, confirmed=False):
     '''DM Action which deletes files'''
@@ -228,7 +239,8 @@ def action_validation(dmfilestat, action, confirmed=False):
     logger.debug("Function: %s()" % sys._getframe().f_code.co_name, extra = logid)
 
     # Any non-blank string in dmfilestat.files_in_use fails the validation.
-    # Manual actions must call data_management.update_files_in_use directly prior to validating for up-to-date info.
+    # files_in_use is set and cleared by the job server and plugin daemon as jobs start and end.
+    # Manual actions call data_management.update_files_in_use prior to validating, in case events were missed.
     if dmfilestat.files_in_use:
         errmsg = "%s files are currently being used by %s." % (dmfilestat.dmfileset.type, dmfilestat.files_in_use)
         logger.info(errmsg, extra = logid)    #For developers only, more informative error string
@@ -443,6 +455,125 @@ def _copy_to_dir(filepath, _start_dir, _destination):
         os.chdir(orig_dir)
 
 
+def _rsync_files_from(relpaths, _start_dir, _destination):
+    '''Start one rsync process copying relpaths, relative to _start_dir, into _destination'''
+    fd, listfile = tempfile.mkstemp(prefix='dm_files_from_')
+    with os.fdopen(fd, 'w') as fileh:
+        fileh.write('\0'.join(relpaths))
+    cmd = ["rsync", "--times", "--copy-links", "--from0", "--files-from=%s" % listfile,
+           os.path.join(_start_dir, ''), os.path.join(_destination, '')]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return proc, listfile
+
+
+def _split_streams(files, streams):
+    '''Split (relpath, size) sorted by path into at most streams contiguous runs of similar size,
+    so the files of a directory mostly go to the same stream'''
+    total = sum(size for _, size in files) or 1
+    runs = [[]]
+    done = 0
+    for relpath, size in files:
+        if runs[-1] and len(runs) < streams and done >= total * len(runs) / float(streams):
+            runs.append([])
+        runs[-1].append(relpath)
+        done += size
+    return runs
+
+
+def _copy_files(filepaths, _start_dir, _destination, streams=COPY_STREAMS):
+    '''
+    Copy many files below _start_dir into the _destination dir, like _copy_to_dir.
+    Destination directories are created once, symbolic links within the local directory tree
+    are recreated and the files are copied by up to streams rsync --files-from processes.
+    Files of a failed rsync are copied again one by one to find the failing file.
+    Returns list of (filepath, size) copied and list of (filepath, exception, traceback) which failed,
+    files which no longer exist fail with an ENOENT OSError.
+    '''
+    logger.debug("Function: %s()" % sys._getframe().f_code.co_name, extra = logid)
+    starttime = time.time()
+    if not os.path.isdir(_destination):
+        raise DMExceptions.MediaNotAvailable("%s is no longer available. Check your remote mounts" % _destination)
+
+    copied = []
+    failed = []
+    to_rsync = []
+    sizes = {}
+    created_dirs = set()
+
+    def _missing(filepath, e=None):
+        if e is None:
+            e = OSError(errno.ENOENT, os.strerror(errno.ENOENT), filepath)
+        failed.append((filepath, e, None))
+
+    def _copy_one(filepath):
+        if not os.path.lexists(filepath):
+            _missing(filepath)
+            return
+        try:
+            _copy_to_dir(filepath, _start_dir, _destination)
+            copied.append((filepath, sizes.get(filepath, 0)))
+        except DMExceptions.MediaNotAvailable:
+            raise
+        except (OSError, IOError) as e:
+            if e.errno == errno.ENOSPC:
+                raise
+            failed.append((filepath, e, sys.exc_info()[2]))
+        except Exception as e:
+            failed.append((filepath, e, sys.exc_info()[2]))
+
+    for filepath in filepaths:
+        if not filepath.startswith(os.path.join(_start_dir, '')):
+            _copy_one(filepath)
+            continue
+        relpath = filepath[len(_start_dir):].lstrip('/')
+        try:
+            st = os.lstat(filepath)
+        except (OSError, IOError) as e:
+            if e.errno in [errno.ENOENT, errno.ESTALE]:
+                _missing(filepath, e)
+                continue
+            raise
+        sizes[filepath] = 0 if stat.S_ISLNK(st.st_mode) else st.st_size
+
+        # Creating subdirectories once per directory
+        local_dir = os.path.dirname(relpath)
+        if local_dir not in created_dirs:
+            created_dirs.add(local_dir)
+            try:
+                os.makedirs(os.path.join(_destination, local_dir))
+                src_dir_stat = os.stat(os.path.dirname(filepath))
+                os.chown(os.path.join(_destination, local_dir), src_dir_stat.st_uid, src_dir_stat.st_gid)
+            except OSError as exception:
+                if exception.errno not in [errno.EEXIST, errno.EPERM, errno.EACCES]:
+                    raise
+
+        # Symbolic links within local directory tree are preserved by _copy_to_dir
+        if stat.S_ISLNK(st.st_mode) and os.path.realpath(filepath).startswith(_start_dir):
+            _copy_one(filepath)
+        else:
+            to_rsync.append((relpath, sizes[filepath]))
+
+    to_rsync.sort()
+    running = []
+    for relpaths in _split_streams(to_rsync, streams) if to_rsync else []:
+        running.append((relpaths,) + _rsync_files_from(relpaths, _start_dir, _destination))
+    for relpaths, proc, listfile in running:
+        _, stderr = proc.communicate()
+        os.unlink(listfile)
+        if proc.returncode == 0:
+            copied.extend((os.path.join(_start_dir, relpath), sizes[os.path.join(_start_dir, relpath)]) for relpath in relpaths)
+        else:
+            logger.warn("rsync exit status %d, copying files one by one: %s" % (proc.returncode, stderr.strip()), extra = logid)
+            for relpath in relpaths:
+                _copy_one(os.path.join(_start_dir, relpath))
+
+    elapsed = max(time.time() - starttime, 0.001)
+    total_mb = sum(size for _, size in copied) / (1024.0 * 1024.0)
+    logger.info("Copied %d files %0.1f MB in %0.1f seconds: %0.1f files/s %0.1f MB/s" %
+                (len(copied), total_mb, elapsed, len(copied) / elapsed, total_mb / elapsed), extra = logid)
+    return copied, failed
+
+
 def _process(filepath, action, destination, _start_dir, to_keep):
     '''
     Two basic operations: copy file, delete file.
@@ -622,60 +753,100 @@ def _process_task(pfilename):
 
             # The dictionary contains an element named 'to_process' which is a list variable to iterate over
             logger.debug("%d, start_dir: %s" % (d_cnt, dict['start_dir']), extra = logid)
-            logger.info("%6d %s %s" %(len(dict['to_process']), dmfilestat.dmfileset.type, dmfilestat.result.resultsName), extra = logid)
+            # files before the cursor are done, the list itself is never rewritten
+            to_process = dict['to_process']
+            cursor = dict.get('cursor', 0)
+            logger.info("%6d %s %s" %(len(to_process) - cursor, dmfilestat.dmfileset.type, dmfilestat.result.resultsName), extra = logid)
 
             while (datetime.now() - start_time) < max_time_delta:
                 # If there are no files left to process, (all to_process lists are empty), the recursion ends
-                if len(dict['to_process']) > 0:
+                if cursor < len(to_process):
                     terminate = False
 
-                    try:
-                        # process one file and remove entry from the list
-                        path = dict['to_process'].pop(0)
-
-                        j = dict['processed_cnt'] + 1
-
-                        this_file_size = 0
-                        if not os.path.islink(path):
-                            this_file_size = os.lstat(path)[6]
-
-                        if _process(path, dict['action'], dict['archivepath'], dict['start_dir'], dict['to_keep']):
-                            dict['processed_cnt'] = j
-                            dict['total_size'] += this_file_size
-                            logger.debug("%04d/%04d %s %10d %s" % (j, dict['total_cnt'], dict['action'], dict['total_size'], path), extra = logid)
+                    if dict['action'] in [EXPORT, ARCHIVE]:
+                        # copy a batch of files at once, archive then removes them one by one
+                        batch = to_process[cursor:cursor+COPY_BATCH_SIZE]
+                        processed, failed = _copy_files(batch, dict['start_dir'], dict['archivepath'])
+                        for path, e, tb in failed:
+                            if isinstance(e, (OSError, IOError)) and e.errno in [errno.ENOENT, errno.ESTALE]:
+                                logger.warn("No longer exists %s" % path, extra = logid)
+                            elif isinstance(e, DMExceptions.RsyncError):
+                                raise type(e), e, tb
+                            else:
+                                logger.error("%s %s: %s" % (dict['action'], path, e), extra = logid)
+                    else:
+                        # process a batch of files one by one, until the batch or the time slice ends
+                        batch = to_process[cursor:cursor+DELETE_BATCH_SIZE]
+                        processed = [(path, None) for path in batch]
+                    checkpoint_time = time.time() + CHECKPOINT_SECONDS
+
+                    # counters of this batch, added to dict together with the cursor so that
+                    # the checkpoint never counts files of a batch that is processed again
+                    batch_cnt = 0
+                    batch_size = 0
+                    for idx, (path, this_file_size) in enumerate(processed):
+                        if idx and dict['action'] not in [EXPORT, ARCHIVE] and time.time() > checkpoint_time:
+                            # checkpoint the files processed so far, the rest goes to the next batch
+                            batch = batch[:idx]
+                            break
+                        try:
+                            j = dict['processed_cnt'] + batch_cnt + 1
 
-                    except (OSError, IOError) as e:
-                        #IOError: [Errno 28] No space left on device:
-                        if e.errno == errno.ENOSPC:
-                            raise
-                        elif e.errno == errno.ENOENT or e.errno == errno.ESTALE:
-                            logger.warn("%04d No longer exists %s" % (j, path), extra = logid)
-                            continue
-                        else:
-                            raise
-                    except (DMExceptions.RsyncError, DMExceptions.MediaNotAvailable):
-                        raise
-                    except:
-                        errmsg = "%04d/%04d %s %10d %s" % (j, dict['total_cnt'], dict['action'], dict['total_size'], path)
-                        logger.error(errmsg, extra = logid)
-                        logger.error(traceback.format_exc(), extra = logid)
+                            if this_file_size is None:
+                                this_file_size = 0
+                                if not os.path.islink(path):
+                                    this_file_size = os.lstat(path)[6]
 
-                    if not dict['action'] in [EXPORT, TEST] and dmfilestat.dmfileset.del_empty_dir:
-                        dir = os.path.dirname(path)
-                        try:
-                            if len(os.listdir(dir)) == 0:
-                                if not "plugin_out" in dir:
-                                    try:
-                                        os.rmdir(dir)
-                                        logger.debug("Removed empty directory: %s" % dir, extra = logid)
-                                    except Exception as e:
-                                        logger.warn("rmdir [%d] %s: %s" % (e.errno, e.strerror, dir), extra = logid)
-                        except OSError as e:
-                            if e.errno == errno.ENOENT:
-                                logger.warn("del_empty_dir Does not exist %s" % (path), extra = logid)
+                            if dict['action'] == EXPORT:
+                                done = True
+                            elif dict['action'] == ARCHIVE:
+                                done = _file_removal(path, dict['to_keep'])
+                            else:
+                                done = _process(path, dict['action'], dict['archivepath'], dict['start_dir'], dict['to_keep'])
+                            if done:
+                                batch_cnt += 1
+                                batch_size += this_file_size
+                                logger.debug("%04d/%04d %s %10d %s" % (j, dict['total_cnt'], dict['action'], dict['total_size'] + batch_size, path), extra = logid)
+
+                        except (OSError, IOError) as e:
+                            #IOError: [Errno 28] No space left on device:
+                            if e.errno == errno.ENOSPC:
+                                raise
+                            elif e.errno == errno.ENOENT or e.errno == errno.ESTALE:
+                                logger.warn("%04d No longer exists %s" % (j, path), extra = logid)
                                 continue
                             else:
-                                raise e
+                                raise
+                        except (DMExceptions.RsyncError, DMExceptions.MediaNotAvailable):
+                            raise
+                        except:
+                            errmsg = "%04d/%04d %s %10d %s" % (j, dict['total_cnt'], dict['action'], dict['total_size'] + batch_size, path)
+                            logger.error(errmsg, extra = logid)
+                            logger.error(traceback.format_exc(), extra = logid)
+
+                        if not dict['action'] in [EXPORT, TEST] and dmfilestat.dmfileset.del_empty_dir:
+                            dir = os.path.dirname(path)
+                            try:
+                                if len(os.listdir(dir)) == 0:
+                                    if not "plugin_out" in dir:
+                                        try:
+                                            os.rmdir(dir)
+                                            logger.debug("Removed empty directory: %s" % dir, extra = logid)
+                                        except Exception as e:
+                                            logger.warn("rmdir [%d] %s: %s" % (e.errno, e.strerror, dir), extra = logid)
+                            except OSError as e:
+                                if e.errno == errno.ENOENT:
+                                    logger.warn("del_empty_dir Does not exist %s" % (path), extra = logid)
+                                    continue
+                                else:
+                                    raise e
+
+                    # checkpoint, a relaunched task continues after this batch
+                    cursor += len(batch)
+                    dict['cursor'] = cursor
+                    dict['processed_cnt'] += batch_cnt
+                    dict['total_size'] += batch_size
+                    set_action_cursor(pfilename, list_of_file_dict)
                 else:
                     break
 
@@ -716,21 +887,12 @@ def _process_task(pfilename):
         # ====================================================================
         return
 
-    # Remove the data file here, no earlier.  In case the task is clobbered, celery
-    # will relaunch the task, access the data file and continue the action.
-    try:
-        os.unlink(pfilename)
-    except:
-        pass
-
-
     if not terminate:
         # ====================================================================
         # Launch next task
         # ====================================================================
         try:
-            dict.get('action','unk')
-            pfilename = set_action_param_var(list_of_file_dict)
+            # the same data file, its cursor records the progress
             _process_task.delay(pfilename)
         except:
             logger.error(traceback.format_exc(), extra = logid)
@@ -739,6 +901,14 @@ def _process_task(pfilename):
         # ====================================================================
         # No more files to process.  Clean up and exit.
         # ====================================================================
+        # Remove the data file here, no earlier.  In case the task is clobbered, celery
+        # will relaunch the task, access the data file and continue the action.
+        for filename in [pfilename, pfilename + CURSOR_EXT]:
+            try:
+                os.unlink(filename)
+            except:
+                pass
+
         try:
             dmfilestat.diskspace = float(total_processed)/(1024*1024)
             dmfilestat.save()
@@ -1015,6 +1185,7 @@ def _create_symlink(dmfilestat):
 def set_action_param_var(list_of_dict_files):
     '''
     Argument is dictionary to be pickled.  Return value is name of file.
+    The file is written once, progress is recorded by set_action_cursor.
     '''
     from cPickle import Pickler
     import tempfile
@@ -1031,6 +1202,18 @@ def set_action_param_var(list_of_dict_files):
     '''
 
 
+def set_action_cursor(pfilename, list_of_dict_files):
+    '''
+    Records the progress of each dictionary next to the data file: the number of files done
+    and the counters.  The write is atomic and its size does not depend on the number of files.
+    '''
+    progress = [dict((key, d[key]) for key in ['cursor', 'processed_cnt', 'total_size'] if key in d) for d in list_of_dict_files]
+    tmpname = pfilename + CURSOR_EXT + '.tmp'
+    with open(tmpname, 'w') as fileh:
+        json.dump(progress, fileh)
+    os.rename(tmpname, pfilename + CURSOR_EXT)
+
+
 def get_action_param_var(pfilename):
     '''
     Argument is name of file to unpickle.  Return value is dictionary value.
@@ -1039,6 +1222,14 @@ def get_action_param_var(pfilename):
     with open(pfilename,'rb') as fileh:
         pickle = Unpickler(fileh)
         list_of_dict_files = pickle.load()
+    # continue from the last checkpoint
+    try:
+        with open(pfilename + CURSOR_EXT, 'r') as fileh:
+            for d, progress in zip(list_of_dict_files, json.load(fileh)):
+                d.update(progress)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
     return list_of_dict_files
     '''
     TODO: Get the variable from the task lock.
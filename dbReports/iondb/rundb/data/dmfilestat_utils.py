@@ -1,18 +1,26 @@
 #!/usr/bin/env python
 # Copyright (C) 2014 Ion Torrent Systems, Inc. All Rights Reserved
 import os
-import errno
+from datetime import timedelta
 
-from django.db.models import Sum
+from django.db.models import Sum, Q
+from django.utils import timezone
 
-from iondb.rundb.models import DMFileStat, FileServer, Chip
+from iondb.rundb.models import DMFileStat, FileServer, Chip, Results, PluginResult
 from iondb.rundb.data import dmactions_types
 from iondb.rundb.data import dm_utils
+from iondb.rundb.data import file_index
 from celery.utils.log import get_task_logger
 
 logger = get_task_logger('data_management')
 logid = {'logid':"%s" % ('tasks')}
 
+# files_in_use of the filesets used by jobs of a result, the jobs release only their own message
+ANALYSIS_IN_USE = "%s (%s), analysis running"
+PLUGINS_IN_USE = "plugins running on %s (%s)"
+# plugins in state Started for longer are not considered running
+PLUGIN_IN_USE_DAYS = 1
+
 def calculate_diskspace_by_path(dmfilestats, fs_path):
     '''
     Calculates dmfilestats diskspace on given path.
@@ -94,15 +102,17 @@ def get_keepers_diskspace(fs_path):
 
 
 def update_diskspace(dmfilestat, cached = None):
-    '''Update diskspace field in dmfilestat object'''
+    '''Update diskspace field in dmfilestat object.
+    cached is the file_index.get_file_index of report and raw data directory'''
     try:
         # search both results directory and raw data directory
         search_dirs = [dmfilestat.result.get_report_dir(), dmfilestat.result.experiment.expDir]
 
         if not cached:
-            cached = dm_utils.get_walk_filelist(search_dirs, list_dir=dmfilestat.result.get_report_dir())
+            cached = file_index.get_file_index(search_dirs, list_dir=dmfilestat.result.get_report_dir())
+        cached_files = dict((row[0], row) for row in cached)
 
-        total_size = 0
+        selected = set()
 
         #Create a list of files eligible to process
         is_thumbnail = dmfilestat.result.isThumbnail
@@ -115,22 +125,12 @@ def update_diskspace(dmfilestat, cached = None):
                                                      [],
                                                      is_thumbnail,
                                                      add_linked_sigproc=True,
-                                                     cached = cached)
-
-                #process files in list
-                for path in to_process[1:]:
-                    try:
-                        #logger.debug("%d %s %s" % (j, 'diskspace', path), extra = logid)
-                        if not os.path.islink(path):
-                            total_size += os.lstat(path)[6]
-
-                    except Exception as inst:
-                        if inst.errno == errno.ENOENT:
-                            pass
-                        else:
-                            errmsg = "update_diskspace %s" % (inst)
-                            logger.error(errmsg, extra = logid)
+                                                     cached = cached_files)
+                selected.update(to_process)
 
+        # allocated size, hard linked files once; files the index does not have are stat'ed
+        rows = [cached_files.get(path) or file_index.stat_row(path) for path in selected]
+        total_size, _ = file_index.disk_usage(row for row in rows if row)
         diskspace = float(total_size)/(1024*1024)
     except:
         diskspace = None
@@ -140,4 +140,45 @@ def update_diskspace(dmfilestat, cached = None):
         dmfilestat.save()
     return diskspace
 
-    
\ No newline at end of file
+    
+
+def results_with_plugins_running(result_pks=None):
+    '''pks of the results with plugins in state Started, of result_pks or of all results'''
+    timerange = timezone.now() - timedelta(days=PLUGIN_IN_USE_DAYS)
+    pluginresults = PluginResult.objects.filter(state='Started', starttime__gt=timerange)
+    if result_pks is not None:
+        pluginresults = pluginresults.filter(result__pk__in=result_pks)
+    return set(pluginresults.values_list('result__pk', flat=True))
+
+
+def set_files_in_use(result_pks, analysis=False):
+    '''
+    Job start event, sets files_in_use of the filesets of the results, blocking dmactions.
+    Analysis jobs also use the signal processing files of their experiment and take precedence
+    over plugins.
+    Called by the job server (analysis) and the plugin daemon, one update per result.
+    '''
+    for pk, name, experiment_id in Results.objects.filter(pk__in=result_pks).values_list('pk', 'resultsName', 'experiment_id'):
+        if analysis:
+            dmfilestats = DMFileStat.objects.filter(Q(result__pk=pk) |
+                                                    Q(dmfileset__type=dmactions_types.SIG, result__experiment__pk=experiment_id))
+            dmfilestats.update(files_in_use=ANALYSIS_IN_USE % (name, pk))
+        else:
+            DMFileStat.objects.filter(result__pk=pk, files_in_use='').update(files_in_use=PLUGINS_IN_USE % (name, pk))
+
+
+def release_files_in_use(result_pks, analysis=False):
+    '''
+    Job end event, clears the files_in_use set by set_files_in_use for the results.
+    Filesets of results with plugins still running stay in use by the plugins.
+    '''
+    results = list(Results.objects.filter(pk__in=result_pks).values_list('pk', 'resultsName'))
+    plugins = results_with_plugins_running([pk for pk, name in results])
+    for pk, name in results:
+        plugins_msg = PLUGINS_IN_USE % (name, pk) if pk in plugins else ''
+        if analysis:
+            in_use = DMFileStat.objects.filter(files_in_use=ANALYSIS_IN_USE % (name, pk))
+            in_use.filter(result__pk=pk).update(files_in_use=plugins_msg)
+            in_use.exclude(result__pk=pk).update(files_in_use='')
+        elif not plugins_msg:
+            DMFileStat.objects.filter(result__pk=pk, files_in_use=PLUGINS_IN_USE % (name, pk)).update(files_in_use='')
@@ -0,0 +1,469 @@
+# Copyright (C) 2014 Ion Torrent Systems, Inc. All Rights Reserved
+'''
+Persistent index of the files in a report and its raw data directory.
+
+The index is a SQLite file in the report directory with one row per directory
+(path, mtime) and one row per file (path, size, mtime, inode).  A refresh stats
+every directory, but only lists directories whose mtime changed since the last
+refresh; files are added, renamed or removed by changing the mtime of their
+directory.  The indexed files of unchanged directories are stat'ed again, a file
+rewritten in place does not change its directory.  Once the analysis has
+completed only plugins write into the report, so plugin_out is always listed.
+
+The directories of a tree level are scanned concurrently by SCAN_THREADS
+threads, on NFS the latency of the stat calls dominates.  disk_usage() sums the
+allocated blocks of indexed files, counting hard linked files once; it serves
+DMFileStat.diskspace and PluginResult sizes.  cached_tree_usage() keeps the
+index of a whole tree, such as a report storage location, in its top directory
+and sums it in SQLite.
+
+DirectoryUsage keeps only the allocated size and number of files per directory,
+for trees too large to index file by file, such as the raw data of a file
+server.  It is refreshed by directory mtime the same way.
+'''
+import os
+import sys
+import stat
+import time
+import sqlite3
+import traceback
+from multiprocessing.pool import ThreadPool
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger('data_management')
+logid = {'logid':"%s" % ('file_index')}
+
+INDEX_FILENAME = "cached.fileindex"
+USAGE_FILENAME = ".cached.dirusage"
+# directories modified this close to the scan may change again within the same mtime
+MTIME_GRANULARITY = 2
+# directories scanned at the same time
+SCAN_THREADS = 8
+
+# increment when the tables change, older index files are rebuilt
+SCHEMA_VERSION = 2
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime REAL);
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, parent TEXT, size INTEGER, mtime REAL, inode INTEGER,
+                                  blocks INTEGER, nlink INTEGER, dev INTEGER);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+CREATE INDEX IF NOT EXISTS files_parent ON files (parent);
+'''
+USAGE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS usage (path TEXT PRIMARY KEY, parent TEXT, mtime REAL, blocks INTEGER, files INTEGER);
+CREATE INDEX IF NOT EXISTS usage_parent ON usage (parent);
+'''
+
+
+def _subtree(path):
+    '''Bounds of the paths below path, '0' sorts right after '/' '''
+    return path + '/', path + '0'
+
+
+def _root(path):
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    return path.rstrip('/') or '/'
+
+
+def _text(path):
+    return path.decode('utf-8') if isinstance(path, str) else path
+
+
+class FileIndex(object):
+
+    def __init__(self, index_path=None):
+        '''index_path None keeps the index in memory, for a one time scan'''
+        self.index_path = index_path
+        created = index_path and not os.path.exists(index_path)
+        self.db = sqlite3.connect(index_path or ':memory:', timeout=60)
+        self.db.text_factory = str
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            self.db.executescript("DROP TABLE IF EXISTS dirs; DROP TABLE IF EXISTS files;")
+            self.db.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+        self.db.executescript(SCHEMA)
+        if created:
+            # Needs to have same uid/gid as directory with 0x666 permissions
+            try:
+                dirstat = os.stat(os.path.dirname(index_path))
+                os.chmod(index_path, 0o666)
+                os.chown(index_path, dirstat.st_uid, dirstat.st_gid)
+            except OSError:
+                logger.warn("Unable to set permissions of %s" % index_path, extra = logid)
+
+    def close(self):
+        self.db.close()
+
+    def _forget(self, cursor, path):
+        '''Remove a directory and everything below it'''
+        low, high = _subtree(_text(path))
+        cursor.execute("DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)", (_text(path), low, high))
+        cursor.execute("DELETE FROM files WHERE path >= ? AND path < ?", (low, high))
+
+    def _list_dir(self, dirpath):
+        '''Returns the sub directories and the file_row of the files in dirpath'''
+        subdirs = []
+        files = []
+        for name in os.listdir(dirpath):
+            # This code address specific issue caused by bad plugin code: TS-9917
+            try:
+                name.decode('utf-8')
+            except:
+                logger.warn("Bad file in directory: %s" % dirpath, extra = logid)
+                logger.warn("File is '%s'" % name, extra = logid)
+                continue
+            if name.startswith(INDEX_FILENAME):
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                # removed while listing
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                subdirs.append(path)
+                continue
+            if stat.S_ISLNK(st.st_mode) and os.path.isdir(path):
+                # linked directories are not followed, except
+                # files from linked sigproc_results folder, except proton onboard_results files
+                if name == 'sigproc_results' and 'onboard_results' not in os.path.realpath(path):
+                    subdirs.append(path)
+                continue
+            files.append(_file_row(path, st))
+        return subdirs, files
+
+    def _scan_dir(self, dirpath, known_mtime, rescan, known_files):
+        '''File system part of a refresh, runs in the scan threads.
+        Returns (dirpath, mtime, listing); if the directory did not change listing is
+        (None, file_row of known_files which still exist), known_files are stat'ed again.'''
+        try:
+            mtime = os.stat(dirpath).st_mtime
+            if not rescan and known_mtime == mtime:
+                return dirpath, mtime, (None, filter(None, map(stat_row, known_files)))
+            return dirpath, mtime, self._list_dir(dirpath)
+        except OSError as e:
+            return dirpath, None, e
+
+    def _update_dir(self, cursor, dirpath, mtime, listing, scantime):
+        '''Updates the entries of dirpath from a _scan_dir result, returns its sub directories'''
+        subdirs, files = listing
+        if subdirs is None:
+            # unchanged directory, only sizes and times of its files
+            cursor.execute("DELETE FROM files WHERE parent = ?", (_text(dirpath),))
+            cursor.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                               [(_text(row[0]), _text(dirpath)) + row[1:] for row in files])
+            cursor.execute("SELECT path FROM dirs WHERE parent = ?", (_text(dirpath),))
+            return [path for path, in cursor.fetchall()]
+
+        cursor.execute("SELECT path FROM dirs WHERE parent = ?", (_text(dirpath),))
+        for path in set(path for path, in cursor.fetchall()) - set(subdirs):
+            self._forget(cursor, path)
+        cursor.execute("DELETE FROM files WHERE parent = ?", (_text(dirpath),))
+        cursor.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                           [(_text(row[0]), _text(dirpath)) + row[1:] for row in files])
+        cursor.executemany("INSERT OR IGNORE INTO dirs VALUES (?, ?, NULL)",
+                           [(_text(path), _text(dirpath)) for path in subdirs])
+        # a directory changing right now is listed again next time
+        if scantime - mtime < MTIME_GRANULARITY:
+            mtime = None
+        cursor.execute("UPDATE dirs SET mtime = ? WHERE path = ?", (mtime, _text(dirpath)))
+        if cursor.rowcount == 0:
+            cursor.execute("INSERT INTO dirs VALUES (?, NULL, ?)", (_text(dirpath), mtime))
+        return subdirs
+
+    def refresh(self, input_dirs, threads=SCAN_THREADS):
+        '''Bring the index of the trees rooted in input_dirs up to date'''
+        scantime = time.time()
+        cursor = self.db.cursor()
+        pool = ThreadPool(threads)
+        try:
+            level = []
+            for item in map(_root, input_dirs):
+                if os.path.isdir(item):
+                    level.append(item)
+                else:
+                    logger.warn("No such directory: %s" % item, extra = logid)
+                    self._forget(cursor, item)
+
+            # one tree level at a time, the directories of a level are scanned concurrently
+            while level:
+                tasks = []
+                for dirpath in level:
+                    cursor.execute("SELECT mtime FROM dirs WHERE path = ?", (_text(dirpath),))
+                    row = cursor.fetchone()
+                    rescan = '/plugin_out/' in dirpath + '/'
+                    known_files = []
+                    if row and not rescan:
+                        cursor.execute("SELECT path FROM files WHERE parent = ?", (_text(dirpath),))
+                        known_files = [path for path, in cursor.fetchall()]
+                    tasks.append((dirpath, row[0] if row else None, rescan, known_files))
+                next_level = []
+                for dirpath, mtime, listing in pool.imap_unordered(lambda task: self._scan_dir(*task), tasks):
+                    if isinstance(listing, OSError):
+                        # removed while scanning
+                        logger.warn("Unable to scan %s" % dirpath, extra = logid)
+                        self._forget(cursor, dirpath)
+                        # list the parent again next time
+                        cursor.execute("UPDATE dirs SET mtime = NULL WHERE path = ?", (_text(os.path.dirname(dirpath)),))
+                        continue
+                    next_level.extend(self._update_dir(cursor, dirpath, mtime, listing, scantime))
+                level = next_level
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+        finally:
+            pool.close()
+            pool.join()
+
+    def files(self, input_dirs):
+        '''Returns (path, size, mtime, inode, blocks, nlink, dev) of the indexed files rooted in input_dirs'''
+        cursor = self.db.cursor()
+        ret = []
+        for item in map(_root, input_dirs):
+            low, high = _subtree(_text(item))
+            cursor.execute("SELECT path, size, mtime, inode, blocks, nlink, dev FROM files WHERE path >= ? AND path < ?", (low, high))
+            ret.extend(cursor.fetchall())
+        return ret
+
+    def paths(self, input_dirs):
+        return [row[0] for row in self.files(input_dirs)]
+
+    def usage(self, input_dirs):
+        '''Returns (bytes allocated, inodes) of the indexed files rooted in input_dirs, see disk_usage'''
+        ranges = [_subtree(_text(item)) for item in map(_root, input_dirs)]
+        if not ranges:
+            return 0, 0
+        where = " OR ".join(["(path >= ? AND path < ?)"] * len(ranges))
+        args = [bound for low_high in ranges for bound in low_high]
+        cursor = self.db.cursor()
+        cursor.execute("SELECT COALESCE(SUM(blocks), 0), COUNT(*) FROM files WHERE nlink <= 1 AND (%s)" % where, args)
+        blocks, inodes = cursor.fetchone()
+        # hard linked files once
+        cursor.execute("SELECT COALESCE(SUM(blocks), 0), COUNT(*) FROM (SELECT MAX(blocks) AS blocks FROM files "
+                       "WHERE nlink > 1 AND (%s) GROUP BY dev, inode)" % where, args)
+        linked_blocks, linked_inodes = cursor.fetchone()
+        return (blocks + linked_blocks) * 512, inodes + linked_inodes
+
+
+def _file_row(path, st):
+    return (path, st.st_size, st.st_mtime, st.st_ino, st.st_blocks, st.st_nlink, st.st_dev)
+
+
+def stat_row(path):
+    '''Returns the (path, size, mtime, inode, blocks, nlink, dev) index row of the file path, None if it is gone'''
+    try:
+        return _file_row(path, os.lstat(path))
+    except OSError:
+        return None
+
+
+def _dir_usage(dirpath):
+    '''Returns the sub directories of dirpath and the blocks allocated by and number of its other entries'''
+    subdirs = []
+    blocks = 0
+    files = 0
+    for name in os.listdir(dirpath):
+        path = os.path.join(dirpath, name)
+        try:
+            st = os.lstat(path)
+        except OSError:
+            # removed while listing
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            try:
+                name.decode('utf-8')
+            except:
+                logger.warn("Bad directory name in %s: '%s'" % (dirpath, name), extra = logid)
+                continue
+            subdirs.append(path)
+        else:
+            blocks += st.st_blocks
+            files += 1
+    return subdirs, blocks, files
+
+
+class DirectoryUsage(object):
+    '''Allocated size and number of files per directory.  Symbolic links are
+    not followed and hard linked files are counted in every directory.'''
+
+    def __init__(self, index_path=None):
+        self.index_path = index_path
+        self.db = sqlite3.connect(index_path or ':memory:', timeout=60)
+        self.db.text_factory = str
+        self.db.executescript(USAGE_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def _forget(self, cursor, path):
+        low, high = _subtree(_text(path))
+        cursor.execute("DELETE FROM usage WHERE path = ? OR (path >= ? AND path < ?)", (_text(path), low, high))
+
+    def _scan_dir(self, dirpath, root, known_mtime, rescan):
+        try:
+            mtime = os.stat(dirpath).st_mtime
+            if not rescan and known_mtime == mtime:
+                return dirpath, root, mtime, None
+            return dirpath, root, mtime, _dir_usage(dirpath)
+        except OSError as e:
+            return dirpath, root, None, e
+
+    def _update_dir(self, cursor, dirpath, mtime, listing, scantime):
+        '''Updates dirpath from a _scan_dir result, returns (sub directories, blocks, files)'''
+        if listing is None:
+            cursor.execute("SELECT blocks, files FROM usage WHERE path = ?", (_text(dirpath),))
+            blocks, files = cursor.fetchone()
+            cursor.execute("SELECT path FROM usage WHERE parent = ?", (_text(dirpath),))
+            return [path for path, in cursor.fetchall()], blocks, files
+
+        subdirs, blocks, files = listing
+        cursor.execute("SELECT path FROM usage WHERE parent = ?", (_text(dirpath),))
+        for path in set(path for path, in cursor.fetchall()) - set(subdirs):
+            self._forget(cursor, path)
+        cursor.executemany("INSERT OR IGNORE INTO usage VALUES (?, ?, NULL, 0, 0)",
+                           [(_text(path), _text(dirpath)) for path in subdirs])
+        # a directory changing right now is listed again next time
+        if scantime - mtime < MTIME_GRANULARITY:
+            mtime = None
+        cursor.execute("UPDATE usage SET mtime = ?, blocks = ?, files = ? WHERE path = ?", (mtime, blocks, files, _text(dirpath)))
+        if cursor.rowcount == 0:
+            cursor.execute("INSERT INTO usage VALUES (?, NULL, ?, ?, ?)", (_text(dirpath), mtime, blocks, files))
+        return subdirs, blocks, files
+
+    def refresh(self, roots, rescan=(), threads=SCAN_THREADS):
+        '''Returns a dict root:(bytes allocated, files) of the trees that exist.
+        Only directories whose mtime changed are listed, except in the trees rescan.'''
+        scantime = time.time()
+        cursor = self.db.cursor()
+        pool = ThreadPool(threads)
+        rescan = set(map(_root, rescan))
+        ret = {}
+        try:
+            level = []
+            for root in roots:
+                if os.path.isdir(root):
+                    ret[root] = [0, 0]
+                    level.append((_root(root), root))
+                else:
+                    self._forget(cursor, _root(root))
+
+            # one tree level at a time, the directories of a level are scanned concurrently
+            while level:
+                tasks = []
+                for dirpath, root in level:
+                    cursor.execute("SELECT mtime FROM usage WHERE path = ?", (_text(dirpath),))
+                    row = cursor.fetchone()
+                    tasks.append((dirpath, root, row[0] if row else None, _root(root) in rescan))
+                level = []
+                for dirpath, root, mtime, listing in pool.imap_unordered(lambda task: self._scan_dir(*task), tasks):
+                    if isinstance(listing, OSError):
+                        logger.warn("Unable to scan %s" % dirpath, extra = logid)
+                        self._forget(cursor, dirpath)
+                        cursor.execute("UPDATE usage SET mtime = NULL WHERE path = ?", (_text(os.path.dirname(dirpath)),))
+                        continue
+                    subdirs, blocks, files = self._update_dir(cursor, dirpath, mtime, listing, scantime)
+                    ret[root][0] += blocks * 512
+                    ret[root][1] += files
+                    level.extend((path, root) for path in subdirs)
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+        finally:
+            pool.close()
+            pool.join()
+        return dict((root, tuple(usage)) for root, usage in ret.items())
+
+
+def open_directory_usage(top_dir):
+    '''Returns the DirectoryUsage kept in top_dir, in memory if it cannot be used'''
+    index_path = os.path.join(top_dir, USAGE_FILENAME)
+    try:
+        return DirectoryUsage(index_path)
+    except (sqlite3.Error, OSError):
+        logger.error("Unable to open %s" % index_path, extra = logid)
+        logger.error(traceback.format_exc(), extra = logid)
+    return DirectoryUsage()
+
+
+def open_index(list_dir, create=True):
+    '''Returns the FileIndex of the report directory list_dir, in memory if there is no
+    index file and create is False or the index file cannot be used'''
+    if list_dir:
+        index_path = os.path.join(list_dir, INDEX_FILENAME)
+        if create or os.path.exists(index_path):
+            try:
+                return FileIndex(index_path)
+            except (sqlite3.Error, OSError):
+                logger.error("Unable to open %s" % index_path, extra = logid)
+                logger.error(traceback.format_exc(), extra = logid)
+    return FileIndex()
+
+
+def get_file_index(input_dirs, list_dir=None, save_list=False):
+    '''Returns (path, size, mtime, inode, blocks, nlink, dev) of all files rooted in input_dirs.
+    The index in list_dir is used if it exists, and created if save_list is True.'''
+    starttime = time.time()
+    index = open_index(list_dir, create=save_list)
+    try:
+        try:
+            index.refresh(input_dirs)
+        except sqlite3.Error:
+            if index.index_path is None:
+                raise
+            # e.g. a read-only or corrupted index, fall back to a full scan
+            logger.error("Unable to update %s" % index.index_path, extra = logid)
+            logger.error(traceback.format_exc(), extra = logid)
+            index.close()
+            index = FileIndex()
+            index.refresh(input_dirs)
+        files = index.files(input_dirs)
+    finally:
+        index.close()
+    logger.info("%s: %f seconds" % (sys._getframe().f_code.co_name, (time.time() - starttime)), extra = logid)
+    return files
+
+
+def disk_usage(files):
+    '''Returns the bytes allocated by files, rows of get_file_index, and the number of inodes.
+    Hard linked files are counted once.'''
+    total_size = 0
+    linked = set()
+    inodes = 0
+    for path, size, mtime, inode, blocks, nlink, dev in files:
+        if nlink > 1:
+            if (dev, inode) in linked:
+                continue
+            linked.add((dev, inode))
+        inodes += 1
+        total_size += blocks * 512
+    return total_size, inodes
+
+
+def tree_usage(input_dirs, list_dir=None):
+    '''Returns (bytes allocated, inodes) of all files rooted in input_dirs, see get_file_index'''
+    return disk_usage(get_file_index(input_dirs, list_dir))
+
+
+def cached_tree_usage(top_dir):
+    '''Returns (bytes allocated, inodes) of the files below top_dir.  The index is kept in
+    top_dir, so only directories changed since the last call are listed; it is summed in SQLite.'''
+    starttime = time.time()
+    index = open_index(top_dir)
+    try:
+        try:
+            index.refresh([top_dir])
+        except sqlite3.Error:
+            if index.index_path is None:
+                raise
+            logger.error("Unable to update %s" % index.index_path, extra = logid)
+            logger.error(traceback.format_exc(), extra = logid)
+            index.close()
+            index = FileIndex()
+            index.refresh([top_dir])
+        usage = index.usage([top_dir])
+    finally:
+        index.close()
+    logger.info("%s %s: %f seconds" % (sys._getframe().f_code.co_name, top_dir, (time.time() - starttime)), extra = logid)
+    return usage
@@ -2,6 +2,7 @@
 '''Functions supporting graphs generated on the Services page'''
 import os
 import math
+from datetime import date, timedelta
 from django import http
 from django.conf import settings
 os.environ['MPLCONFIGDIR'] = '/tmp'
@@ -308,3 +309,38 @@ def residence_time(request):
     response = http.HttpResponse(content_type='image/png')
     canvas.print_png(response)
     return response
+
+
+def rawdata_growth(request):
+    '''Raw data and used disk space of each file server over time, from the
+    daily StorageUsageHistory, for capacity planning. ``days`` limits the
+    period shown, default 365.'''
+    days = int(request.GET.get('days', 365))
+    history = models.StorageUsageHistory.objects.filter(date__gte=date.today() - timedelta(days=days))
+    gigabyte = float(1024 * 1024 * 1024)
+
+    matplotlib.rcParams['font.size'] = 10.0
+    matplotlib.rcParams['legend.fontsize'] = 8.0
+    fig = Figure(figsize=(7, 3))
+    fig.patch.set_alpha(0)
+    ax = fig.add_subplot(1, 1, 1)
+    colors = [IONBLUE, IONGREEN, IONORANGE, IONRED, IONYELLOW]
+    prefixes = sorted(set(history.values_list('filesPrefix', flat=True)))
+    for n, prefix in enumerate(prefixes):
+        rows = list(history.filter(filesPrefix=prefix).values_list('date', 'rawdata', 'used', 'total'))
+        dates = [row[0] for row in rows]
+        color = colors[n % len(colors)]
+        ax.plot_date(dates, [row[1] / gigabyte for row in rows], '-', color=color, label='%s raw data' % prefix)
+        ax.plot_date(dates, [row[2] / gigabyte for row in rows], '--', color=color, label='%s used' % prefix)
+        # file system size
+        ax.axhline(rows[-1][3] / gigabyte, color=color, linestyle=':')
+    ax.set_title('File Server Growth')
+    ax.set_ylabel('GBytes')
+    if prefixes:
+        ax.legend(loc='upper left')
+    fig.autofmt_xdate()
+
+    canvas = FigureCanvas(fig)
+    response = http.HttpResponse(content_type='image/png')
+    canvas.print_png(response)
+    return response
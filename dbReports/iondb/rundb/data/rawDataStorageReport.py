@@ -11,6 +11,8 @@ from django.core.exceptions import ObjectDoesNotExist
 
 import iondb.bin.djangoinit
 from iondb.rundb import models
+from iondb.rundb.data import file_index
+from iondb.rundb.data import rawdata_usage
 import iondb.settings
 
 enable_progress_update = False
@@ -50,20 +52,7 @@ def disk_space(path):
 
 
 def get_size(start, progress):
-    total_size = 0
-    i = 0
-    #faster algorithm?
-    for dirpath, dirnames, filenames in os.walk(start):
-        for f in filenames:
-            try:
-                fp = os.path.join(dirpath, f)
-                total_size += os.path.getsize(fp)
-                if i >= 10000 and progress:
-                    print "\n    Progress update: ~%s Gb" % (total_size / (1024 * 1024 * 1024)) + "\n    Current directory: %s" % dirpath
-                    i = 0
-                i += 1
-            except:
-                pass
+    total_size, _ = file_index.cached_tree_usage(start)
     if progress:
         print "\n    Finished %s" % start + ", total size: %s bytes" % total_size + " = ~%s Gb\n" % (total_size / (1024 * 1024 * 1024))
     return total_size
@@ -89,7 +78,8 @@ def write_simple_report():
         for server in validServers:
             testpath = os.path.join(server.filesPrefix, PGM.name)
             if os.path.isdir(testpath):
-                space = get_size(testpath, enable_progress_update)
+                # raw data of the runs, as of the last refresh_rawdata_usage task
+                space, runs = rawdata_usage.rawdata_usage(testpath)
                 rigSpace += space
                 if enable_progress_update:
                     print "\nPGM %s " % PGM.name + "on server %s " % server.filesPrefix + "contains %s bytes" % space + " = ~%sGb" % (space / (1024 * 1024 * 1024))
@@ -120,20 +110,9 @@ def used_disk_space(path):
     path argument is a list of paths to check disk usage
     Return sum of all disk usage
 
-    Warning: the du system command can take a long time to return when run
-    on a large filesystem.  Don't know what to do about that yet.
+    The index of each path is kept in the path, see file_index.cached_tree_usage.
     '''
-    import commands
-
-    def du(path):
-        diskusage = commands.getstatusoutput("du -sk %s 2>/dev/null" % path)
-        sum = int(diskusage[1].split()[0])
-        return sum
-
-    kbytes = 0
-    for dir in path:
-        if os.path.isdir(dir):
-            kbytes += du(dir)
+    kbytes = sum(file_index.cached_tree_usage(dir)[0] for dir in path if os.path.isdir(dir)) / 1024
 
     # DEBUG PRINTOUT
     #print "Disk Size %s" % path
@@ -271,9 +250,10 @@ def raw_data_storage_report(exps):
 
 def file_server_storage_report():
     '''
-    Reports storage allocation only using the df system command.
-    Anything needing du is not returned because du takes forever on large
-    filesystems.  Large being the typical NAS of ~19TB.
+    Reports storage allocation using the df system command, and the raw data
+    usage kept by the refresh_rawdata_usage task.  Nothing here walks the file
+    system, du takes forever on large filesystems.  Large being the typical
+    NAS of ~19TB.
     '''
     #--------------------------------------------------------------------------
     #   Filesystem tools
@@ -336,6 +316,8 @@ def file_server_storage_report():
         report.append("Total Disk Space         :      %6d GBytes\n" % tds)
         report.append("Used Disk Space          :      %6d GBytes %.1f%%\n" % (uds, percentuds))
         report.append("Free Disk Space          :      %6d GBytes %.1f%%\n" % (fds, percentfds))
+        rawdata, runs = rawdata_usage.rawdata_usage(fileserver.filesPrefix)
+        report.append("Raw Data Disk Space      :      %6d GBytes %d runs\n" % (rawdata / (1024 * 1024 * 1024), runs))
         report.append("\n")
     return report
 
@@ -399,13 +381,11 @@ class Experiment:
         return self.location
 
     def get_folder_size(self):
-        dir = self.dir
-        dir_size = 0
-        for (path, dirs, files) in os.walk(self.dir):
-            for file in files:
-                filename = os.path.join(path, file)
-                dir_size += os.path.getsize(filename)
-        return dir_size
+        try:
+            return models.RawDataUsage.objects.get(experiment__pk=self.pk).diskusage
+        except ObjectDoesNotExist:
+            # not refreshed yet
+            return get_size(self.dir, False)
 
     def get_exp_name(self):
         return self.name
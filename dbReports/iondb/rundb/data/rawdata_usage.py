@@ -0,0 +1,106 @@
+# Copyright (C) 2014 Ion Torrent Systems, Inc. All Rights Reserved
+'''
+Raw data disk usage per Experiment and its daily growth per file server.
+
+refresh_rawdata_usage() runs as a periodic task.  The sizes of the directories
+below each file server are kept in a file_index.DirectoryUsage on the file
+server itself and only directories whose mtime changed are listed again; the
+directories of runs still transferring are listed every time.  Experiments whose
+usage changed are saved in RawDataUsage, StorageUsageHistory gets one row per
+file server and day.  The
+storage report and the capacity graphs read these tables and do not touch the
+file system.
+'''
+import os
+import time
+import traceback
+from datetime import timedelta
+from django.db.models import Sum
+from django.utils import timezone
+from celery.utils.log import get_task_logger
+
+from iondb.rundb import models
+from iondb.rundb.data import file_index
+
+logger = get_task_logger('data_management')
+logid = {'logid':"%s" % ('rawdata_usage')}
+
+# ftpStatus of runs whose raw data transfer has ended, see bin/crawler.py
+TRANSFER_ENDED = ['Complete', 'Completed', 'User Aborted', 'Missing File(s)', 'Lost Chip Connection']
+# runs are considered transferring this long at most
+TRANSFER_DAYS = 2
+
+
+def _fileserver_experiments(prefix):
+    '''(pk, expDir, transferring) of the experiments with raw data on the file server prefix'''
+    experiments = models.Experiment.objects.filter(expDir__startswith=os.path.join(prefix, ''))
+    timerange = timezone.now() - timedelta(days=TRANSFER_DAYS)
+    transferring = set(experiments.filter(date__gt=timerange).exclude(ftpStatus__in=TRANSFER_ENDED).values_list('pk', flat=True))
+    return [(pk, expDir, pk in transferring) for pk, expDir in experiments.values_list('pk', 'expDir')]
+
+
+def _save_usage(pk, usage, stored):
+    if stored.get(pk) == usage:
+        return
+    diskusage, files = usage
+    if not models.RawDataUsage.objects.filter(experiment__pk=pk).update(diskusage=diskusage, files=files, updated=timezone.now()):
+        models.RawDataUsage.objects.create(experiment_id=pk, diskusage=diskusage, files=files)
+
+
+def refresh_fileserver(prefix):
+    '''Updates RawDataUsage of the experiments on file server prefix and its StorageUsageHistory,
+    returns (bytes used by raw data, runs)'''
+    experiments = _fileserver_experiments(prefix)
+    stored = dict((pk, (diskusage, files)) for pk, diskusage, files in
+                  models.RawDataUsage.objects.filter(experiment__expDir__startswith=os.path.join(prefix, ''))
+                  .values_list('experiment_id', 'diskusage', 'files'))
+
+    index = file_index.open_directory_usage(prefix)
+    try:
+        # files grow in place while a run transfers, its directories are listed every time
+        usage = index.refresh([expDir for pk, expDir, transferring in experiments],
+                              rescan=[expDir for pk, expDir, transferring in experiments if transferring])
+    finally:
+        index.close()
+
+    rawdata = 0
+    runs = 0
+    for pk, expDir, transferring in experiments:
+        if expDir in usage:
+            _save_usage(pk, usage[expDir], stored)
+            rawdata += usage[expDir][0]
+            runs += 1
+        elif pk in stored:
+            # raw data removed
+            _save_usage(pk, (0, 0), stored)
+
+    st = os.statvfs(prefix)
+    total = st.f_blocks * st.f_frsize
+    used = total - st.f_bfree * st.f_frsize
+    history, created = models.StorageUsageHistory.objects.get_or_create(filesPrefix=prefix, date=timezone.now().date())
+    history.rawdata = rawdata
+    history.runs = runs
+    history.used = used
+    history.total = total
+    history.save()
+    return rawdata, runs
+
+
+def refresh_rawdata_usage():
+    for fileserver in models.FileServer.objects.all():
+        if not os.path.isdir(fileserver.filesPrefix):
+            continue
+        try:
+            starttime = time.time()
+            rawdata, runs = refresh_fileserver(fileserver.filesPrefix)
+            logger.info("%s: %d runs, %d GB raw data, %f seconds" % (fileserver.filesPrefix, runs,
+                        rawdata / (1024 * 1024 * 1024), time.time() - starttime), extra = logid)
+        except:
+            logger.error("Unable to refresh raw data usage of %s" % fileserver.filesPrefix, extra = logid)
+            logger.error(traceback.format_exc(), extra = logid)
+
+
+def rawdata_usage(path):
+    '''Returns (bytes, runs) of the raw data below path, as of the last refresh'''
+    usage = models.RawDataUsage.objects.filter(experiment__expDir__startswith=os.path.join(path, ''), files__gt=0)
+    return usage.aggregate(sum=Sum('diskusage'))['sum'] or 0, usage.count()
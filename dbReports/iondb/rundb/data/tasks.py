@@ -11,9 +11,10 @@ from django.core import urlresolvers
 from django import shortcuts
 from iondb.rundb.models import Message, Results, EventLog, DMFileStat
 from iondb.rundb.data import dmactions
-from iondb.rundb.data import dm_utils
+from iondb.rundb.data import file_index
 from iondb.rundb.data import dmfilestat_utils
 from iondb.rundb.data import dmactions_types
+from iondb.rundb.data import rawdata_usage
 from iondb.rundb.data.dmactions_types import FILESET_TYPES
 from iondb.rundb.data.project_msg_banner import project_msg_banner
 from celery.exceptions import SoftTimeLimitExceeded
@@ -109,8 +110,8 @@ def update_dmfilestats_diskspace(dmfilestat):
     ''' Task to update DMFileStat.diskspace '''
     search_dirs = [dmfilestat.result.get_report_dir(), dmfilestat.result.experiment.expDir]
     try:
-        cached_file_list = dm_utils.get_walk_filelist(search_dirs, list_dir=dmfilestat.result.get_report_dir())
-        dmfilestat_utils.update_diskspace(dmfilestat, cached=cached_file_list)
+        cached_file_index = file_index.get_file_index(search_dirs, list_dir=dmfilestat.result.get_report_dir())
+        dmfilestat_utils.update_diskspace(dmfilestat, cached=cached_file_index)
     except:
         logger.exception(traceback.format_exc(), extra = logid)
 
@@ -126,10 +127,10 @@ def update_dmfilestat_diskusage(resultpk):
     try:
         result = Results.objects.get(pk=resultpk)
         search_dirs = [result.get_report_dir(), result.experiment.expDir]
-        cached_file_list = dm_utils.get_walk_filelist(search_dirs, list_dir=result.get_report_dir(), save_list=True)
+        cached_file_index = file_index.get_file_index(search_dirs, list_dir=result.get_report_dir(), save_list=True)
         for dmtype in FILESET_TYPES:
             dmfilestat = result.get_filestat(dmtype)
-            dmfilestat_utils.update_diskspace(dmfilestat, cached=cached_file_list)
+            dmfilestat_utils.update_diskspace(dmfilestat, cached=cached_file_index)
     except SoftTimeLimitExceeded:
         logger.warn("Time exceeded update_diskusage for (%d) %s" % (resultpk,result.resultsName), extra = logid)
     except:
@@ -162,13 +163,19 @@ def backfill_dmfilestats_diskspace():
         dmfilestat = dmfilestats[0]
         search_dirs = [dmfilestat.result.get_report_dir(), dmfilestat.result.experiment.expDir]
         try:
-            cached_file_list = dm_utils.get_walk_filelist(search_dirs, list_dir=dmfilestat.result.get_report_dir(), save_list=True)
-            dmfilestat_utils.update_diskspace(dmfilestat, cached=cached_file_list)
+            cached_file_index = file_index.get_file_index(search_dirs, list_dir=dmfilestat.result.get_report_dir(), save_list=True)
+            dmfilestat_utils.update_diskspace(dmfilestat, cached=cached_file_index)
         except:
             logger.error(traceback.format_exc(), extra = logid)
             raise
 
 
+@periodic_task(run_every=3600, expires=600, queue="diskutil", ignore_result = True)
+def refresh_rawdata_usage():
+    ''' Updates the raw data disk usage per Experiment and file server, see rawdata_usage.py '''
+    rawdata_usage.refresh_rawdata_usage()
+
+
 @app.task
 def save_serialized_json(resultpk):
     ''' Quick task to serialize and save in a json file all result-related dbase objects '''
@@ -43,6 +43,7 @@ urlpatterns = patterns(
     url(r'^datamanagement/(.+)/(.+)/file_server_status.png/$', 'graphs.fs_statusbar'),
     url(r'^datamanagement/archive_drivespace.png/$', 'graphs.archive_drivespace_bar'),
     url(r'^datamanagement/residence_time.png$', 'graphs.residence_time'),
+    url(r'^datamanagement/rawdata_growth.png$', 'graphs.rawdata_growth'),
     url(r'^datamanagement/dmactions_jobs/$', 'views.dmactions_jobs', name='dmactions_jobs'),
     url(r'^datamanagement/dmactions_jobs/cancel/(?P<pk>\d+)/', 'views.cancel_pending_dmaction', name='cancel_pending_dmaction'),
 
@@ -19,6 +19,7 @@ the data gathering and analysis.
 import datetime
 import re
 import os
+import time
 import fnmatch
 import traceback
 import pytz
@@ -27,7 +28,7 @@ from django.core.exceptions import ValidationError
 import iondb.settings
 
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from iondb.utils import devices
 
 from iondb.rundb import json_field
@@ -3567,6 +3568,12 @@ class PluginResult(models.Model):
 
     owner = models.ForeignKey(User)
 
+    # html and php files of the output folder, written on completion, see update_manifest()
+    manifest = json_field.JSONField(blank=True, default='')
+
+    # folder mtimes closer than this to the listing may hide later changes
+    MANIFEST_MTIME_GRANULARITY = 2
+
     @cached_property
     def default_path(self):
         return self.path(create=False, fallback=True)
@@ -3598,32 +3605,47 @@ class PluginResult(models.Model):
 
         return path
 
+    def update_manifest(self):
+        """ List the html and php files of the output folder into manifest, {} if the folder is missing """
+        path = self.path(create=False)
+        try:
+            mtime = os.stat(path).st_mtime
+            files = sorted(pfile for pfile in os.listdir(path) if (pfile.endswith(".html") or pfile.endswith(".php")))
+        except OSError:
+            self.manifest = {}
+            return self.manifest
+
+        if time.time() - mtime < self.MANIFEST_MTIME_GRANULARITY:
+            # changes within the same mtime tick would go unnoticed, treat as stale
+            mtime = None
+        self.manifest = {'path': path, 'mtime': int(mtime) if mtime else None, 'files': files}
+        return self.manifest
+
+    def current_manifest(self):
+        """ Returns the manifest if the output folder did not change since it was written, else None """
+        manifest = self.manifest
+        if not manifest or not manifest.get('mtime') or self.state in self.RUNNING_STATES:
+            return None
+        try:
+            if int(os.stat(manifest['path']).st_mtime) != manifest['mtime']:
+                return None
+        except OSError:
+            return None
+        return manifest
+
     # compat - return just size, not (size,inodes) tuple
     def calc_size(self):
         return self._calc_size[0]
 
     @cached_property
     def _calc_size(self):
+        from iondb.rundb.data import file_index
         d = self.default_path
         if not d or not os.path.exists(d):
             return (0,0)
 
-        total_size = 0
-        inodes = 0
-
-        file_walker = (
-            os.path.join(root, f)
-            for root, _, files in os.walk( d )
-            for f in files
-        )
-        for f in file_walker:
-            if not os.path.isfile(f):
-                continue
-            inodes += 1
-            try:
-                total_size += os.lstat(f).st_size
-            except OSError:
-                logger.exception("Failed accessing %s during calc_size", f)
+        # the report file index is refreshed if it exists, plugin output is always rescanned
+        total_size, inodes = file_index.tree_usage([d], list_dir=self.result.get_report_dir())
 
         logger.info("PluginResult %d for %s has %d byte(s) in %d file(s)",
                     self.id, self.plugin.name, total_size, inodes)
@@ -3649,6 +3671,7 @@ class PluginResult(models.Model):
         self.starttime = None
         self.endtime = None
         self.jobid = jobid
+        self.manifest = {}
 
     def start(self, jobid=None):
         self.state = 'Started'
@@ -3663,7 +3686,8 @@ class PluginResult(models.Model):
         self.endtime = timezone.now()
         self.state = state
         self.apikey = None
-        self.save(update_fields=['endtime', 'state', 'apikey'])
+        self.update_manifest()
+        self.save(update_fields=['endtime', 'state', 'apikey', 'manifest'])
         # Compute size as background task
         plugintasks.calc_size.delay(self.id)
 
@@ -4342,8 +4366,9 @@ class DMFileStat (models.Model):
     # megabytes used by files
     diskspace = models.FloatField(blank=True, null=True)
 
-    # status of files currently being used by analysis pipeline
-    files_in_use = models.CharField(max_length=512, blank=True, default='')
+    # status of files currently being used by analysis pipeline or plugins,
+    # set and cleared by job start and end events, see dmfilestat_utils.set_files_in_use
+    files_in_use = models.CharField(max_length=512, blank=True, default='', db_index=True)
 
     # link to result object (the Report)
     result = models.ForeignKey(Results, null=True, blank=True)
@@ -4403,6 +4428,166 @@ class DMFileStat (models.Model):
         return bool(self.action_state in ['AG','DG','EG','SA','SE','SD'])
 
 
+class RawDataUsage(models.Model):
+    """Disk space used by the raw data directory of an Experiment, refreshed by
+    a periodic task, see data/rawdata_usage.py
+    """
+    experiment = models.OneToOneField(Experiment, related_name='rawdatausage')
+    # bytes allocated
+    diskusage = models.BigIntegerField(default=0)
+    files = models.IntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return u'%s' % self.experiment
+
+
+class StorageUsageHistory(models.Model):
+    """Daily raw data growth of a file server, for capacity planning"""
+    filesPrefix = models.CharField(max_length=200)
+    date = models.DateField()
+    # bytes allocated by raw data directories, number of runs
+    rawdata = models.BigIntegerField(default=0)
+    runs = models.IntegerField(default=0)
+    # bytes used and total of the file system, from statvfs
+    used = models.BigIntegerField(default=0)
+    total = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = (('filesPrefix', 'date'),)
+        ordering = ['date']
+
+    def __unicode__(self):
+        return u'%s %s' % (self.filesPrefix, self.date)
+
+
+class PlanSummary(models.Model):
+    """Values the plan API copies from the experiment, its analysis settings and samples,
+    stored so plan listings do not query them for every plan.
+    Rows are deleted when any of these change and rebuilt on the next listing.
+    """
+    plan = models.OneToOneField(PlannedExperiment, related_name='summary')
+    data = json_field.JSONField(blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    @staticmethod
+    def build(plan):
+        """Computes the summary values of plan"""
+        data = {}
+        try:
+            experiment = plan.experiment
+        except Experiment.DoesNotExist:
+            logger.error('Missing experiment for Plan %s(%s)' % (plan.planName, plan.pk))
+            return data
+
+        data['autoAnalyze'] = experiment.autoAnalyze
+        data['chipType'] = experiment.chipType
+        data['flows'] = experiment.flows
+        data['flowsInOrder'] = experiment.flowsInOrder
+        data['notes'] = experiment.notes
+        data['sequencekitname'] = experiment.sequencekitname
+        data['platform'] = experiment.platform
+
+        latest_eas = plan.latestEAS
+        if not latest_eas:
+            latest_eas = experiment.get_EAS()
+
+        data['barcodedSamples'] = latest_eas.barcodedSamples if latest_eas else ""
+        data['barcodeId'] = latest_eas.barcodeKitName if latest_eas else ""
+        data['bedfile'] = latest_eas.targetRegionBedFile if latest_eas else ""
+        data['forward3primeadapter'] = latest_eas.threePrimeAdapter if latest_eas else ""
+        data['library'] = latest_eas.reference if latest_eas else ""
+        data['libraryKey'] = latest_eas.libraryKey if latest_eas else ""
+        data['tfKey'] = latest_eas.tfKey if latest_eas else ""
+        data['librarykitname'] = latest_eas.libraryKitName if latest_eas else ""
+        data['regionfile'] = latest_eas.hotSpotRegionBedFile if latest_eas else ""
+        data['isDuplicateReads'] = latest_eas.isDuplicateReads if latest_eas else False
+        data['base_recalibration_mode'] = latest_eas.base_recalibration_mode if latest_eas else "no_recal"
+        data['realign'] = latest_eas.realign if latest_eas else False
+
+        for args in ['beadfindargs', 'thumbnailbeadfindargs', 'analysisargs', 'thumbnailanalysisargs',
+                     'prebasecallerargs', 'prethumbnailbasecallerargs', 'calibrateargs', 'thumbnailcalibrateargs',
+                     'basecallerargs', 'thumbnailbasecallerargs', 'alignmentargs', 'thumbnailalignmentargs']:
+            data[args] = getattr(latest_eas, args) if latest_eas else ""
+
+        data['sample'] = ""
+        data['sampleDisplayedName'] = ""
+        if not (latest_eas and latest_eas.barcodeKitName):
+            samples = experiment.samples.all()
+            if samples:
+                data['sample'] = samples[0].name
+                data['sampleDisplayedName'] = samples[0].displayedName
+
+        data['selectedPlugins'] = latest_eas.selectedPlugins if latest_eas else ""
+
+        if latest_eas:
+            pluginInfo = latest_eas.selectedPlugins.get("variantCaller", {})
+            if pluginInfo:
+                userInput = pluginInfo.get("userInput", {})
+                if userInput:
+                    data['variantfrequency'] = userInput.get("variationtype", "")
+
+        return data
+
+    @classmethod
+    def get_data(cls, plan):
+        """Returns the stored summary values of plan, building them if missing"""
+        try:
+            return plan.summary.data
+        except cls.DoesNotExist:
+            pass
+
+        data = cls.build(plan)
+        if plan.pk:
+            try:
+                with transaction.atomic():
+                    cls.objects.create(plan=plan, data=data)
+            except IntegrityError:
+                # stored by a concurrent request
+                pass
+        return data
+
+    def __unicode__(self):
+        return u'%s' % self.plan
+
+
+@receiver(post_save, sender=PlannedExperiment, dispatch_uid="plansummary_plan")
+def on_plan_saved(sender, instance, **kwargs):
+    PlanSummary.objects.filter(plan=instance.pk).delete()
+
+
+@receiver(post_save, sender=Experiment, dispatch_uid="plansummary_experiment")
+def on_plan_experiment_saved(sender, instance, **kwargs):
+    if instance.plan_id:
+        PlanSummary.objects.filter(plan=instance.plan_id).delete()
+
+
+@receiver(post_save, sender=ExperimentAnalysisSettings, dispatch_uid="plansummary_eas_saved")
+@receiver(post_delete, sender=ExperimentAnalysisSettings, dispatch_uid="plansummary_eas_deleted")
+def on_plan_eas_changed(sender, instance, **kwargs):
+    if instance.experiment_id:
+        PlanSummary.objects.filter(plan__experiment=instance.experiment_id).delete()
+
+
+@receiver(post_save, sender=Sample, dispatch_uid="plansummary_sample_saved")
+@receiver(pre_delete, sender=Sample, dispatch_uid="plansummary_sample_deleted")
+def on_plan_sample_changed(sender, instance, **kwargs):
+    PlanSummary.objects.filter(plan__experiment__samples=instance.pk).delete()
+
+
+@receiver(m2m_changed, sender=Sample.experiments.through, dispatch_uid="plansummary_samples_changed")
+def on_plan_samples_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ['post_add', 'post_remove', 'pre_clear']:
+        return
+    if reverse:
+        # instance is an Experiment
+        PlanSummary.objects.filter(plan__experiment=instance.pk).delete()
+    elif action == 'pre_clear':
+        PlanSummary.objects.filter(plan__experiment__samples=instance.pk).delete()
+    elif pk_set:
+        PlanSummary.objects.filter(plan__experiment__in=pk_set).delete()
+
+
 class FileMonitor(models.Model):
     """Record the details of a file download from a remote server to the TS
     by a backround or automated process.
@@ -4687,3 +4872,39 @@ class SharedServer(models.Model):
 
     def __unicode__(self):
         return self.name
+
+
+# Time of the last change of each model, the API cache keys depend on it, see api.ModelResource.
+# queryset update() does not send signals and is not seen here.
+MODEL_VERSION_TIMEOUT = 7 * 24 * 3600
+
+def model_version_key(model):
+    return "model_version_%s" % model._meta.db_table
+
+def model_versions(model_list):
+    """Returns the last change times of model_list, models without a known time are set to now"""
+    keys = [model_version_key(model) for model in model_list]
+    versions = cache.get_many(keys)
+    missing = dict((key, time.time()) for key in keys if key not in versions)
+    if missing:
+        cache.set_many(missing, MODEL_VERSION_TIMEOUT)
+        versions.update(missing)
+    return [versions[key] for key in keys]
+
+def touch_models(*model_list):
+    """Records a change of the models, for writes which send no signals (bulk_create, update)"""
+    now = time.time()
+    cache.set_many(dict((model_version_key(model), now) for model in model_list), MODEL_VERSION_TIMEOUT)
+
+
+@receiver(post_save, dispatch_uid="model_version_saved")
+@receiver(post_delete, dispatch_uid="model_version_deleted")
+def on_model_changed(sender, **kwargs):
+    if sender._meta.app_label == 'rundb':
+        touch_models(sender)
+
+
+@receiver(m2m_changed, dispatch_uid="model_version_relation")
+def on_relation_changed(sender, instance, action, model, **kwargs):
+    if action.startswith('post_') and sender._meta.app_label == 'rundb':
+        touch_models(sender, instance.__class__, model)
@@ -0,0 +1,104 @@
+# Copyright (C) 2014 Ion Torrent Systems, Inc. All Rights Reserved
+from django.test import TestCase
+from iondb.rundb.models import PlannedExperiment, Experiment, ExperimentAnalysisSettings, Sample, PlanSummary
+from datetime import datetime
+import uuid
+
+
+class PlanSummaryTest(TestCase):
+    fixtures = ['iondb/rundb/tests/views/report/fixtures/globalconfig.json']
+
+    def setUp(self):
+        plan = PlannedExperiment(planName='summary test')
+        plan.save()
+        self.plan_pk = plan.pk
+
+        exp = Experiment()
+        exp.date = datetime.now()
+        exp.cycles = 0
+        exp.flows = 500
+        exp.unique = uuid.uuid1()
+        exp.plan = plan
+        exp.save()
+        self.experiment = exp
+
+        self.eas = ExperimentAnalysisSettings.objects.create(experiment=exp, isEditable=True, reference='hg19', selectedPlugins={})
+
+    def plan(self):
+        # fresh instance, plan.summary is cached on the instance
+        return PlannedExperiment.objects.get(pk=self.plan_pk)
+
+    def stored(self):
+        return PlanSummary.objects.filter(plan=self.plan_pk).count()
+
+    def test_get_data(self):
+        data = PlanSummary.get_data(self.plan())
+        self.assertEqual(data['flows'], 500)
+        self.assertEqual(data['library'], 'hg19')
+        self.assertEqual(self.stored(), 1)
+        self.assertEqual(PlanSummary.get_data(self.plan()), data)
+        self.assertEqual(self.stored(), 1)
+
+    def test_plan_without_experiment(self):
+        plan = PlannedExperiment(planName='no experiment')
+        plan.save()
+        self.assertEqual(PlanSummary.get_data(plan), {})
+
+    def test_plan_saved(self):
+        PlanSummary.get_data(self.plan())
+        self.plan().save()
+        self.assertEqual(self.stored(), 0)
+
+    def test_experiment_saved(self):
+        PlanSummary.get_data(self.plan())
+        self.experiment.flows = 260
+        self.experiment.save()
+        self.assertEqual(self.stored(), 0)
+        self.assertEqual(PlanSummary.get_data(self.plan())['flows'], 260)
+
+    def test_eas_saved(self):
+        PlanSummary.get_data(self.plan())
+        self.eas.reference = 'hg38'
+        self.eas.save()
+        self.assertEqual(self.stored(), 0)
+        self.assertEqual(PlanSummary.get_data(self.plan())['library'], 'hg38')
+
+    def test_eas_deleted(self):
+        PlanSummary.get_data(self.plan())
+        self.eas.delete()
+        self.assertEqual(self.stored(), 0)
+        self.assertEqual(PlanSummary.get_data(self.plan())['library'], '')
+
+    def test_sample_added(self):
+        sample = Sample.objects.create(name='sample_1', displayedName='sample 1')
+        PlanSummary.get_data(self.plan())
+        sample.experiments.add(self.experiment)
+        self.assertEqual(self.stored(), 0)
+        self.assertEqual(PlanSummary.get_data(self.plan())['sample'], 'sample_1')
+        self.experiment.samples.remove(sample)
+        self.assertEqual(self.stored(), 0)
+        self.assertEqual(PlanSummary.get_data(self.plan())['sample'], '')
+
+    def test_sample_saved(self):
+        sample = Sample.objects.create(name='sample_1', displayedName='sample 1')
+        sample.experiments.add(self.experiment)
+        PlanSummary.get_data(self.plan())
+        sample.displayedName = 'renamed'
+        sample.save()
+        self.assertEqual(self.stored(), 0)
+        self.assertEqual(PlanSummary.get_data(self.plan())['sampleDisplayedName'], 'renamed')
+
+    def test_sample_deleted(self):
+        sample = Sample.objects.create(name='sample_1', displayedName='sample 1')
+        sample.experiments.add(self.experiment)
+        PlanSummary.get_data(self.plan())
+        sample.delete()
+        self.assertEqual(self.stored(), 0)
+        self.assertEqual(PlanSummary.get_data(self.plan())['sample'], '')
+
+    def test_samples_cleared(self):
+        sample = Sample.objects.create(name='sample_1', displayedName='sample 1')
+        sample.experiments.add(self.experiment)
+        PlanSummary.get_data(self.plan())
+        sample.experiments.clear()
+        self.assertEqual(self.stored(), 0)
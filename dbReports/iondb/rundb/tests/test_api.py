@@ -0,0 +1,84 @@
+# Copyright (C) 2014 Ion Torrent Systems, Inc. All Rights Reserved
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.http import HttpResponse
+from django.core.cache import get_cache
+from iondb.rundb import api, models
+
+
+class ConditionalResponseTest(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_etag(self):
+        response = api.conditional_response(self.factory.get('/rundb/api/v1/rig/'), HttpResponse('{"objects": []}'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header('ETag'))
+        self.assertTrue('no-cache' in response['Cache-Control'])
+
+    def test_not_modified(self):
+        etag = api.conditional_response(self.factory.get('/'), HttpResponse('content'))['ETag']
+        response = api.conditional_response(self.factory.get('/', HTTP_IF_NONE_MATCH=etag), HttpResponse('content'))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, '')
+
+    def test_changed_content(self):
+        etag = api.conditional_response(self.factory.get('/'), HttpResponse('content'))['ETag']
+        response = api.conditional_response(self.factory.get('/', HTTP_IF_NONE_MATCH=etag), HttpResponse('changed'))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_not_get(self):
+        response = api.conditional_response(self.factory.post('/'), HttpResponse('content'))
+        self.assertFalse(response.has_header('ETag'))
+
+    def test_error(self):
+        response = api.conditional_response(self.factory.get('/'), HttpResponse('error', status=500))
+        self.assertFalse(response.has_header('ETag'))
+
+
+class CachedResourceTest(TestCase):
+    fixtures = ['iondb/rundb/tests/models/fixtures/groups.json',
+                'iondb/rundb/tests/models/fixtures/users.json']
+
+    def setUp(self):
+        # the pages and model versions are kept in the default cache, memcached
+        self.cache = get_cache('django.core.cache.backends.locmem.LocMemCache')
+        self.saved_caches = (api.cache, models.cache)
+        api.cache = models.cache = self.cache
+        self.client.login(username='ionadmin', password='ionadmin')
+        location = models.Location.objects.create(name='Home')
+        models.Rig.objects.create(name='PGM_test', location=location)
+
+    def tearDown(self):
+        api.cache, models.cache = self.saved_caches
+        self.cache.clear()
+
+    def get(self, **extra):
+        return self.client.get('/rundb/api/v1/rig/', {'format': 'json'}, **extra)
+
+    def test_not_modified(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header('Last-Modified'))
+        response = self.get(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_model_saved(self):
+        response = self.get()
+        models.Rig.objects.create(name='PGM_test_2', location=models.Location.objects.get(name='Home'))
+        changed = self.get(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertTrue('PGM_test_2' in changed.content)
+
+    def test_cache_model_saved(self):
+        response = self.get()
+        models.Location.objects.filter(name='Home').update(name='Lab')
+        # update sends no signal
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        models.touch_models(models.Location)
+        changed = self.get(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertTrue('Lab' in changed.content)
@@ -0,0 +1,81 @@
+# Copyright (C) 2014 Ion Torrent Systems, Inc. All Rights Reserved
+from datetime import timedelta
+from django.test import TestCase
+from django.utils import timezone
+from django.conf import settings
+from iondb.rundb.models import Results, DMFileSet, DMFileStat
+from iondb.rundb.tests.models.test_results import create_result
+from iondb.rundb.data import dmactions, dmactions_types
+from iondb.rundb.data import exceptions as DMExceptions
+from iondb.rundb.data.data_management import get_candidates
+
+
+class DMFileStatTestCase(TestCase):
+    fixtures = ['iondb/rundb/tests/views/report/fixtures/globalconfig.json',
+                'iondb/rundb/tests/models/fixtures/groups.json',
+                'iondb/rundb/tests/models/fixtures/users.json']
+
+    def setUp(self):
+        # Results.save creates a DMFileStat for each DMFileSet of the release
+        for dmtype in (dmactions_types.SIG, dmactions_types.BASE, dmactions_types.OUT):
+            DMFileSet.objects.create(type=dmtype, version=settings.RELVERSION)
+        self.result = create_result(self)
+        self.assertEqual(self.result.dmfilestat_set.count(), 3)
+
+    def create_reanalysis(self):
+        # a second result of the same experiment, shares the signal processing files
+        result = Results(resultsName='bar', experiment=self.result.experiment,
+                         processedCycles=0, processedflows=0, framesProcessed=0)
+        result.save()
+        return result
+
+    def files_in_use(self, result, dmtype=None):
+        dmfilestats = DMFileStat.objects.filter(result=result)
+        if dmtype:
+            dmfilestats = dmfilestats.filter(dmfileset__type=dmtype)
+        return sorted(set(dmfilestats.values_list('files_in_use', flat=True)))
+
+
+class GetCandidatesTest(DMFileStatTestCase):
+
+    def candidates(self, dmtype, action=dmactions.ARCHIVE, threshdate=None, limit=10):
+        dmfilestats = DMFileStat.objects.filter(dmfileset__type=dmtype).order_by('pk')
+        return get_candidates(dmfilestats, action, threshdate or timezone.now(), limit)
+
+    def test_candidate(self):
+        selected = self.candidates(dmactions_types.OUT)
+        self.assertEqual([dmfilestat.result_id for dmfilestat in selected], [self.result.pk])
+
+    def test_limit(self):
+        self.create_reanalysis()
+        self.create_reanalysis()
+        self.assertEqual(len(self.candidates(dmactions_types.OUT, limit=2)), 2)
+
+    def test_files_in_use(self):
+        DMFileStat.objects.filter(result=self.result).update(files_in_use='plugins running')
+        self.assertRaises(DMExceptions.NoDMFileStat, self.candidates, dmactions_types.OUT)
+
+    def test_preserve_data(self):
+        DMFileStat.objects.filter(result=self.result).update(preserve_data=True)
+        self.assertRaises(DMExceptions.NoDMFileStat, self.candidates, dmactions_types.OUT)
+        # signal processing files are kept by the experiment
+        self.assertEqual(len(self.candidates(dmactions_types.SIG)), 1)
+
+    def test_signal_processing_keep(self):
+        experiment = self.result.experiment
+        experiment.storage_options = 'KI'
+        experiment.save()
+        self.assertRaises(DMExceptions.NoDMFileStat, self.candidates, dmactions_types.SIG)
+        self.assertEqual(len(self.candidates(dmactions_types.OUT)), 1)
+
+    def test_skips_unavailable(self):
+        reanalysis = self.create_reanalysis()
+        DMFileStat.objects.filter(result=self.result).update(files_in_use='plugins running')
+        selected = self.candidates(dmactions_types.OUT, limit=1)
+        self.assertEqual([dmfilestat.result_id for dmfilestat in selected], [reanalysis.pk])
+
+    def test_delete_expired_basecalling_input(self):
+        threshdate = timezone.now() + timedelta(days=1)
+        selected = self.candidates(dmactions_types.BASE, dmactions.DELETE, threshdate)
+        self.assertEqual(len(selected), 1)
+        self.assertTrue(selected[0].allow_delete)
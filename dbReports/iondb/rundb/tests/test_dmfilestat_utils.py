@@ -0,0 +1,60 @@
+# Copyright (C) 2014 Ion Torrent Systems, Inc. All Rights Reserved
+from django.contrib.auth.models import User
+from django.utils import timezone
+from iondb.rundb.models import Plugin, PluginResult
+from iondb.rundb.data import dmactions_types
+from iondb.rundb.data.dmfilestat_utils import set_files_in_use, release_files_in_use, \
+    ANALYSIS_IN_USE, PLUGINS_IN_USE
+from iondb.rundb.tests.test_data_management import DMFileStatTestCase
+
+
+class FilesInUseTest(DMFileStatTestCase):
+
+    def start_plugin(self, result):
+        plugin = Plugin.objects.create(name='testplugin', version='1.0')
+        return PluginResult.objects.create(plugin=plugin, result=result, owner=User.objects.get(username='ionadmin'),
+                                           state='Started', starttime=timezone.now(), store={})
+
+    def test_plugins(self):
+        msg = PLUGINS_IN_USE % (self.result.resultsName, self.result.pk)
+        set_files_in_use([self.result.pk])
+        self.assertEqual(self.files_in_use(self.result), [msg])
+        release_files_in_use([self.result.pk])
+        self.assertEqual(self.files_in_use(self.result), [''])
+
+    def test_plugins_still_running(self):
+        set_files_in_use([self.result.pk])
+        self.start_plugin(self.result)
+        release_files_in_use([self.result.pk])
+        self.assertEqual(self.files_in_use(self.result), [PLUGINS_IN_USE % (self.result.resultsName, self.result.pk)])
+
+    def test_analysis_uses_signal_processing_files(self):
+        reanalysis = self.create_reanalysis()
+        msg = ANALYSIS_IN_USE % (reanalysis.resultsName, reanalysis.pk)
+        set_files_in_use([reanalysis.pk], analysis=True)
+        self.assertEqual(self.files_in_use(reanalysis), [msg])
+        self.assertEqual(self.files_in_use(self.result, dmactions_types.SIG), [msg])
+        self.assertEqual(self.files_in_use(self.result, dmactions_types.OUT), [''])
+        release_files_in_use([reanalysis.pk], analysis=True)
+        self.assertEqual(self.files_in_use(reanalysis), [''])
+        self.assertEqual(self.files_in_use(self.result), [''])
+
+    def test_analysis_over_plugins(self):
+        set_files_in_use([self.result.pk])
+        set_files_in_use([self.result.pk], analysis=True)
+        self.assertEqual(self.files_in_use(self.result), [ANALYSIS_IN_USE % (self.result.resultsName, self.result.pk)])
+        # plugins do not replace the analysis message
+        set_files_in_use([self.result.pk])
+        self.assertEqual(self.files_in_use(self.result), [ANALYSIS_IN_USE % (self.result.resultsName, self.result.pk)])
+
+    def test_analysis_end_plugins_running(self):
+        set_files_in_use([self.result.pk], analysis=True)
+        self.start_plugin(self.result)
+        release_files_in_use([self.result.pk], analysis=True)
+        self.assertEqual(self.files_in_use(self.result), [PLUGINS_IN_USE % (self.result.resultsName, self.result.pk)])
+
+    def test_release_other_result(self):
+        reanalysis = self.create_reanalysis()
+        set_files_in_use([self.result.pk])
+        release_files_in_use([reanalysis.pk])
+        self.assertEqual(self.files_in_use(self.result), [PLUGINS_IN_USE % (self.result.resultsName, self.result.pk)])
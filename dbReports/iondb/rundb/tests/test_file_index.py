@@ -0,0 +1,142 @@
+# Copyright (C) 2014 Ion Torrent Systems, Inc. All Rights Reserved
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from iondb.rundb.data import file_index
+
+
+class FileIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.report = os.path.join(self.tempdir, 'report')
+        os.makedirs(os.path.join(self.report, 'basecaller_results'))
+        self.write('basecaller_results/rawlib.bam', 1000)
+        self.write('report.pdf', 100)
+        self.mtime = int(time.time()) - 100
+        self.age()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def path(self, name):
+        return os.path.join(self.report, name)
+
+    def write(self, name, size, mode='w'):
+        with open(self.path(name), mode) as f:
+            f.write('x' * size)
+
+    def age(self):
+        # directories changed within MTIME_GRANULARITY are always listed, move them into the past
+        for root, dirs, files in os.walk(self.report):
+            os.utime(root, (self.mtime, self.mtime))
+
+    def index(self):
+        return dict((row[0], row) for row in file_index.get_file_index([self.report], list_dir=self.report, save_list=True))
+
+    def test_index_file_kept_in_report(self):
+        files = self.index()
+        self.assertTrue(os.path.exists(self.path(file_index.INDEX_FILENAME)))
+        self.assertEqual(sorted(files.keys()), [self.path('basecaller_results/rawlib.bam'), self.path('report.pdf')])
+
+    def test_unchanged_directory_not_listed(self):
+        self.index()
+        self.write('basecaller_results/new.bam', 10)
+        self.age()
+        self.assertNotIn(self.path('basecaller_results/new.bam'), self.index())
+
+    def test_changed_directory_listed(self):
+        self.index()
+        self.write('basecaller_results/new.bam', 10)
+        os.utime(self.path('basecaller_results'), (self.mtime + 50, self.mtime + 50))
+        files = self.index()
+        self.assertIn(self.path('basecaller_results/new.bam'), files)
+        self.assertEqual(files[self.path('basecaller_results/new.bam')][1], 10)
+
+    def test_rewrite_in_place(self):
+        self.index()
+        self.write('basecaller_results/rawlib.bam', 5000, mode='a')
+        self.age()
+        self.assertEqual(self.index()[self.path('basecaller_results/rawlib.bam')][1], 6000)
+
+    def test_deleted_file(self):
+        self.index()
+        os.unlink(self.path('report.pdf'))
+        self.assertNotIn(self.path('report.pdf'), self.index())
+
+    def test_deleted_file_unchanged_directory(self):
+        self.index()
+        os.unlink(self.path('report.pdf'))
+        self.age()
+        self.assertNotIn(self.path('report.pdf'), self.index())
+
+    def test_deleted_directory(self):
+        self.index()
+        shutil.rmtree(self.path('basecaller_results'))
+        self.assertEqual(self.index().keys(), [self.path('report.pdf')])
+
+    def test_hard_links_counted_once(self):
+        os.link(self.path('basecaller_results/rawlib.bam'), self.path('rawlib.bam'))
+        files = self.index()
+        self.assertEqual(len(files), 3)
+        size, inodes = file_index.disk_usage(files.values())
+        self.assertEqual(inodes, 2)
+        self.assertEqual(file_index.cached_tree_usage(self.report), (size, inodes))
+
+    def test_cached_tree_usage_follows_changes(self):
+        before, inodes = file_index.cached_tree_usage(self.report)
+        self.write('basecaller_results/rawlib.bam', 100000, mode='a')
+        self.age()
+        after, inodes_after = file_index.cached_tree_usage(self.report)
+        self.assertTrue(after > before)
+        self.assertEqual(inodes_after, inodes)
+
+
+class DirectoryUsageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.trees = [os.path.join(self.tempdir, name) for name in ('report_1', 'report_2')]
+        for tree in self.trees:
+            os.makedirs(os.path.join(tree, 'plugin_out'))
+            with open(os.path.join(tree, 'plugin_out', 'results.json'), 'w') as f:
+                f.write('x' * 10000)
+        self.mtime = int(time.time()) - 100
+        for root, dirs, files in os.walk(self.tempdir):
+            os.utime(root, (self.mtime, self.mtime))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def refresh(self, rescan=()):
+        usage = file_index.open_directory_usage(self.tempdir)
+        try:
+            return usage.refresh(self.trees, rescan)
+        finally:
+            usage.close()
+
+    def test_usage_per_tree(self):
+        usage = self.refresh()
+        self.assertEqual(sorted(usage.keys()), self.trees)
+        self.assertEqual(usage[self.trees[0]][1], 1)
+        self.assertTrue(usage[self.trees[0]][0] > 0)
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, file_index.USAGE_FILENAME)))
+
+    def test_removed_tree(self):
+        self.refresh()
+        shutil.rmtree(self.trees[1])
+        self.assertEqual(self.refresh().keys(), [self.trees[0]])
+
+    def test_rescan_unchanged_directory(self):
+        self.refresh()
+        path = os.path.join(self.trees[0], 'plugin_out')
+        with open(os.path.join(path, 'results.json'), 'a') as f:
+            f.write('x' * 100000)
+        os.utime(path, (self.mtime, self.mtime))
+        before = self.refresh()
+        after = self.refresh(rescan=[self.trees[0]])
+        self.assertTrue(after[self.trees[0]][0] > before[self.trees[0]][0])
+        self.assertEqual(after[self.trees[1]], before[self.trees[1]])
@@ -0,0 +1,134 @@
+# Copyright (C) 2014 Ion Torrent Systems, Inc. All Rights Reserved
+import unittest
+
+from iondb.utils import gridstatus
+
+QSTAT_XML = '''<?xml version='1.0'?>
+<job_info  xmlns:xsd="http://gridengine.sunsource.net/source/browse/*checkout*/gridengine/source/dist/util/resources/schemas/qstat/qstat.xsd?revision=1.11">
+  <queue_info>
+    <job_list state="running">
+      <JB_job_number>101</JB_job_number>
+      <JB_name>analysis</JB_name>
+      <state>r</state>
+      <queue_name>all.q@ts</queue_name>
+      <slots>1</slots>
+    </job_list>
+    <job_list state="running">
+      <JB_job_number>102</JB_job_number>
+      <JB_name>block</JB_name>
+      <state>r</state>
+      <slots>1</slots>
+      <tasks>3</tasks>
+    </job_list>
+    <job_list state="running">
+      <JB_job_number>103</JB_job_number>
+      <state>dr</state>
+    </job_list>
+  </queue_info>
+  <job_info>
+    <job_list state="pending">
+      <JB_job_number>104</JB_job_number>
+      <state>qw</state>
+    </job_list>
+    <job_list state="pending">
+      <JB_job_number>105</JB_job_number>
+      <state>hqw</state>
+    </job_list>
+    <job_list state="pending">
+      <JB_job_number>106</JB_job_number>
+      <state>Eqw</state>
+    </job_list>
+    <job_list state="pending">
+      <JB_job_number>107</JB_job_number>
+      <state>qw</state>
+      <tasks>1-10:1</tasks>
+    </job_list>
+  </job_info>
+</job_info>
+'''
+
+
+class ParseQstatTest(unittest.TestCase):
+
+    def test_drmaa_state(self):
+        self.assertEqual(gridstatus.drmaa_state('r'), 'running')
+        self.assertEqual(gridstatus.drmaa_state('t'), 'running')
+        self.assertEqual(gridstatus.drmaa_state('qw'), 'queued_active')
+        self.assertEqual(gridstatus.drmaa_state('hqw'), 'user_on_hold')
+        self.assertEqual(gridstatus.drmaa_state('s'), 'user_suspended')
+        self.assertEqual(gridstatus.drmaa_state('S'), 'system_suspended')
+        self.assertEqual(gridstatus.drmaa_state('dr'), None)
+        self.assertEqual(gridstatus.drmaa_state('Eqw'), None)
+
+    def test_parse_qstat_xml(self):
+        states = gridstatus.parse_qstat_xml(QSTAT_XML)
+        self.assertEqual(states, {
+            '101': 'running',
+            '102': 'running',
+            '102.3': 'running',
+            '104': 'queued_active',
+            '105': 'user_on_hold',
+            '107': 'queued_active',
+        })
+
+    def test_parse_empty(self):
+        self.assertEqual(gridstatus.parse_qstat_xml('<job_info><queue_info/><job_info/></job_info>'), {})
+
+
+class JobStatusCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshots = 0
+        self.queued = {'1': 'running', '2': 'queued_active'}
+        self.asked = []
+        self.drmaa = {'3': 'done', '4': 'failed', '5': 'running'}
+
+    def snapshot(self):
+        self.snapshots += 1
+        return dict(self.queued)
+
+    def jobstatus(self, jobid):
+        self.asked.append(jobid)
+        return self.drmaa[jobid]
+
+    def test_snapshot_reused(self):
+        cache = gridstatus.JobStatusCache(self.jobstatus, refresh_interval=60, snapshot=self.snapshot)
+        self.assertEqual(cache.status_many([1, 2]), ['running', 'queued_active'])
+        self.assertEqual(cache.status('1'), 'running')
+        self.assertEqual(self.snapshots, 1)
+        self.assertEqual(self.asked, [])
+
+    def test_snapshot_refreshed(self):
+        cache = gridstatus.JobStatusCache(self.jobstatus, refresh_interval=-1, snapshot=self.snapshot)
+        self.assertEqual(cache.status('2'), 'queued_active')
+        self.queued['2'] = 'running'
+        self.assertEqual(cache.status('2'), 'running')
+        self.assertEqual(self.snapshots, 2)
+
+    def test_ended_jobs_asked_once(self):
+        cache = gridstatus.JobStatusCache(self.jobstatus, refresh_interval=-1, snapshot=self.snapshot)
+        self.assertEqual(cache.status_many(['1', '3', '4']), ['running', 'done', 'failed'])
+        self.assertEqual(cache.status_many(['1', '3', '4']), ['running', 'done', 'failed'])
+        self.assertEqual(self.asked, ['3', '4'])
+
+    def test_missing_running_job_asked_again(self):
+        # submitted after the snapshot was taken, its state may still change
+        cache = gridstatus.JobStatusCache(self.jobstatus, refresh_interval=60, snapshot=self.snapshot)
+        self.assertEqual(cache.status('5'), 'running')
+        self.drmaa['5'] = 'done'
+        self.assertEqual(cache.status('5'), 'done')
+        self.assertEqual(self.asked, ['5', '5'])
+
+    def test_ended_jobs_expire(self):
+        cache = gridstatus.JobStatusCache(self.jobstatus, refresh_interval=-1, snapshot=self.snapshot)
+        cache.KEEP_ENDED = -1
+        cache.status('3')
+        cache.status('3')
+        self.assertEqual(self.asked, ['3', '3'])
+
+    def test_failed_snapshot(self):
+        def snapshot():
+            raise RuntimeError("qstat failed")
+        cache = gridstatus.JobStatusCache(self.jobstatus, refresh_interval=60, snapshot=snapshot)
+        self.assertEqual(cache.status('5'), 'running')
+        self.assertEqual(self.asked, ['5'])
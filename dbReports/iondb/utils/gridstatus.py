@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# Copyright (C) 2014 Ion Torrent Systems, Inc. All Rights Reserved
+
+"""
+Grid job status table shared by the job server and the plugin daemon.
+
+Asking DRMAA for the status of every job on every request costs one round trip
+to the SGE qmaster per job. ``JobStatusCache`` instead takes one ``qstat -xml``
+snapshot of all queued and running jobs per ``refresh_interval`` and answers
+status requests from it. Jobs which are not in the snapshot have either ended
+or were submitted after it was taken; only those are asked from DRMAA, and
+final states are remembered, so every job costs at most one DRMAA call.
+
+States are reported with the python-drmaa ``JobState`` names.
+"""
+
+import subprocess
+import threading
+import time
+import logging
+from xml.etree import ElementTree
+
+logger = logging.getLogger(__name__)
+
+ENDED_STATES = ('done', 'failed')
+
+
+def drmaa_state(qstat_state):
+    """Translate a qstat state code (qw, hqw, r, t, s, ...) into a python-drmaa JobState,
+    None where qstat alone is not conclusive (deletion, error)"""
+    if 'd' in qstat_state or 'E' in qstat_state:
+        return None
+    if 's' in qstat_state:
+        return 'user_suspended'
+    if 'S' in qstat_state or 'T' in qstat_state:
+        return 'system_suspended'
+    if 'r' in qstat_state or 't' in qstat_state or 'R' in qstat_state:
+        return 'running'
+    if 'h' in qstat_state:
+        return 'user_on_hold'
+    if 'q' in qstat_state or 'w' in qstat_state:
+        return 'queued_active'
+    return None
+
+
+def parse_qstat_xml(xml):
+    """Returns a dict jobid:state for the job_list entries of qstat -xml output"""
+    states = {}
+    root = ElementTree.fromstring(xml)
+    for job in root.getiterator('job_list'):
+        jobid = job.findtext('JB_job_number')
+        state = drmaa_state(job.findtext('state') or '')
+        if not jobid or state is None:
+            continue
+        states[jobid] = state
+        # array job tasks are reported as jobid.taskid by DRMAA
+        tasks = job.findtext('tasks')
+        if tasks and tasks.isdigit():
+            states['%s.%s' % (jobid, tasks)] = state
+    return states
+
+
+def qstat_snapshot():
+    cmd = ['qstat', '-xml', '-u', '*']
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError("%s failed: %s" % (' '.join(cmd), stderr.strip()))
+    return parse_qstat_xml(stdout)
+
+
+class JobStatusCache(object):
+
+    # ended jobs are remembered this long
+    KEEP_ENDED = 60 * 60
+
+    def __init__(self, jobstatus, refresh_interval=5, snapshot=qstat_snapshot):
+        """``jobstatus(jobid)`` is the DRMAA status call used for jobs missing from the snapshot"""
+        self.jobstatus = jobstatus
+        self.refresh_interval = refresh_interval
+        self.snapshot = snapshot
+        self.lock = threading.Lock()
+        self.states = {}
+        self.snapshot_time = 0
+        # jobid -> (state, time ended)
+        self.ended = {}
+
+    def refresh(self):
+        try:
+            states = self.snapshot()
+        except Exception as err:
+            logger.warning("Job status snapshot failed, using DRMAA: %s" % err)
+            states = {}
+        self.states = states
+        self.snapshot_time = time.time()
+        expired = self.snapshot_time - self.KEEP_ENDED
+        for jobid in [jobid for jobid, (state, t) in self.ended.items() if t < expired]:
+            del self.ended[jobid]
+
+    def status_many(self, jobids):
+        """Returns the states of jobids, in the same order.
+        May run qstat and DRMAA calls, twisted servers call it with deferToThread."""
+        with self.lock:
+            if time.time() - self.snapshot_time > self.refresh_interval:
+                self.refresh()
+            ret = []
+            for jobid in jobids:
+                jobid = str(jobid)
+                if jobid in self.states:
+                    ret.append(self.states[jobid])
+                elif jobid in self.ended:
+                    ret.append(self.ended[jobid][0])
+                else:
+                    state = self.jobstatus(jobid)
+                    if state in ENDED_STATES:
+                        self.ended[jobid] = (state, time.time())
+                    ret.append(state)
+            return ret
+
+    def status(self, jobid):
+        return self.status_many([jobid])[0]
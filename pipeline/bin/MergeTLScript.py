@@ -14,6 +14,7 @@ import math
 import re
 
 from ion.utils import blockprocessing
+from ion.utils import blockmerge
 from ion.utils import explogparser
 from ion.utils import sigproc
 from ion.utils import basecaller
@@ -37,6 +38,7 @@ if __name__=="__main__":
     parser.add_argument('-b', '--do-basecalling', dest='do_basecalling', action='store_true', help='base calling')
     parser.add_argument('-a', '--do-alignment', dest='do_alignment', action='store_true', help='alignment')
     parser.add_argument('-z', '--do-zipping', dest='do_zipping', action='store_true', help='zipping')
+    parser.add_argument('-w', '--wait-for-blocks', dest='wait_for_blocks', action='store_true', help='start block merges as blocks finish, when not submitted with a hold on the block jobs')
 
     args = parser.parse_args()
 
@@ -115,43 +117,74 @@ if __name__=="__main__":
         elif chipType.startswith('P1.0.19'):
             exclusionMaskFile = 'exclusionMask_P1_0_19.txt'
 
-        sigproc.mergeSigProcResults(
+        # the bead mask merge and the composite return code run side by side,
+        # the heatmap follows the merged mask
+        merge_graph = blockmerge.MergeGraph(block_timeout=60*60)
+        analysis_done = None
+        if args.wait_for_blocks:
+            analysis_done = lambda: all(blockmerge.block_finished(blockdir, ['Analysis']) for blockdir in dirs)
+        sigproc.add_sigproc_merge(
+            merge_graph,
             dirs,
             env['SIGPROC_RESULTS'],
             env['shortRunName'],
-            exclusionMaskFile)
+            exclusionMaskFile,
+            ready=analysis_done)
+
+        if not merge_graph.run():
+            printtime("ERROR: Merge Heatmaps failed")
 
 
     if args.do_basecalling:
 
         set_result_status('Merge Basecaller Results')
 
-        try:
-            sigproc.mergeAvgNukeTraces(dirs, env['SIGPROC_RESULTS'], env['libraryKey'], 'Library Beads')
-        except:
-            printtime("Warning: mergeAvgNukeTraces '%s' 'Library Beads' failed" % env['libraryKey'])
+        # All basecalling merges are independent of each other except for the unfiltered BAMs,
+        # which need the merged datasets_basecaller.json. With --wait-for-blocks the block
+        # reductions start as soon as a block reports its basecaller status.
+        merge_graph = blockmerge.MergeGraph(block_timeout=60*60)
+        basecaller_done = None
+        all_basecaller_done = None
+        if args.wait_for_blocks:
+            basecaller_done = lambda blockdir: blockmerge.block_finished(blockdir, ['Basecaller', 'Pre Basecalling Step'])
+            all_basecaller_done = lambda: all(basecaller_done(blockdir) for blockdir in dirs)
+
+        merge_graph.add_reduction(
+            sigproc.avg_nuke_trace_reduction(env['SIGPROC_RESULTS'], env['libraryKey'], 'Library Beads'),
+            dirs, ready=basecaller_done)
+        merge_graph.add_reduction(
+            sigproc.avg_nuke_trace_reduction(env['SIGPROC_RESULTS'], env['tfKey'], 'Test Fragment Beads'),
+            dirs, ready=basecaller_done)
+
+        # plots whichever of the two traces was written
+        merge_graph.add_task('raw_data_traces', sigproc.generate_raw_data_traces,
+            (env['libraryKey'], env['tfKey'], env['flowOrder'], env['SIGPROC_RESULTS']),
+            after=['avgNukeTrace_%s' % env['libraryKey'], 'avgNukeTrace_%s' % env['tfKey']])
+
+        # Only merge standard json files
+        basecaller_stats_tasks = basecaller.add_basecaller_stats_merge(
+            merge_graph, dirs, env['BASECALLER_RESULTS'], ready=basecaller_done)
+
+        RECALIBRATION_RESULTS = os.path.join(env['BASECALLER_RESULTS'],"recalibration")
+        if not os.path.isdir(RECALIBRATION_RESULTS):
+            os.makedirs(RECALIBRATION_RESULTS)
+        # these read the files of every block, they start once all blocks have finished
+        merge_graph.add_task('hpmodel_merge', basecaller.merge_hpmodels, ready=all_basecaller_done)
+        merge_graph.add_task('rawtf_bam', basecaller.merge_rawtf_bams,
+            (dirs, env['BASECALLER_RESULTS']), ready=all_basecaller_done)
 
-        try:
-            sigproc.mergeAvgNukeTraces(dirs, env['SIGPROC_RESULTS'], env['tfKey'], 'Test Fragment Beads')
-        except:
-            printtime("Warning: mergeAvgNukeTraces '%s' 'Test Fragment Beads' failed" % env['tfKey'])
-
-        try:
-            sigproc.generate_raw_data_traces(
-                env['libraryKey'],
-                env['tfKey'],
-                env['flowOrder'],
-                env['SIGPROC_RESULTS'])
-        except:
-            traceback.print_exc()
-
-        try:
-            # Only merge standard json files
-            basecaller.merge_basecaller_stats(
-                dirs,
-                env['BASECALLER_RESULTS'])
-        except:
-            traceback.print_exc()
+        if do_unfiltered_processing:
+            for unfiltered_directory in ['unfiltered.untrimmed', 'unfiltered.trimmed']:
+                unfiltered_directory = os.path.join(env['BASECALLER_RESULTS'],unfiltered_directory)
+                if not os.path.isdir(unfiltered_directory):
+                    os.mkdir(unfiltered_directory)
+                datasets_task = merge_graph.add_reduction(
+                    basecaller.datasets_basecaller_reduction(dirs, unfiltered_directory), dirs, ready=basecaller_done)
+                merge_graph.add_task(unfiltered_directory, basecaller.merge_unfiltered_bams,
+                    (dirs, env['BASECALLER_RESULTS'], unfiltered_directory, 'picard'),
+                    depends=basecaller_stats_tasks + [datasets_task.name])
+
+        if not merge_graph.run():
             printtime("ERROR: Merge Basecaller Results failed")
 
         try:
@@ -162,70 +195,6 @@ if __name__=="__main__":
             traceback.print_exc()
             raise
 
-        basecaller_datasets = blockprocessing.get_datasets_basecaller(env['BASECALLER_RESULTS'])
-
-
-        try:
-            RECALIBRATION_RESULTS = os.path.join(env['BASECALLER_RESULTS'],"recalibration")
-            if not os.path.isdir(RECALIBRATION_RESULTS):
-                os.makedirs(RECALIBRATION_RESULTS)            
-            cmd = "calibrate --hpmodelMerge"
-            printtime("DEBUG: Calling '%s':" % cmd)
-            ret = subprocess.call(cmd,shell=True)
-        except:
-            traceback.print_exc()
-            printtime("ERROR: Merge Basecaller Results failed")
-
-
-        try:
-            graph_max_x = int(50 * math.ceil(0.014 * int(env['flows'])))
-        except:
-            traceback.print_exc()
-            graph_max_x = 400
-
-        try:
-            printtime("INFO: merging rawtf.basecaller.bam")
-            block_bam_list = [os.path.join(adir, env['BASECALLER_RESULTS'], 'rawtf.basecaller.bam') for adir in dirs]
-            block_bam_list = [block_bam_filename for block_bam_filename in block_bam_list if os.path.exists(block_bam_filename)]
-            composite_bam_filename = os.path.join(env['BASECALLER_RESULTS'], 'rawtf.basecaller.bam')
-            if block_bam_list:
-                blockprocessing.merge_bam_files(block_bam_list,composite_bam_filename,composite_bai_filepath="",mark_duplicates=False,method='picard')
-        except:
-            print traceback.format_exc()
-            printtime("ERROR: merging rawtf.basecaller.bam unsuccessful")
-
-        if do_unfiltered_processing:
-            try:
-                os.mkdir(os.path.join(env['BASECALLER_RESULTS'],'unfiltered.untrimmed'))
-
-                basecaller.merge_datasets_basecaller_json(
-                    dirs,
-                    os.path.join(env['BASECALLER_RESULTS'],"unfiltered.untrimmed"))
-
-                basecaller.merge_bams(
-                    dirs,
-                    os.path.join(env['BASECALLER_RESULTS'],"unfiltered.untrimmed"),
-                    basecaller_datasets,
-                    'picard')
-            except:
-                print traceback.format_exc()
-
-
-            try:
-                os.mkdir(os.path.join(env['BASECALLER_RESULTS'],'unfiltered.trimmed'))
-
-                basecaller.merge_datasets_basecaller_json(
-                    dirs,
-                    os.path.join(env['BASECALLER_RESULTS'],"unfiltered.trimmed"))
-
-                basecaller.merge_bams(
-                    dirs,
-                    os.path.join(env['BASECALLER_RESULTS'],"unfiltered.trimmed"),
-                    basecaller_datasets,
-                    'picard')
-            except:
-                print traceback.format_exc()
-
 
     if args.do_alignment:
         # at least one barcode has a reference
@@ -1,22 +1,58 @@
 # Copyright (C) 2012 Ion Torrent Systems, Inc. All Rights Reserved
 
 import argparse
-import subprocess
-from subprocess import CalledProcessError
 import sys
-import pylab
 import numpy
-import math
 import os
 
 import ConfigParser
-import io
-
-
-def merge(folder, infile, out_list, verbose, offset_str):
-
-    infile = os.path.join(folder,infile)
 
+# rows formatted per write, bounds the size of the text buffer
+WRITE_CHUNK_ROWS = 1000000
+
+
+def load_mask(filename):
+    """Read a bead mask, text ("W H" line followed by one "row col [...]" line per bead)
+    or binary (.npy, same layout). Returns width, height and an int32 array with
+    one row per bead."""
+    if filename.endswith('.npy'):
+        data = numpy.load(filename)
+        return int(data[0,0]), int(data[0,1]), data[1:]
+
+    with open(filename, 'r') as f:
+        header = f.readline()
+        while header.startswith('#'):
+            header = f.readline()
+        text = f.read()
+    width, height = [int(v) for v in header.split()[:2]]
+    if '#' in text:
+        text = '\n'.join(line for line in text.splitlines() if not line.startswith('#'))
+    first_line = text.lstrip().split('\n', 1)[0]
+    columns = len(first_line.split()) or 2
+    data = numpy.fromstring(text, dtype=numpy.int32, sep=' ')
+    return width, height, data.reshape((-1, columns))
+
+
+def save_mask(filename, width, height, beads):
+    """Write a bead mask in the format load_mask() reads, binary if filename ends with .npy"""
+    beads = numpy.asarray(beads, dtype=numpy.int32)
+    if beads.ndim != 2:
+        beads = beads.reshape((-1, 2))
+    if filename.endswith('.npy'):
+        header = numpy.zeros((1, beads.shape[1]), dtype=numpy.int32)
+        header[0,:2] = (width, height)
+        numpy.save(filename, numpy.vstack((header, beads)))
+        return
+
+    with open(filename, 'w') as f:
+        f.write("%d %d\n" % (width, height))
+        row_format = ' '.join(['%d'] * beads.shape[1]) + '\n'
+        for start in range(0, len(beads), WRITE_CHUNK_ROWS):
+            chunk = beads[start:start+WRITE_CHUNK_ROWS]
+            f.write((row_format * len(chunk)) % tuple(chunk.ravel().tolist()))
+
+
+def block_offset(folder, offset_str):
     config = ConfigParser.RawConfigParser()
     config.read(os.path.join(folder, 'processParameters.txt'))
     if offset_str == "use_blocks":
@@ -28,32 +64,32 @@ def merge(folder, infile, out_list, verbose, offset_str):
         sys.exit(1)
 
     offset = size.split(',')
-    offsetx = int(offset[0])
-    offsety = int(offset[1])
+    return int(offset[0]), int(offset[1])
 
-    if verbose:
-        print "MaskMerge: Reading "+str(infile)
 
-    beadlist = numpy.loadtxt(infile, dtype='int', comments='#')
+def merge(folder, infile, out_list, verbose, offset_str):
+    """Append the beads of one block, translated to chip coordinates, to out_list"""
 
+    infile = os.path.join(folder,infile)
+    offsetx, offsety = block_offset(folder, offset_str)
 
-    # ignore block length
-    WIDTH=int(beadlist[0,0])
-    HEIGHT=int(beadlist[0,1])
+    if verbose:
+        print "MaskMerge: Reading "+str(infile)
+
+    WIDTH, HEIGHT, beads = load_mask(infile)
     if verbose:
         print "MaskMerge: block size:", WIDTH, HEIGHT
 
-    # add offset to current block data, ignore first column which contains the block size
-    beadlist[1:,0]+=offsety
-    beadlist[1:,1]+=offsetx
+    # add offset to current block data, first column is the row (y)
+    beads[:,0] += offsety
+    beads[:,1] += offsetx
 
     if verbose:
         print "MaskMerge: Append block with offsets x: "+str(offsetx)+" y: "+str(offsety)
 
-    # remove first element, extend list
-    l = beadlist.tolist()
-    del l[0]
-    out_list.extend(l)
+    out_list.append(beads)
+    return beads
+
 
 def main_merge(inputfile, blockfolder, outputfile, verbose, offset_str):
 
@@ -63,47 +99,40 @@ def main_merge(inputfile, blockfolder, outputfile, verbose, offset_str):
         print "MaskMerge: in:",inputfile
         print "MaskMerge: out:",outputfile
 
-    out_list = list()
-
-    # add block data to outputfile
-    for i,folder in enumerate(blockfolder):
-
-        if i==0:
+    config = ConfigParser.RawConfigParser()
+    config.read(os.path.join(blockfolder[0], 'processParameters.txt'))
+    chip = config.get('global', 'Chip')
+    size = chip.split(',')
+    sizex = int(size[0])
+    sizey = int(size[1])
 
-            config = ConfigParser.RawConfigParser()
-            config.read(os.path.join(folder, 'processParameters.txt'))
-            chip = config.get('global', 'Chip')
-            size = chip.split(',')
-            sizex = size[0]
-            sizey = size[1]
+    if verbose:
+        print "MaskMerge: chip size:",sizex,sizey
 
-            if verbose:
-                print "MaskMerge: chip size:",sizex,sizey
- 
-            if verbose:
-                print "MaskMerge: write header"
-            # open to write file size
-            f = open(outputfile, 'w')
-            f.write(sizex+" "+sizey+"\n")
-            f.close()
+    block_list = []
+    for folder in blockfolder:
+        merge(folder,inputfile,block_list,verbose,offset_str)
 
-        merge(folder,inputfile,out_list,verbose,offset_str)
+    # one preallocated array for all blocks
+    columns = max([block.shape[1] for block in block_list] or [2])
+    outdata = numpy.zeros((sum(len(block) for block in block_list), columns), dtype=numpy.int32)
+    start = 0
+    for block in block_list:
+        outdata[start:start+len(block),:block.shape[1]] = block
+        start += len(block)
+    del block_list
 
     if verbose:
         print "MaskMerge: write",outputfile
 
-    # append data
-    f_handle = file(outputfile, 'a')
-    outdata = numpy.array(out_list)
-    numpy.savetxt(f_handle, outdata, fmt='%1.1i')
-    f_handle.close()
+    save_mask(outputfile, sizex, sizey, outdata)
 
 if __name__=="__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', dest='verbose', action='store_true')
-    parser.add_argument('-i', dest='inputfile', default='MaskBead.mask', help='mask to be merged')
-    parser.add_argument('-o', dest='outputfile', default='MaskBead.mask', help='mask to be merged')
+    parser.add_argument('-i', dest='inputfile', default='MaskBead.mask', help='mask to be merged, binary if it ends with .npy')
+    parser.add_argument('-o', dest='outputfile', default='MaskBead.mask', help='merged mask, binary if it ends with .npy')
     parser.add_argument('-s', '--offset_str', dest='offset_str', default='use_blocks', help=' offset string')
     parser.add_argument('blockfolder', nargs='+')
 
@@ -34,6 +34,7 @@ from ion.utils import explogparser
 from ion.utils import sigproc
 from ion.utils import basecaller
 from ion.utils import alignment
+from ion.utils import filewatch
 from ion.utils.file_exists import file_exists
 from ion.utils.compress import make_zip
 from ion.utils.blockprocessing import printtime
@@ -197,6 +198,24 @@ def spawn_cluster_job(rpath, scriptname, args, holds=None):
     return jobid
 
 
+JOB_ENDED = ('done', 'failed', 'DRMAA BUG')
+
+def wait_for_jobs(jobids, timeout):
+    '''Block until at least one of the jobs has ended, at most timeout seconds.
+    Returns a dict jobid:status of the jobs which have ended.'''
+    try:
+        return jobserver.waitjobs(jobids, timeout)
+    except xmlrpclib.Fault:
+        # job server without waitjobs, poll the status of all jobs at once
+        time.sleep(min(timeout, 10))
+    try:
+        statuses = jobserver.jobstatus_many(jobids)
+    except xmlrpclib.Fault:
+        # older job server, poll the jobs one by one
+        statuses = [jobserver.jobstatus(jobid) for jobid in jobids]
+    return dict((jobid, status) for jobid, status in zip(jobids, statuses) if status in JOB_ENDED)
+
+
 if __name__=="__main__":
 
     blockprocessing.printheader()
@@ -468,45 +487,39 @@ if __name__=="__main__":
 
         plugins_params['block_dirs'] = [os.path.join(env['report_root_dir'],result_dirs[block['id_str']]) for block in blocks_to_process]
 
-        while len(blocks_to_process) > 0 and timeout > 0:
+        # file which signals that a block is ready to be processed
+        def block_data_file(block):
+            if doSigproc:
+                if is_single:
+                    return os.path.join(env['pathToRaw'],'acq_0000.dat')
+                elif is_thumbnail:
+                    return os.path.join(env['pathToRaw'],'..',block['id_str'],'acq_0000.dat') # TODO
+                else: # is_composite
+                    return os.path.join(env['pathToRaw'],block['id_str'],'acq_0000.dat')
+            else:
+                if is_composite:
+                    # look for all analysis_return_code.txt files, this is the last file beeing transfered
+                    return os.path.join(env['SIGPROC_RESULTS'],'block_'+block['id_str'],'analysis_return_code.txt')
+                else: # is_thumbnail or is_single:
+                    return os.path.join(env['SIGPROC_RESULTS'],'analysis_return_code.txt')
+
+        block_watcher = filewatch.FileWatcher([block_data_file(block) for block in blocks_to_process])
+        deadline = time.time() + timeout
+
+        while len(blocks_to_process) > 0 and time.time() < deadline:
 
             printtime('waiting for %s block(s) to schedule' % str(len(blocks_to_process)))
             sys.stdout.flush()
             sys.stderr.flush()
 
-            # wait 10 sec before looking for new files
-            timeout -= 10
-            time.sleep (10)
+            # returns as soon as new block files show up
+            ready_files = block_watcher.wait(deadline - time.time())
 
-            blocks_to_process_ready = []
-            if doSigproc:
+            blocks_to_process_ready = [block for block in blocks_to_process if block_data_file(block) in ready_files]
+            if debug_mode:
                 for block in blocks_to_process:
-                    if is_single:
-                        data_file = os.path.join(env['pathToRaw'],'acq_0000.dat')
-                    elif is_thumbnail:
-                        data_file = os.path.join(env['pathToRaw'],'..',block['id_str'],'acq_0000.dat') # TODO
-                    else: # is_composite
-                        data_file = os.path.join(env['pathToRaw'],block['id_str'],'acq_0000.dat')
-
-                    if os.path.exists(data_file):
-                        blocks_to_process_ready.append(block)
-                    else:
-                        if debug_mode:
-                            printtime("missing %s" % data_file)
-
-            else:
-                for block in blocks_to_process:
-                    if is_composite:
-                        # look for all analysis_return_code.txt files, this is the last file beeing transfered
-                        data_file = os.path.join(env['SIGPROC_RESULTS'],'block_'+block['id_str'],'analysis_return_code.txt')
-                    else: # is_thumbnail or is_single:
-                        data_file = os.path.join(env['SIGPROC_RESULTS'],'analysis_return_code.txt')
-
-                    if os.path.exists(data_file):
-                        blocks_to_process_ready.append(block)
-                    else:
-                        if debug_mode:
-                            printtime("missing %s" % data_file)
+                    if block not in blocks_to_process_ready:
+                        printtime("missing %s" % block_data_file(block))
 
             printtime('try to schedule %s new block(s)' % str(len(blocks_to_process_ready)))
 
@@ -533,6 +546,8 @@ if __name__=="__main__":
 
                 blocks_to_process.remove(block)
 
+        block_watcher.close()
+
         if is_composite:
             merge_job_dict['basecalling'] = spawn_cluster_job('.','MergeTLScript.py',['--do-basecalling'],block_job_dict.values())
             printtime("Submitted merge basecalling job with job ID (%s)" % (str(merge_job_dict['basecalling'])))
@@ -571,52 +586,54 @@ if __name__=="__main__":
         pl_started = False
         block_job_list = block_job_dict.values()
         while len(block_job_list) > 0:
-            for job in block_job_list:
-                block = [block for block in blocks if block['jobid'] == job][0]
-                #check status of jobid
-                try:
-                    block['status'] = jobserver.jobstatus(block['jobid'])
-                except:
-                    traceback.print_exc()
+            # wake up early to launch SEPARATOR plugins once separator.mask.bin exists
+            try:
+                ended = wait_for_jobs(block_job_list, 60 if pl_started else 10)
+            except:
+                traceback.print_exc()
+                ended = {}
+                time.sleep(10)
+
+            done_blocks = []
+            for job, status in ended.items():
+                if job not in block_job_list:
                     continue
+                block = [block for block in blocks if str(block['jobid']) == job][0]
+                block['status'] = status
 
                 if blocklevel_plugins and (block['status']=='done'):
-                    plugins_params['blockId'] = block['id_str']
-                    plugins = blockprocessing.runplugins(plugins, env, RunLevel.BLOCK, plugins_params)
+                    done_blocks.append(block['id_str'])
+
+                printtime("Job %s has ended with status %s" % (str(block['jobid']),block['status']))
+                block_job_list.remove(job)
 
-                if block['status']=='done' or block['status']=='failed' or block['status']=="DRMAA BUG":
-                    printtime("Job %s has ended with status %s" % (str(block['jobid']),block['status']))
-                    block_job_list.remove(block['jobid'])
-#                else:
-#                    printtime("Job %s has status %s" % (str(block['jobid']),block['status']))
+            if done_blocks:
+                # blocks ended since the last check are launched together
+                plugins_params['blockIds'] = done_blocks
+                plugins = blockprocessing.runplugins(plugins, env, RunLevel.BLOCK, plugins_params)
 
             if os.path.exists(os.path.join(env['SIGPROC_RESULTS'],'separator.mask.bin')) and not pl_started:
                 plugins = blockprocessing.runplugins(plugins, env, RunLevel.SEPARATOR, plugins_params)
                 pl_started = True
 
+            if ended:
+                printtime("waiting for %d blocks to be finished" % len(block_job_list))
 
-            printtime("waiting for %d blocks to be finished" % len(block_job_list))
-            time.sleep (10)
-
-        merge_job_list = merge_job_dict.keys()
-        while len(merge_job_list) > 0:
-            for key in merge_job_list:
-
-                #check status of jobid
-                try:
-                    jid = merge_job_dict[key]
-                    merge_status = jobserver.jobstatus(jid)
-                except:
-                    traceback.print_exc()
-                    continue
+        merge_jobs = dict((str(jid), key) for key, jid in merge_job_dict.items())
+        while len(merge_jobs) > 0:
+            try:
+                ended = wait_for_jobs(merge_jobs.keys(), 60)
+            except:
+                traceback.print_exc()
+                ended = {}
+                time.sleep(10)
 
-                if merge_status=='done' or merge_status=='failed' or merge_status=="DRMAA BUG":
-                    printtime("Job %s, %s has ended with status %s" % (key,jid,merge_status))
-                    merge_job_list.remove(key)
-                    break
+            for jid, merge_status in ended.items():
+                if jid in merge_jobs:
+                    printtime("Job %s, %s has ended with status %s" % (merge_jobs.pop(jid),jid,merge_status))
 
-            printtime("waiting for %d merge jobs to be finished" % len(merge_job_list))
-            time.sleep (10)
+            if ended:
+                printtime("waiting for %d merge jobs to be finished" % len(merge_jobs))
 
 
     printtime("All jobs processed")
@@ -14,13 +14,15 @@ import matplotlib.cm as cm
 import Image
 import ConfigParser
 import argparse
-import struct
 import numpy
 import math
 import scipy.ndimage
 import scipy.misc
 import scipy.signal
 
+from ion.reports import MaskMerge
+from ion.utils import bfmask
+
 
 # This array is convolved with the bead data in bfmask.bin to compute a sum in the range [0-100] of a 10x10 well area.
 array_ten_by_ten =  numpy.ones((10,10), dtype=numpy.int16)
@@ -55,6 +57,11 @@ def reasonable_shrink(scores, bound=1000, threshold=2000):
 def makeContourMap(arr, HEIGHT, WIDTH, outputId, maskId, plt_title, average, outputdir, barcodeId=-1, vmaxVal=100):
     scores = calculate_scores(arr)
     del arr
+    makeDensityPlots(scores, HEIGHT, WIDTH, outputId, maskId, plt_title, average, outputdir, barcodeId, vmaxVal)
+
+
+def makeDensityPlots(scores, HEIGHT, WIDTH, outputId, maskId, plt_title, average, outputdir, barcodeId=-1, vmaxVal=100):
+    """Contour, raw and full bleed plots of a loading density map in percent"""
     scores = reasonable_shrink(scores)
     makeContourPlot(scores, average, HEIGHT, WIDTH, outputId, maskId, plt_title, outputdir, barcodeId, vmaxVal)
     pil_transposed_scores =numpy.flipud(scores)
@@ -153,15 +160,11 @@ def makeContourPlot(scores, average, HEIGHT, WIDTH, outputId, maskId, plt_title,
 
 def extractMaskInfo(filename):
     """Read bfmask.bin and return an array of wells, value 1 for those with
-    beads and 0 for empty wells.
+    beads and 0 for empty wells. Use bfmask.binned_density() for loading maps,
+    it does not hold the full chip in memory.
     """
-    with open(filename, 'rb') as f:
-        h, w = struct.unpack_from('ii', f.read(8))
-        wells_data = numpy.fromfile(f, dtype=numpy.int16, count=-1)
-    ree = numpy.reshape(wells_data, (h, w))
-    del wells_data
     # The second bit is a flag indicating loading
-    ree &= 2
+    ree = bfmask.open_mask(filename) & bfmask.MASK_BEAD
     # Shift to 1 for a loaded well and 0 for an empty well
     ree >>= 1
     return ree
@@ -169,32 +172,69 @@ def extractMaskInfo(filename):
 
 def makeBarcodeArr(qBcId, row, col, bcIds, HEIGHT, WIDTH):
     # TODO: x/y are reversed from what is typical
-    #print "makeBarcodeArr", qBcId, row, col, bcIds, HEIGHT, WIDTH
-    counts = 0
+    # full resolution array of one barcode, plots use makeBarcodeDensityMaps
+    selected = (numpy.asarray(bcIds) == qBcId)
     arr = numpy.zeros((HEIGHT,WIDTH))
-    for i in range(len(row)):
-        if qBcId == bcIds[i]:
-            arr[row[i], col[i]] = 1
-            counts += 1
-    return arr, counts
+    arr[numpy.asarray(row)[selected], numpy.asarray(col)[selected]] = 1
+    return arr, int(selected.sum())
+
+
+def makeBarcodeDensityMaps(row, col, bcIds, HEIGHT, WIDTH, bin_size=None):
+    """Loading density of every barcode in one bincount pass.
+
+    Wells are binned in bin_size x bin_size squares, by default the 10x10 area of
+    calculate_scores() or larger so that no side exceeds 1000 bins.
+    Returns the sorted barcode ids, an array (barcodes, rows, cols) with the
+    percentage of loaded wells per bin and the number of beads per barcode.
+    """
+    if bin_size is None:
+        bin_size = max(10, int(math.ceil(max(HEIGHT, WIDTH) / 1000.0)))
+    rows = int(math.ceil(HEIGHT / float(bin_size)))
+    cols = int(math.ceil(WIDTH / float(bin_size)))
+
+    barcode_ids, bc_index = numpy.unique(numpy.asarray(bcIds), return_inverse=True)
+    index = bc_index.astype(numpy.int64) * (rows * cols)
+    index += (numpy.asarray(row) // bin_size) * cols
+    index += numpy.asarray(col) // bin_size
+    counts = numpy.bincount(index, minlength=len(barcode_ids) * rows * cols)
+    del index
+    maps = counts.reshape((len(barcode_ids), rows, cols)).astype(numpy.float32)
+    bead_counts = maps.sum(axis=2).sum(axis=1).astype(numpy.int64)
+
+    # percentage of the wells in each bin, bins on the chip edge are smaller
+    bin_rows = numpy.minimum(bin_size, HEIGHT - numpy.arange(rows) * bin_size)
+    bin_cols = numpy.minimum(bin_size, WIDTH - numpy.arange(cols) * bin_size)
+    maps *= 100.0 / numpy.outer(bin_rows, bin_cols)
+    return barcode_ids, maps, bead_counts
 
 
 def extractBarcodeMaskInfo(filePath):
     INPUTFILE=filePath
     print "Reading", INPUTFILE
-    beadlist = numpy.loadtxt(INPUTFILE,dtype='int',comments='#')
-    WIDTH=int(beadlist[0,0])
-    HEIGHT=int(beadlist[0,1])
-    bcbead_row = (beadlist[1:,0])  #really y, but is first column
-    bcbead_col = (beadlist[1:,1])  #really x, but is the second column
-    bcbead_bcIds = (beadlist[1:,2])
-    
-    unique_barcodeIds = dict.fromkeys(bcbead_bcIds).keys();
+    WIDTH, HEIGHT, beadlist = MaskMerge.load_mask(INPUTFILE)
+    bcbead_row = (beadlist[:,0])  #really y, but is first column
+    bcbead_col = (beadlist[:,1])  #really x, but is the second column
+    bcbead_bcIds = (beadlist[:,2])
+
+    unique_barcodeIds = numpy.unique(bcbead_bcIds).tolist()
     print "Unique barcode ids found: ", unique_barcodeIds
-    
+
     return unique_barcodeIds, HEIGHT, WIDTH, bcbead_row, bcbead_col, bcbead_bcIds
 
 
+def genBarcodeHeatmaps(filePath, outputdir, plot_title):
+    """Loading density plots per barcode from a barcode mask (row, col, barcode id per bead),
+    text or binary, see MaskMerge.load_mask. All maps come from one makeBarcodeDensityMaps pass
+    instead of a makeBarcodeArr array per barcode."""
+    unique_barcodeIds, HEIGHT, WIDTH, row, col, bcIds = extractBarcodeMaskInfo(filePath)
+    barcode_ids, maps, bead_counts = makeBarcodeDensityMaps(row, col, bcIds, HEIGHT, WIDTH)
+    del row, col, bcIds
+    for barcodeId, scores, counts in zip(barcode_ids, maps, bead_counts):
+        average = 100.0 * counts / (HEIGHT * WIDTH)
+        makeDensityPlots(scores, HEIGHT, WIDTH, "Barcode%d" % barcodeId, "", plot_title, average,
+                         outputdir, barcodeId, autoGetVmaxFromAverage(average))
+
+
 def genHeatmap(filePath, bfmaskstatspath, outputdir, plot_title):
     #
     #Called from TLScript.py
@@ -210,12 +250,13 @@ def genHeatmap(filePath, bfmaskstatspath, outputdir, plot_title):
 
     print total_wells, excluded_wells, bead_wells, average
 
-    beadarr = extractMaskInfo(filePath)
-    HEIGHT, WIDTH = beadarr.shape
+    # 10x10 well bins computed from the memory-mapped mask, tile by tile
+    HEIGHT, WIDTH = bfmask.read_shape(filePath)
+    scores = bfmask.binned_density(filePath)
     # The fact that these are fixed is a clue that we might be able to remove them
     outputId = "Bead"
     maskId = ""
-    makeContourMap(beadarr, HEIGHT, WIDTH, outputId, maskId, plot_title, average, outputdir)
+    makeDensityPlots(scores, HEIGHT, WIDTH, outputId, maskId, plot_title, average, outputdir)
 
 
 #MaskBead.mask contains all well coordinations with Beads (Bead Wells = NUMBER), see bfmask.stats
@@ -226,6 +267,9 @@ if __name__=="__main__":
     parser.add_argument('maskfile', default='bfmask.bin', help='e.g. bfmask.bin')
     parser.add_argument('bfmask', default='bfmask.stats', help='e.g. bfmask.stats')
     parser.add_argument('plt_title', default='title', help='e.g. FOZ-223')
+    parser.add_argument('-b', dest='barcodemask', help='barcode mask (row col barcode id per bead), also plot each barcode')
     args = parser.parse_args()
 
     genHeatmap(args.maskfile, args.bfmask, "./", args.plt_title)
+    if args.barcodemask:
+        genBarcodeHeatmaps(args.barcodemask, "./", args.plt_title)
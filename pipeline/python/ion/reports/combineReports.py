@@ -69,17 +69,17 @@ def wait_on_jobs(jobIds, jobName, status = "Processing", max_running_jobs = 0):
     # wait for job to finish
     while len(jobIds) > max_running_jobs:
         printtime("waiting for %s job(s) to finish ..." % jobName)
-        for jobid in jobIds:
-            try:
-                jobstatus = jobserver.jobstatus(jobid)
-            except:
-                traceback.print_exc()
-                continue
-                
+        try:
+            statuses = jobserver.jobstatus_many(jobIds)
+        except:
+            traceback.print_exc()
+            statuses = []
+
+        for jobid, jobstatus in zip(list(jobIds), statuses):
             if jobstatus=='done' or jobstatus=='failed' or jobstatus=="DRMAA BUG":
                 printtime("DEBUG: Job %s has ended with status %s" % (str(jobid),jobstatus))
                 jobIds.remove(jobid)
-                
+
         time.sleep(20)
 
 
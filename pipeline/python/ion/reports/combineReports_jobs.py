@@ -11,6 +11,7 @@ import re
 
 from ion.utils.blockprocessing import printtime
 from ion.utils.compress import make_zip
+from ion.utils import bamheader
 os.environ['MPLCONFIGDIR'] = '/tmp'
 from ion.utils import ionstats_plots
 
@@ -20,21 +21,9 @@ def merge_bam_files(bamfilelist, composite_bam_filepath, mark_duplicates, new_sa
     composite_header_filepath = composite_bam_filepath + '.header.sam'
     
     try:
-        # generate file headers and merge them using picard tools
-        for bamfile in bamfilelist:
-            cmd = 'samtools view -H %s > %s.header.sam' % (bamfile,bamfile,)
-            printtime("DEBUG: Calling '%s'" % cmd)
-            subprocess.call(cmd,shell=True)
-
-        cmd = 'java -Xmx8g -jar /opt/picard/picard-tools-current/MergeSamFiles.jar'
-        for bamfile in bamfilelist:
-            cmd = cmd + ' I=%s.header.sam' % bamfile
-        cmd = cmd + ' O=%s' % composite_header_filepath
-        cmd = cmd + ' VERBOSITY=WARNING' # suppress INFO on stderr
-        cmd = cmd + ' QUIET=true' # suppress job-summary on stderr
-        cmd = cmd + ' VALIDATION_STRINGENCY=SILENT'
-        printtime("DEBUG: Calling '%s'" % cmd)
-        subprocess.call(cmd,shell=True)
+        # read file headers and merge them
+        printtime("DEBUG: merging %d BAM headers into %s" % (len(bamfilelist), composite_header_filepath))
+        bamheader.merge_bam_headers(bamfilelist, composite_header_filepath)
 
         # overwrite sample names in header SM tag
         if new_sample_name:
@@ -5,236 +5,273 @@ import os
 import json
 import traceback
 import copy
+import numpy
 
-# BeadSummary section will be eventually obsoleted
-def merge_bead_summary(block_dirs):
-    print 'mergeBaseCallerJson.merge_bead_summary on %s blocks' % len(block_dirs)
-    
-    bs_lib = {'badKey':0,'highPPF':0,'highRes':0,'polyclonal':0,'short':0,'valid':0,'zero':0,'key':'TCAG'}
-    bs_tf =  {'badKey':0,'highPPF':0,'highRes':0,'polyclonal':0,'short':0,'valid':0,'zero':0,'key':'ATCG'}
-    for dir in block_dirs:
-        try:
-            file = open(os.path.join(dir,'BaseCaller.json'), 'r')
-            block_json = json.load(file)
-            file.close()
-
-            bs_lib['badKey']     += block_json['BeadSummary']['lib']['badKey']
-            bs_lib['highPPF']    += block_json['BeadSummary']['lib']['highPPF']
-            bs_lib['highRes']    += block_json['BeadSummary']['lib']['highRes']
-            bs_lib['polyclonal'] += block_json['BeadSummary']['lib']['polyclonal']
-            bs_lib['short']      += block_json['BeadSummary']['lib']['short']
-            bs_lib['valid']      += block_json['BeadSummary']['lib']['valid']
-            bs_lib['zero']       += block_json['BeadSummary']['lib']['zero']
-            #bs_lib['key']         = block_json['BeadSummary']['lib']['key']
-            
-            bs_tf['badKey']      += block_json['BeadSummary']['tf']['badKey']
-            bs_tf['highPPF']     += block_json['BeadSummary']['tf']['highPPF']
-            bs_tf['highRes']     += block_json['BeadSummary']['tf']['highRes']
-            bs_tf['polyclonal']  += block_json['BeadSummary']['tf']['polyclonal']
-            bs_tf['short']       += block_json['BeadSummary']['tf']['short']
-            bs_tf['valid']       += block_json['BeadSummary']['tf']['valid']
-            bs_tf['zero']        += block_json['BeadSummary']['tf']['zero']
-            #bs_tf['key']          = block_json['BeadSummary']['tf']['key']
-        except:
-            traceback.print_exc()
-            print 'mergeBaseCallerJson.merge_bead_summary: skipping block ' + dir
-    
-    return {"lib":bs_lib,"tf":bs_tf}    
+BEAD_SUMMARY_FIELDS = ['badKey','highPPF','highRes','polyclonal','short','valid','zero']
+BASE_DETAILS_FIELDS = ['adapter_trim','beverly_filter','failed_keypass','final',
+                       'high_residual','initial','quality_trim','short']
+LIBRARY_REPORT_FIELDS = ["filtered_low_quality","filtered_polyclonal","filtered_primer_dimer","final_library_reads"]
+READ_DETAILS_FIELDS = ["adapter_trim","beverly_filter","bkgmodel_high_ppf","bkgmodel_keypass",
+                       "bkgmodel_polyclonal","failed_keypass","high_ppf","high_residual",
+                       "polyclonal","quality_trim","short","valid","zero"]
+QV_HISTOGRAM_LENGTH = 50
 
 
+def _field_vector(section, fields):
+    return numpy.array([section.get(field,0) for field in fields])
 
 
-def merge_filtering(block_dirs):
-    
-    # BaseDetails
-    bd = {'adapter_trim':0,'beverly_filter':0,'failed_keypass':0,'final':0,
-          'high_residual':0,'initial':0,'quality_trim':0,'short':0}
-    # LibraryReport
-    lr = {"filtered_low_quality":0,"filtered_polyclonal":0,"filtered_primer_dimer":0,"final_library_reads":0}
-    # ReadDetails/lib
-    rd_lib = {"adapter_trim":0,"beverly_filter":0,"bkgmodel_high_ppf":0,"bkgmodel_keypass":0,
-              "bkgmodel_polyclonal":0,"failed_keypass":0,"high_ppf":0,"high_residual":0,
-              "key":"TCAG","polyclonal":0,"quality_trim":0,"short":0,"valid":0,"zero":0}
-    # ReadDetails/tf
-    rd_tf = {"adapter_trim":0,"beverly_filter":0,"bkgmodel_high_ppf":0,"bkgmodel_keypass":0,
-              "bkgmodel_polyclonal":0,"failed_keypass":0,"high_ppf":0,"high_residual":0,
-              "key":"ATCG","polyclonal":0,"quality_trim":0,"short":0,"valid":0,"zero":0}
-    # Bead Adapters
-    adapters = {}
-    
-    qv_hist = [0] * 50
-    
-    for dir in block_dirs:
-        try:
-            file = open(os.path.join(dir,'BaseCaller.json'), 'r')
-            block_json = json.load(file)
-            file.close()
-            
-            # Merging adapter classification part of Basecaller.json
-            adapter_idx = 0
-            while ('Adapter_'+str(adapter_idx)) in block_json['Filtering'].get('BeadAdapters',{}):
-                if ('Adapter_'+str(adapter_idx)) in adapters:
-                    adapters['Adapter_'+str(adapter_idx)]['read_count'] += block_json['Filtering']['BeadAdapters']['Adapter_'+str(adapter_idx)].get('read_count',0)
-                    adapters['Adapter_'+str(adapter_idx)]['num_decisions'] += block_json['Filtering']['BeadAdapters']['Adapter_'+str(adapter_idx)].get('num_decisions',0)
-                    adapters['Adapter_'+str(adapter_idx)]['average_metric'] += block_json['Filtering']['BeadAdapters']['Adapter_'+str(adapter_idx)].get('read_count',0) * block_json['Filtering']['BeadAdapters']['Adapter_'+str(adapter_idx)].get('average_metric',0)
-                    adapters['Adapter_'+str(adapter_idx)]['average_separation'] += block_json['Filtering']['BeadAdapters']['Adapter_'+str(adapter_idx)].get('num_decisions',0) * block_json['Filtering']['BeadAdapters']['Adapter_'+str(adapter_idx)].get('average_separation',0)
-                else:
-                    adapters['Adapter_'+str(adapter_idx)] = copy.deepcopy(block_json['Filtering']['BeadAdapters']['Adapter_'+str(adapter_idx)])
-                    adapters['Adapter_'+str(adapter_idx)]['average_metric'] *= block_json['Filtering']['BeadAdapters']['Adapter_'+str(adapter_idx)]['read_count']
-                    adapters['Adapter_'+str(adapter_idx)]['average_separation'] *= block_json['Filtering']['BeadAdapters']['Adapter_'+str(adapter_idx)]['num_decisions']
-                adapter_idx +=1 
-
-            bd['adapter_trim']   += block_json['Filtering'].get('BaseDetails',{}).get('adapter_trim',0)
-            bd['beverly_filter'] += block_json['Filtering'].get('BaseDetails',{}).get('beverly_filter',0)
-            bd['failed_keypass'] += block_json['Filtering'].get('BaseDetails',{}).get('failed_keypass',0)
-            bd['final']          += block_json['Filtering'].get('BaseDetails',{}).get('final',0)
-            bd['high_residual']  += block_json['Filtering'].get('BaseDetails',{}).get('high_residual',0)
-            bd['initial']        += block_json['Filtering'].get('BaseDetails',{}).get('initial',0)
-            bd['quality_trim']   += block_json['Filtering'].get('BaseDetails',{}).get('quality_trim',0)
-            bd['short']          += block_json['Filtering'].get('BaseDetails',{}).get('short',0)
-            
-            lr['filtered_low_quality']  += block_json['Filtering'].get('LibraryReport',{}).get('filtered_low_quality',0)
-            lr['filtered_polyclonal']   += block_json['Filtering'].get('LibraryReport',{}).get('filtered_polyclonal',0)
-            lr['filtered_primer_dimer'] += block_json['Filtering'].get('LibraryReport',{}).get('filtered_primer_dimer',0)
-            lr['final_library_reads']   += block_json['Filtering'].get('LibraryReport',{}).get('final_library_reads',0)
-            
-            rd_lib['adapter_trim']        += block_json['Filtering'].get('ReadDetails',{}).get('lib',{}).get('adapter_trim',0)
-            rd_lib['beverly_filter']      += block_json['Filtering'].get('ReadDetails',{}).get('lib',{}).get('beverly_filter',0)
-            rd_lib['bkgmodel_high_ppf']   += block_json['Filtering'].get('ReadDetails',{}).get('lib',{}).get('bkgmodel_high_ppf',0)
-            rd_lib['bkgmodel_keypass']    += block_json['Filtering'].get('ReadDetails',{}).get('lib',{}).get('bkgmodel_keypass',0)
-            rd_lib['bkgmodel_polyclonal'] += block_json['Filtering'].get('ReadDetails',{}).get('lib',{}).get('bkgmodel_polyclonal',0)
-            rd_lib['failed_keypass']      += block_json['Filtering'].get('ReadDetails',{}).get('lib',{}).get('failed_keypass',0)
-            rd_lib['high_ppf']            += block_json['Filtering'].get('ReadDetails',{}).get('lib',{}).get('high_ppf',0)
-            rd_lib['high_residual']       += block_json['Filtering'].get('ReadDetails',{}).get('lib',{}).get('high_residual',0)
-            rd_lib['polyclonal']          += block_json['Filtering'].get('ReadDetails',{}).get('lib',{}).get('polyclonal',0)
-            rd_lib['quality_trim']        += block_json['Filtering'].get('ReadDetails',{}).get('lib',{}).get('quality_trim',0)
-            rd_lib['short']               += block_json['Filtering'].get('ReadDetails',{}).get('lib',{}).get('short',0)
-            rd_lib['valid']               += block_json['Filtering'].get('ReadDetails',{}).get('lib',{}).get('valid',0)
-            rd_lib['zero']                += block_json['Filtering'].get('ReadDetails',{}).get('lib',{}).get('zero',0)
-
-            rd_tf['adapter_trim']        += block_json['Filtering'].get('ReadDetails',{}).get('tf',{}).get('adapter_trim',0)
-            rd_tf['beverly_filter']      += block_json['Filtering'].get('ReadDetails',{}).get('tf',{}).get('beverly_filter',0)
-            rd_tf['bkgmodel_high_ppf']   += block_json['Filtering'].get('ReadDetails',{}).get('tf',{}).get('bkgmodel_high_ppf',0)
-            rd_tf['bkgmodel_keypass']    += block_json['Filtering'].get('ReadDetails',{}).get('tf',{}).get('bkgmodel_keypass',0)
-            rd_tf['bkgmodel_polyclonal'] += block_json['Filtering'].get('ReadDetails',{}).get('tf',{}).get('bkgmodel_polyclonal',0)
-            rd_tf['failed_keypass']      += block_json['Filtering'].get('ReadDetails',{}).get('tf',{}).get('failed_keypass',0)
-            rd_tf['high_ppf']            += block_json['Filtering'].get('ReadDetails',{}).get('tf',{}).get('high_ppf',0)
-            rd_tf['high_residual']       += block_json['Filtering'].get('ReadDetails',{}).get('tf',{}).get('high_residual',0)
-            rd_tf['polyclonal']          += block_json['Filtering'].get('ReadDetails',{}).get('tf',{}).get('polyclonal',0)
-            rd_tf['quality_trim']        += block_json['Filtering'].get('ReadDetails',{}).get('tf',{}).get('quality_trim',0)
-            rd_tf['short']               += block_json['Filtering'].get('ReadDetails',{}).get('tf',{}).get('short',0)
-            rd_tf['valid']               += block_json['Filtering'].get('ReadDetails',{}).get('tf',{}).get('valid',0)
-            rd_tf['zero']                += block_json['Filtering'].get('ReadDetails',{}).get('tf',{}).get('zero',0)
-
-            rd_lib['key']                 = block_json['Filtering'].get('ReadDetails',{}).get('lib',{}).get('key',rd_lib['key'])
-            rd_tf['key']                  = block_json['Filtering'].get('ReadDetails',{}).get('tf',{}).get('key',rd_tf['key'])
-            
-            for idx in range(50):
-                qv_hist[idx] += block_json['Filtering']['qv_histogram'][idx]
-            
-        except:
-            print 'mergeBaseCallerJson.merge_filtering: skipping block ' + dir
-    
-    # Now looping through the adapters again to turn averages back into averages
-    adapter_idx = 0
-    while ('Adapter_'+str(adapter_idx)) in adapters:
-        adapters['Adapter_'+str(adapter_idx)]['average_metric'] /= max(adapters['Adapter_'+str(adapter_idx)]['read_count'], 1)
-        adapters['Adapter_'+str(adapter_idx)]['average_separation'] /= max(adapters['Adapter_'+str(adapter_idx)]['num_decisions'], 1)
-        adapter_idx +=1
-    
-    return {"BaseDetails":bd,"BeadAdapters":adapters,"LibraryReport":lr,'ReadDetails':{'lib':rd_lib,'tf':rd_tf},'qv_histogram':qv_hist}
+def _field_dict(vector, fields):
+    return dict(zip(fields, vector.tolist()))
 
 
+def load_block(block_dir):
+    '''Reads BaseCaller.json of one block into a partial result for BaseCallerJsonReducer.
+    Sections which cannot be read are None and are skipped when folding.'''
 
+    partial = {'block_dir':block_dir, 'BeadSummary':None, 'Filtering':None, 'Phasing':None}
+    try:
+        file = open(os.path.join(block_dir,'BaseCaller.json'), 'r')
+        block_json = json.load(file)
+        file.close()
+    except:
+        traceback.print_exc()
+        print 'mergeBaseCallerJson.load_block: skipping block ' + block_dir
+        return partial
+
+    # BeadSummary section will be eventually obsoleted
+    try:
+        partial['BeadSummary'] = numpy.concatenate([
+            numpy.array([block_json['BeadSummary']['lib'][field] for field in BEAD_SUMMARY_FIELDS]),
+            numpy.array([block_json['BeadSummary']['tf'][field] for field in BEAD_SUMMARY_FIELDS])])
+    except:
+        traceback.print_exc()
+        print 'mergeBaseCallerJson.merge_bead_summary: skipping block ' + block_dir
+
+    try:
+        filtering = block_json['Filtering']
+        read_details = filtering.get('ReadDetails',{})
+        adapters = {}
+        adapter_idx = 0
+        while ('Adapter_'+str(adapter_idx)) in filtering.get('BeadAdapters',{}):
+            adapter = copy.deepcopy(filtering['BeadAdapters']['Adapter_'+str(adapter_idx)])
+            adapter['read_count'] = adapter.get('read_count',0)
+            adapter['num_decisions'] = adapter.get('num_decisions',0)
+            # averages are carried as sums weighted by read count and number of decisions
+            adapter['average_metric'] = adapter['read_count'] * adapter.get('average_metric',0)
+            adapter['average_separation'] = adapter['num_decisions'] * adapter.get('average_separation',0)
+            adapters['Adapter_'+str(adapter_idx)] = adapter
+            adapter_idx +=1
+
+        partial['Filtering'] = {
+            'BaseDetails'   : _field_vector(filtering.get('BaseDetails',{}), BASE_DETAILS_FIELDS),
+            'LibraryReport' : _field_vector(filtering.get('LibraryReport',{}), LIBRARY_REPORT_FIELDS),
+            'lib'           : _field_vector(read_details.get('lib',{}), READ_DETAILS_FIELDS),
+            'tf'            : _field_vector(read_details.get('tf',{}), READ_DETAILS_FIELDS),
+            'lib_key'       : read_details.get('lib',{}).get('key'),
+            'tf_key'        : read_details.get('tf',{}).get('key'),
+            'qv_histogram'  : numpy.array(filtering['qv_histogram'][:QV_HISTOGRAM_LENGTH]),
+            'BeadAdapters'  : adapters,
+        }
+    except:
+        print 'mergeBaseCallerJson.merge_filtering: skipping block ' + block_dir
 
-def merge_phasing(block_dirs):
-    
-    # Phasing
-    ph = {'CF':0,'IE':0,'DR':0,'CFbyRegion':0,'IEbyRegion':0,'DRbyRegion':0,'RegionRows':1,'RegionCols':1}
-    
-    # 1. Determine grid size and translate directory names into coordinates
-    
     try:
-    
-        coord_x = [-1] * len(block_dirs)
-        coord_y = [-1] * len(block_dirs)
-        
-        for idx,dir in enumerate(block_dirs):
-            parts = dir.split('_')
-            if not parts[0] == 'block':
-                continue
-            coord_x[idx] = int(parts[1][1:])
-            coord_y[idx] = int(parts[2][1:])
-        
-        coord_x_to_idx = dict((val,idx) for (idx,val) in enumerate(sorted(list(set(coord_x)))))
-        coord_y_to_idx = dict((val,idx) for (idx,val) in enumerate(sorted(list(set(coord_y)))))
-    
-        region_cols = len(coord_x_to_idx)
-        region_rows = len(coord_y_to_idx)
-        
-        if region_cols == 0 or region_rows == 0:
-            return ph
-    
-        ph['RegionRows'] = region_rows
-        ph['RegionCols'] = region_cols
-        ph['CFbyRegion'] = [0.0] * (region_rows*region_cols)
-        ph['IEbyRegion'] = [0.0] * (region_rows*region_cols)
-        ph['DRbyRegion'] = [0.0] * (region_rows*region_cols)
-        
-        # 2. Populate phasing by region
-        
-        for idx,dir in enumerate(block_dirs):
-            try:
-                file = open(os.path.join(dir,'BaseCaller.json'), 'r')
-                block_json = json.load(file)
-                file.close()
-        
-                my_x = coord_x_to_idx.get(coord_x[idx],-1)
-                my_y = coord_y_to_idx.get(coord_y[idx],-1)
+        partial['Phasing'] = (block_json['Phasing']['CF'], block_json['Phasing']['IE'], block_json['Phasing']['DR'])
+    except:
+        print 'mergeBaseCallerJson.merge_phasing: skipping block ' + block_dir
+
+    return partial
+
+
+class BaseCallerJsonReducer(object):
+    '''Combines BaseCaller.json metrics one block at a time.
+
+    Counters and the qv histogram are kept as numpy vectors, so folding a block is a
+    handful of vector additions. The combined json is generated once by result().
+    '''
+
+    def __init__(self):
+        self.bead_summary = numpy.zeros(2*len(BEAD_SUMMARY_FIELDS), dtype=numpy.int64)
+        self.base_details = numpy.zeros(len(BASE_DETAILS_FIELDS), dtype=numpy.int64)
+        self.library_report = numpy.zeros(len(LIBRARY_REPORT_FIELDS), dtype=numpy.int64)
+        self.read_details_lib = numpy.zeros(len(READ_DETAILS_FIELDS), dtype=numpy.int64)
+        self.read_details_tf = numpy.zeros(len(READ_DETAILS_FIELDS), dtype=numpy.int64)
+        self.qv_histogram = numpy.zeros(QV_HISTOGRAM_LENGTH, dtype=numpy.int64)
+        self.lib_key = 'TCAG'
+        self.tf_key = 'ATCG'
+        self.adapters = {}
+        self.phasing = []
+        self.block_dirs = []
+
+    def add(self, partial):
+        '''Fold the partial result of one block, as returned by load_block()'''
+        self.block_dirs.append(partial['block_dir'])
+
+        if partial['BeadSummary'] is not None:
+            self.bead_summary += partial['BeadSummary']
+
+        filtering = partial['Filtering']
+        if filtering is not None:
+            for name, adapter in filtering['BeadAdapters'].iteritems():
+                if name in self.adapters:
+                    for field in ['read_count','num_decisions','average_metric','average_separation']:
+                        self.adapters[name][field] += adapter[field]
+                else:
+                    self.adapters[name] = copy.deepcopy(adapter)
+            self.base_details += filtering['BaseDetails']
+            self.library_report += filtering['LibraryReport']
+            self.read_details_lib += filtering['lib']
+            self.read_details_tf += filtering['tf']
+            self.qv_histogram[:len(filtering['qv_histogram'])] += filtering['qv_histogram']
+            self.lib_key = filtering['lib_key'] or self.lib_key
+            self.tf_key = filtering['tf_key'] or self.tf_key
+
+        if partial['Phasing'] is not None:
+            self.phasing.append((partial['block_dir'], partial['Phasing']))
+
+    def add_block(self, block_dir):
+        self.add(load_block(block_dir))
+
+    def bead_summary_json(self):
+        n = len(BEAD_SUMMARY_FIELDS)
+        bs_lib = _field_dict(self.bead_summary[:n], BEAD_SUMMARY_FIELDS)
+        bs_tf = _field_dict(self.bead_summary[n:], BEAD_SUMMARY_FIELDS)
+        bs_lib['key'] = 'TCAG'
+        bs_tf['key'] = 'ATCG'
+        return {"lib":bs_lib,"tf":bs_tf}
+
+    def filtering_json(self):
+        # turn weighted sums back into averages
+        adapters = copy.deepcopy(self.adapters)
+        for adapter in adapters.itervalues():
+            adapter['average_metric'] /= max(adapter['read_count'], 1)
+            adapter['average_separation'] /= max(adapter['num_decisions'], 1)
+
+        rd_lib = _field_dict(self.read_details_lib, READ_DETAILS_FIELDS)
+        rd_lib['key'] = self.lib_key
+        rd_tf = _field_dict(self.read_details_tf, READ_DETAILS_FIELDS)
+        rd_tf['key'] = self.tf_key
+
+        return {"BaseDetails"   : _field_dict(self.base_details, BASE_DETAILS_FIELDS),
+                "BeadAdapters"  : adapters,
+                "LibraryReport" : _field_dict(self.library_report, LIBRARY_REPORT_FIELDS),
+                'ReadDetails'   : {'lib':rd_lib,'tf':rd_tf},
+                'qv_histogram'  : self.qv_histogram.tolist()}
+
+    def phasing_json(self):
+
+        # Phasing
+        ph = {'CF':0,'IE':0,'DR':0,'CFbyRegion':0,'IEbyRegion':0,'DRbyRegion':0,'RegionRows':1,'RegionCols':1}
+
+        # 1. Determine grid size and translate directory names into coordinates
+
+        try:
+            coord = {}
+            for dir in self.block_dirs:
+                parts = os.path.basename(os.path.normpath(dir)).split('_')
+                if not parts[0] == 'block':
+                    coord[dir] = (-1,-1)
+                    continue
+                coord[dir] = (int(parts[1][1:]), int(parts[2][1:]))
+
+            coord_x_to_idx = dict((val,idx) for (idx,val) in enumerate(sorted(set(x for x,y in coord.values()))))
+            coord_y_to_idx = dict((val,idx) for (idx,val) in enumerate(sorted(set(y for x,y in coord.values()))))
+
+            region_cols = len(coord_x_to_idx)
+            region_rows = len(coord_y_to_idx)
+
+            if region_cols == 0 or region_rows == 0:
+                return ph
+
+            ph['RegionRows'] = region_rows
+            ph['RegionCols'] = region_cols
+            ph['CFbyRegion'] = [0.0] * (region_rows*region_cols)
+            ph['IEbyRegion'] = [0.0] * (region_rows*region_cols)
+            ph['DRbyRegion'] = [0.0] * (region_rows*region_cols)
+
+            # 2. Populate phasing by region
+
+            for dir,(cf,ie,dr) in self.phasing:
+                my_x = coord_x_to_idx.get(coord[dir][0],-1)
+                my_y = coord_y_to_idx.get(coord[dir][1],-1)
                 my_idx = my_y + my_x * region_rows
                 if my_x < 0 or my_y < 0 or my_idx >= (region_rows*region_cols):
                     continue
-        
-                ph['CFbyRegion'][my_idx] = block_json['Phasing']['CF']
-                ph['IEbyRegion'][my_idx] = block_json['Phasing']['IE']
-                ph['DRbyRegion'][my_idx] = block_json['Phasing']['DR']
-        
-            except:
-                print 'mergeBaseCallerJson.merge_phasing: skipping block ' + dir
-        
-        # 3. Compute average phasing
-        
-        cf = [v for v in ph['CFbyRegion'] if v > 0.0]
-        ie = [v for v in ph['IEbyRegion'] if v > 0.0]
-        dr = [v for v in ph['DRbyRegion'] if v > 0.0]
-        ph['CF'] = sum(cf,0.0) / len(cf)
-        ph['IE'] = sum(ie,0.0) / len(ie)
-        ph['DR'] = sum(dr,0.0) / len(dr)
-        
-    except:
-        pass
-    
-    return ph
+                ph['CFbyRegion'][my_idx] = cf
+                ph['IEbyRegion'][my_idx] = ie
+                ph['DRbyRegion'][my_idx] = dr
+
+            # 3. Compute average phasing
+
+            cf = [v for v in ph['CFbyRegion'] if v > 0.0]
+            ie = [v for v in ph['IEbyRegion'] if v > 0.0]
+            dr = [v for v in ph['DRbyRegion'] if v > 0.0]
+            ph['CF'] = sum(cf,0.0) / len(cf)
+            ph['IE'] = sum(ie,0.0) / len(ie)
+            ph['DR'] = sum(dr,0.0) / len(dr)
+
+        except:
+            pass
+
+        return ph
+
+    def result(self):
+        return {'BeadSummary' : self.bead_summary_json(),
+                'Filtering'   : self.filtering_json(),
+                'Phasing'     : self.phasing_json()}
+
+    def write(self, results_dir):
+        file = open(os.path.join(results_dir,'BaseCaller.json'), 'w')
+        file.write(json.dumps(self.result(),indent=4))
+        file.close()
+
+
+def fold(reducer, partial):
+    '''BlockReduction fold step, reducer is created on the first block'''
+    if reducer is None:
+        reducer = BaseCallerJsonReducer()
+    reducer.add(partial)
+    return reducer
+
+
+def write(reducer, results_dir):
+    '''BlockReduction finish step'''
+    if reducer is None:
+        reducer = BaseCallerJsonReducer()
+    reducer.write(results_dir)
+
+
+def _reduce(block_dirs):
+    reducer = BaseCallerJsonReducer()
+    for dir in block_dirs:
+        reducer.add_block(dir)
+    return reducer
+
+
+def merge_bead_summary(block_dirs):
+    print 'mergeBaseCallerJson.merge_bead_summary on %s blocks' % len(block_dirs)
+    return _reduce(block_dirs).bead_summary_json()
+
+
+def merge_filtering(block_dirs):
+    return _reduce(block_dirs).filtering_json()
+
+
+def merge_phasing(block_dirs):
+    return _reduce(block_dirs).phasing_json()
 
 
 def merge(block_dirs, results_dir):
     '''mergeBaseCallerJson.merge - Combine BaseCaller.json metrics from multiple blocks'''
 
-    combined_json = {'BeadSummary' : merge_bead_summary(block_dirs),
-                     'Filtering'   : merge_filtering(block_dirs),
-                     'Phasing'     : merge_phasing(block_dirs)}
-    
-    file = open(os.path.join(results_dir,'BaseCaller.json'), 'w')
-    file.write(json.dumps(combined_json,indent=4))
-    file.close()
+    print 'mergeBaseCallerJson.merge on %s blocks' % len(block_dirs)
+    _reduce(block_dirs).write(results_dir)
 
 
 if __name__=="__main__":
-    
+
     blockDirs = [name for name in os.listdir('.') if os.path.isdir(name) and name.startswith('block_')]
     resultsDir = '.'
-    
-    merge(blockDirs,resultsDir)
-
-
 
+    merge(blockDirs,resultsDir)
@@ -5,6 +5,7 @@ __version__ = filter(str.isdigit, "$Revision$")
 
 from ion.utils.blockprocessing import printtime
 from ion.utils import blockprocessing
+from ion.utils import blockmerge
 
 import traceback
 import os
@@ -375,16 +376,60 @@ def create_plots(ionstats_filepath,flows):
     ionstats_plots.old_aq_length_histogram(ionstats_filepath,'Filtered_Alignments_Q47.png', 'AQ47', 'purple')
 
 
-def merge_ionstats(dirs, BASECALLER_RESULTS, ALIGNMENT_RESULTS, basecaller_datasets):
+def merge_ionstats_dataset(dirs, ionstats_folder, ionstats_file, file_prefix, ALIGNMENT_RESULTS, reference):
+
+    block_filename_list = [os.path.join(dir,ionstats_folder,file_prefix+'.'+ionstats_file) for dir in dirs]
+    block_filename_list = [filename for filename in block_filename_list if os.path.exists(filename)] # TODO, remove this check and provide list with valid blocks
+    composite_filename = os.path.join(ionstats_folder, file_prefix+'.composite_allblocks_'+ionstats_file)
+    ionstats.reduce_stats(block_filename_list, composite_filename)
+
+    if reference:
+        block_h5_filename_list = [os.path.join(dir,ALIGNMENT_RESULTS,file_prefix+'.ionstats_error_summary.h5') for dir in dirs]
+        block_h5_filename_list = [filename for filename in block_h5_filename_list if os.path.exists(filename)]  # TODO, remove this check and provide list with valid blocks
+        composite_h5_filename = os.path.join(ALIGNMENT_RESULTS, file_prefix+'.ionstats_error_summary.h5')
+        ionstats.reduce_stats_h5(block_h5_filename_list, composite_h5_filename)
+
+
+def merge_ionstats_allblocks(dirs, ALIGNMENT_RESULTS):
+
+    block_filename_list = [os.path.join(dir,ALIGNMENT_RESULTS,'ionstats_alignment.json') for dir in dirs]
+    block_filename_list = [filename for filename in block_filename_list if os.path.exists(filename)]
+    composite_filename = os.path.join(ALIGNMENT_RESULTS, 'composite_allblocks_ionstats_alignment.json')
+    ionstats.reduce_stats(block_filename_list, composite_filename)
+
+    block_h5_filename_list = [os.path.join(dir,ALIGNMENT_RESULTS,'ionstats_error_summary.h5') for dir in dirs]
+    block_h5_filename_list = [filename for filename in block_h5_filename_list if os.path.exists(filename)]
+    composite_filename = os.path.join(ALIGNMENT_RESULTS, 'ionstats_error_summary.h5') # composite_allblocks
+    if len(block_h5_filename_list):
+        ionstats.reduce_stats_h5(block_h5_filename_list, composite_filename)
+
+
+def merge_ionstats_allbarcodes(ALIGNMENT_RESULTS, composite_filename_list, composite_h5_filename_list):
+
+    # DEBUG: this is used to check if merging is commutative, the length check is necessary in case  all datasets are 'filtered' (e.g.)
+    if len(composite_filename_list) > 0:
+        ionstats.reduce_stats(composite_filename_list,os.path.join(ALIGNMENT_RESULTS,'composite_allbarcodes_ionstats_alignment.json'))
+    if len(composite_h5_filename_list) > 0:
+        ionstats.reduce_stats_h5(composite_h5_filename_list,os.path.join(ALIGNMENT_RESULTS,'composite_allbarcodes_ionstats_error_summary.h5'))
+
+
+def merge_ionstats(dirs, BASECALLER_RESULTS, ALIGNMENT_RESULTS, basecaller_datasets, graph=None):
 
     # Merge *ionstats_alignment.json files across blocks
+    # The per-dataset reductions are independent and run concurrently on the merge graph,
+    # pass a graph to add them to an existing merge stage instead of running them here.
 
     # DEBUG: check if merging is commutative
 
     try:
+        run_graph = graph is None
+        if run_graph:
+            graph = blockmerge.MergeGraph()
+
         # DEBUG
         composite_filename_list = []
         composite_h5_filename_list = []
+        dataset_tasks = []
 
         for dataset in basecaller_datasets["datasets"]:
 
@@ -407,36 +452,21 @@ def merge_ionstats(dirs, BASECALLER_RESULTS, ALIGNMENT_RESULTS, basecaller_datas
                 ionstats_folder = BASECALLER_RESULTS
                 ionstats_file = 'ionstats_basecaller.json'
 
-            block_filename_list = [os.path.join(dir,ionstats_folder,dataset['file_prefix']+'.'+ionstats_file) for dir in dirs]
-            block_filename_list = [filename for filename in block_filename_list if os.path.exists(filename)] # TODO, remove this check and provide list with valid blocks
-            composite_filename = os.path.join(ionstats_folder, dataset['file_prefix']+'.composite_allblocks_'+ionstats_file)
-            ionstats.reduce_stats(block_filename_list, composite_filename)
-            composite_filename_list.append(composite_filename)
+            task = graph.add_task('ionstats:%s' % dataset['file_prefix'], merge_ionstats_dataset,
+                (dirs, ionstats_folder, ionstats_file, dataset['file_prefix'], ALIGNMENT_RESULTS, reference))
+            dataset_tasks.append(task.name)
 
+            composite_filename_list.append(os.path.join(ionstats_folder, dataset['file_prefix']+'.composite_allblocks_'+ionstats_file))
             if reference:
-                block_h5_filename_list = [os.path.join(dir,ALIGNMENT_RESULTS,dataset['file_prefix']+'.ionstats_error_summary.h5') for dir in dirs]
-                block_h5_filename_list = [filename for filename in block_h5_filename_list if os.path.exists(filename)]  # TODO, remove this check and provide list with valid blocks
-                composite_h5_filename = os.path.join(ALIGNMENT_RESULTS, dataset['file_prefix']+'.ionstats_error_summary.h5')
-                ionstats.reduce_stats_h5(block_h5_filename_list, composite_h5_filename)
-                composite_h5_filename_list.append(composite_h5_filename)
-
-
-        block_filename_list = [os.path.join(dir,ALIGNMENT_RESULTS,'ionstats_alignment.json') for dir in dirs]
-        block_filename_list = [filename for filename in block_filename_list if os.path.exists(filename)]
-        composite_filename = os.path.join(ALIGNMENT_RESULTS, 'composite_allblocks_ionstats_alignment.json')
-        ionstats.reduce_stats(block_filename_list, composite_filename)
-
-        block_h5_filename_list = [os.path.join(dir,ALIGNMENT_RESULTS,'ionstats_error_summary.h5') for dir in dirs]
-        block_h5_filename_list = [filename for filename in block_h5_filename_list if os.path.exists(filename)]
-        composite_filename = os.path.join(ALIGNMENT_RESULTS, 'ionstats_error_summary.h5') # composite_allblocks
-        if len(block_h5_filename_list):
-            ionstats.reduce_stats_h5(block_h5_filename_list, composite_filename)
-
-        # DEBUG: this is used to check if merging is commutative, the length check is necessary in case  all datasets are 'filtered' (e.g.)
-        if len(composite_filename_list) > 0:
-            ionstats.reduce_stats(composite_filename_list,os.path.join(ALIGNMENT_RESULTS,'composite_allbarcodes_ionstats_alignment.json'))
-        if len(composite_h5_filename_list) > 0:
-            ionstats.reduce_stats_h5(composite_h5_filename_list,os.path.join(ALIGNMENT_RESULTS,'composite_allbarcodes_ionstats_error_summary.h5'))
+                composite_h5_filename_list.append(os.path.join(ALIGNMENT_RESULTS, dataset['file_prefix']+'.ionstats_error_summary.h5'))
+
+        graph.add_task('ionstats:allblocks', merge_ionstats_allblocks, (dirs, ALIGNMENT_RESULTS))
+        graph.add_task('ionstats:allbarcodes', merge_ionstats_allbarcodes,
+            (ALIGNMENT_RESULTS, composite_filename_list, composite_h5_filename_list),
+            depends=dataset_tasks)
+
+        if run_graph:
+            graph.run()
 
     except:
         printtime("ERROR: Failed to merge ionstats_alignment.json")
@@ -444,8 +474,9 @@ def merge_ionstats(dirs, BASECALLER_RESULTS, ALIGNMENT_RESULTS, basecaller_datas
 
 
 
-def merge_bams(dirs, BASECALLER_RESULTS, ALIGNMENT_RESULTS, basecaller_datasets, mark_duplicates):
+def merge_bams(dirs, BASECALLER_RESULTS, ALIGNMENT_RESULTS, basecaller_datasets, mark_duplicates, processes=None):
 
+    merges = []
     for dataset in basecaller_datasets['datasets']:
 
         try:
@@ -469,13 +500,17 @@ def merge_bams(dirs, BASECALLER_RESULTS, ALIGNMENT_RESULTS, basecaller_datasets,
             if block_bam_list:
                 if reference and not filtered:
                     composite_bai_filepath = composite_bam_filepath+'.bai'
-                    blockprocessing.merge_bam_files(block_bam_list, composite_bam_filepath, composite_bai_filepath, mark_duplicates)
+                    merges.append((block_bam_list, composite_bam_filepath, composite_bai_filepath, mark_duplicates, 'samtools'))
                 else:
                     composite_bai_filepath=""
-                    blockprocessing.merge_bam_files(block_bam_list, composite_bam_filepath, composite_bai_filepath, mark_duplicates=False, method='samtools')
+                    merges.append((block_bam_list, composite_bam_filepath, composite_bai_filepath, False, 'samtools'))
 
         except:
             print traceback.format_exc()
             printtime("ERROR: merging %s unsuccessful" % bamfile)
 
+    printtime("Merging BAM files of %d datasets" % len(merges))
+    blockmerge.merge_bam_datasets(merges, processes)
+    printtime("Finished merging BAM files")
+
 
@@ -0,0 +1,197 @@
+#!/usr/bin/python
+# Copyright (C) 2014 Ion Torrent Systems, Inc. All Rights Reserved
+
+'''
+Read and merge BAM file headers without samtools or picard.
+
+A BAM file is a series of BGZF blocks, which are gzip members and can be read with
+the gzip module. The uncompressed stream starts with the binary header:
+magic "BAM\\1", l_text, text, n_ref and n_ref times (l_name, name, l_ref).
+
+merge_headers() follows picard MergeSamFiles (default SORT_ORDER=coordinate):
+@SQ dictionaries must agree, identical @RG and @PG records are kept once, records
+that reuse an ID with different content get the ID suffixed with .1, .2, ...
+@RG and @PG records are ordered by ID and @CO lines are kept once, in input order.
+'''
+
+import struct
+import gzip
+
+BAM_MAGIC = 'BAM\1'
+
+
+class BamHeaderError(Exception):
+    pass
+
+
+def _read_exactly(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise BamHeaderError("truncated BAM header")
+    return data
+
+
+def read_bam_header(bam_filepath):
+    '''Returns the header text and the list of (name, length) reference sequences'''
+    f = gzip.GzipFile(bam_filepath, 'rb')
+    try:
+        if _read_exactly(f, 4) != BAM_MAGIC:
+            raise BamHeaderError("%s is not a BAM file" % bam_filepath)
+        l_text, = struct.unpack('<i', _read_exactly(f, 4))
+        text = _read_exactly(f, l_text).rstrip('\0')
+        n_ref, = struct.unpack('<i', _read_exactly(f, 4))
+        references = []
+        for i in range(n_ref):
+            l_name, = struct.unpack('<i', _read_exactly(f, 4))
+            name = _read_exactly(f, l_name).rstrip('\0')
+            l_ref, = struct.unpack('<i', _read_exactly(f, 4))
+            references.append((name, l_ref))
+    finally:
+        f.close()
+    return text, references
+
+
+class SamHeader(object):
+    '''Header lines split by record type, each record is a list of (tag, value) pairs'''
+
+    def __init__(self):
+        self.hd = []
+        self.sq = []
+        self.rg = []
+        self.pg = []
+        self.co = []
+
+    @classmethod
+    def parse(cls, text, references=()):
+        header = cls()
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            if line.startswith('@CO'):
+                header.co.append(line)
+                continue
+            fields = line.split('\t')
+            record = [tuple(field.split(':', 1)) for field in fields[1:] if ':' in field]
+            if fields[0] == '@HD':
+                header.hd = record
+            elif fields[0] == '@SQ':
+                header.sq.append(record)
+            elif fields[0] == '@RG':
+                header.rg.append(record)
+            elif fields[0] == '@PG':
+                header.pg.append(record)
+        if not header.sq:
+            # text without @SQ lines, fall back to the binary reference list
+            header.sq = [[('SN', name), ('LN', str(length))] for name, length in references]
+        return header
+
+    @classmethod
+    def from_bam(cls, bam_filepath):
+        return cls.parse(*read_bam_header(bam_filepath))
+
+    def text(self):
+        lines = []
+        if self.hd:
+            lines.append(_format('@HD', self.hd))
+        lines.extend(_format('@SQ', record) for record in self.sq)
+        lines.extend(_format('@RG', record) for record in self.rg)
+        lines.extend(_format('@PG', record) for record in self.pg)
+        lines.extend(self.co)
+        return ''.join(line + '\n' for line in lines)
+
+
+def _format(code, record):
+    return '\t'.join([code] + ['%s:%s' % (tag, value) for tag, value in record])
+
+
+def _get(record, tag, default=None):
+    for key, value in record:
+        if key == tag:
+            return value
+    return default
+
+
+def _set(record, tag, value):
+    return [(key, value if key == tag else old) for key, old in record]
+
+
+def _merge_sequences(headers):
+    merged = []
+    lengths = {}
+    for header in headers:
+        for record in header.sq:
+            name = _get(record, 'SN')
+            if name in lengths:
+                if lengths[name] != _get(record, 'LN'):
+                    raise BamHeaderError("sequence %s has conflicting lengths %s and %s" %
+                                         (name, lengths[name], _get(record, 'LN')))
+                continue
+            lengths[name] = _get(record, 'LN')
+            merged.append(record)
+    return merged
+
+
+def _merge_records(records_per_header, update_references=False):
+    '''records_per_header: one list of records per input header.
+    Returns the merged records ordered by ID.'''
+    by_id = {}
+    merged = []
+    for records in records_per_header:
+        def translate(record, translation):
+            record = _set(record, 'ID', translation[_get(record, 'ID')])
+            if update_references and _get(record, 'PP') in translation:
+                record = _set(record, 'PP', translation[_get(record, 'PP')])
+            return record
+
+        # a renamed @PG changes the PP of its children, repeat until the IDs are stable
+        translation = dict((_get(record, 'ID'), _get(record, 'ID')) for record in records)
+        for i in range(len(records) + 1):
+            changed = False
+            for record in records:
+                record_id = _get(record, 'ID')
+                candidate = translate(record, translation)
+                new_id = record_id
+                suffix = 0
+                while new_id in by_id and by_id[new_id] != _set(candidate, 'ID', new_id):
+                    suffix += 1
+                    new_id = '%s.%d' % (record_id, suffix)
+                if translation[record_id] != new_id:
+                    translation[record_id] = new_id
+                    changed = True
+            if not changed:
+                break
+        for record in records:
+            record = translate(record, translation)
+            if _get(record, 'ID') not in by_id:
+                by_id[_get(record, 'ID')] = record
+                merged.append(record)
+    # stable: records with equal ID prefix keep the input order
+    merged.sort(key=lambda record: _get(record, 'ID'))
+    return merged
+
+
+def merge_headers(headers, sort_order='coordinate'):
+    '''Merge a list of SamHeader objects into a new SamHeader'''
+    merged = SamHeader()
+    version = '1.4'
+    for header in headers:
+        if header.hd:
+            version = _get(header.hd, 'VN', version)
+            break
+    merged.hd = [('VN', version), ('SO', sort_order)]
+    merged.sq = _merge_sequences(headers)
+    merged.rg = _merge_records([header.rg for header in headers])
+    merged.pg = _merge_records([header.pg for header in headers], update_references=True)
+    for header in headers:
+        for comment in header.co:
+            if comment not in merged.co:
+                merged.co.append(comment)
+    return merged
+
+
+def merge_bam_headers(bamfilelist, header_filepath, sort_order='coordinate'):
+    '''Write the merged header of all BAM files as SAM text, for samtools merge -h / reheader'''
+    merged = merge_headers([SamHeader.from_bam(bamfile) for bamfile in bamfilelist], sort_order)
+    with open(header_filepath, 'w') as f:
+        f.write(merged.text())
+    return merged
@@ -14,7 +14,7 @@ import dateutil
 from shutil import move
 import math
 import shlex
-import copy
+import numpy
 
 from ion.utils import TFPipeline
 from ion.utils.blockprocessing import isbadblock
@@ -22,6 +22,7 @@ from ion.reports import MaskMerge
 
 from ion.reports import mergeBaseCallerJson
 from ion.utils import blockprocessing
+from ion.utils import blockmerge
 from ion.utils import ionstats
 
 from ion.utils import ionstats_plots
@@ -194,111 +195,237 @@ def merge_barcoded_basecaller_bams(BASECALLER_RESULTS, basecaller_datasets, meth
     printtime("Finished basecaller barcode merging")
 
 
-def merge_datasets_basecaller_json(dirs, BASECALLER_RESULTS):
+BARCODE_ERRORS_HIST_LENGTH = 3
+BARCODE_DISTANCE_HIST_LENGTH = 5
 
-    ########################################################
-    # Merge datasets_basecaller.json                       #
-    ########################################################
-    
-    block_datasets_json = []
-    combined_datasets_json = {}
-    
-    for dir in dirs:
-        current_datasets_path = os.path.join(dir,BASECALLER_RESULTS,'datasets_basecaller.json')
-        try:
-            f = open(current_datasets_path,'r')
-            block_datasets_json.append(json.load(f))
-            f.close()
-        except:
-            printtime("ERROR: skipped %s" % current_datasets_path)
-    
-    if (not block_datasets_json) or ('datasets' not in block_datasets_json[0]) or ('read_groups' not in block_datasets_json[0]):
-        printtime("merge_basecaller_results: no block contained a valid datasets_basecaller.json, aborting")
-        return
 
-    combined_datasets_json = copy.deepcopy(block_datasets_json[0])
-    
-    for dataset_idx in range(len(combined_datasets_json['datasets'])):
-        combined_datasets_json['datasets'][dataset_idx]['read_count'] = 0
-        for current_datasets_json in block_datasets_json:
-            combined_datasets_json['datasets'][dataset_idx]['read_count'] += current_datasets_json['datasets'][dataset_idx].get("read_count",0)
-    
-    for read_group in combined_datasets_json['read_groups'].iterkeys():
-        combined_datasets_json['read_groups'][read_group]['Q20_bases'] = 0
-        combined_datasets_json['read_groups'][read_group]['total_bases'] = 0
-        combined_datasets_json['read_groups'][read_group]['read_count'] = 0
-        combined_datasets_json['read_groups'][read_group]['filtered'] = True if 'barcode_sequence' in combined_datasets_json['read_groups'][read_group] else False
-        if "barcode_sequence" in combined_datasets_json['read_groups'][read_group]:
-            combined_datasets_json['read_groups'][read_group]['barcode_bias'] = [-1]
-            combined_datasets_json['read_groups'][read_group]['barcode_distance_hist'] = [0,0,0,0,0]
-            combined_datasets_json['read_groups'][read_group]['barcode_errors_hist'] = [0,0,0]
-            combined_datasets_json['read_groups'][read_group]['barcode_match_filtered'] = 0
-            combined_datasets_json['read_groups'][read_group]['num_blocks_filtered'] = 0
-                  
-        for current_datasets_json in block_datasets_json:
-            combined_datasets_json['read_groups'][read_group]['Q20_bases'] += current_datasets_json['read_groups'].get(read_group,{}).get("Q20_bases",0)
-            combined_datasets_json['read_groups'][read_group]['total_bases'] += current_datasets_json['read_groups'].get(read_group,{}).get("total_bases",0)
-            combined_datasets_json['read_groups'][read_group]['read_count'] += current_datasets_json['read_groups'].get(read_group,{}).get("read_count",0)
-            combined_datasets_json['read_groups'][read_group]['filtered'] &= current_datasets_json['read_groups'].get(read_group,{}).get("filtered",True)
-            if current_datasets_json['read_groups'].get(read_group,{}).get("filtered",False):
-                combined_datasets_json['read_groups'][read_group]['num_blocks_filtered'] += 1
-            if "barcode_sequence" in combined_datasets_json['read_groups'][read_group]:
-                combined_datasets_json['read_groups'][read_group]['barcode_match_filtered'] += current_datasets_json['read_groups'].get(read_group,{}).get("barcode_match_filtered",0)
-                error_hist = current_datasets_json['read_groups'].get(read_group,{}).get("barcode_errors_hist",[0,0,0])
-                for hist_idx in range(len(error_hist)):
-                    combined_datasets_json['read_groups'][read_group]['barcode_errors_hist'][hist_idx] += error_hist[hist_idx]
-                distance_hist = current_datasets_json['read_groups'].get(read_group,{}).get("barcode_distance_hist",[0,0,0,0,0])
-                for hist_idx in range(len(distance_hist)):
-                    combined_datasets_json['read_groups'][read_group]['barcode_distance_hist'][hist_idx] += distance_hist[hist_idx]
-                barcode_bias = current_datasets_json['read_groups'].get(read_group,{}).get("barcode_bias",[-1])
-                if (combined_datasets_json['read_groups'][read_group]['barcode_bias'] == [-1]) & (barcode_bias != [-1]):
-                    combined_datasets_json['read_groups'][read_group]['barcode_bias'] = len(barcode_bias) * [0]
-                if barcode_bias != [-1]:
-                    for bias_idx in range(len(barcode_bias)):
-                        combined_datasets_json['read_groups'][read_group]['barcode_bias'][bias_idx] += barcode_bias[bias_idx] * current_datasets_json['read_groups'].get(read_group,{}).get("read_count",0)
-        # After combining all the blocks
-        if "barcode_sequence" in combined_datasets_json['read_groups'][read_group]:
-            if combined_datasets_json['read_groups'][read_group]['barcode_bias'] == [-1]:
-                combined_datasets_json['read_groups'][read_group]['barcode_bias'] = [0]
-            if combined_datasets_json['read_groups'][read_group]['read_count'] > 0:
-                for bias_idx in range(len(combined_datasets_json['read_groups'][read_group]['barcode_bias'])):
-                    combined_datasets_json['read_groups'][read_group]['barcode_bias'][bias_idx] /= combined_datasets_json['read_groups'][read_group]['read_count']
-
-    # Barcode filters -------------------------------------------------------
-    # Potential filters 1) frequency filter 2) minreads filter 3) error histogram filter
-    # No use to attempt filtering here if filtering is done per block or json entries are missing
-    if "barcode_filters" in combined_datasets_json and (combined_datasets_json['barcode_filters']['filter_postpone'] != 0):
-        # Loop through read groups to compute combined filtering threshold
-        max_reads = 0
-        for read_group in combined_datasets_json['read_groups'].iterkeys():
-            if "barcode_sequence" in combined_datasets_json['read_groups'][read_group]:
-                max_reads = max(max_reads, combined_datasets_json['read_groups'][read_group]['read_count'])
-        filter_threshold = combined_datasets_json['barcode_filters']['filter_minreads']
-        filter_threshold = max(filter_threshold, math.floor(max_reads*combined_datasets_json['barcode_filters']['filter_frequency']))
-        
-        # Doing the actual filtering - exclude no-match read group
-        for read_group in combined_datasets_json['read_groups']:
-            filter_me = (combined_datasets_json['read_groups'][read_group]['sample'] == 'none')
-            if ("barcode_sequence" in combined_datasets_json['read_groups'][read_group]) and filter_me:
-                if combined_datasets_json['read_groups'][read_group]['read_count'] <= filter_threshold:
-                    combined_datasets_json['read_groups'][read_group]['filtered'] = True
-                if (not combined_datasets_json['read_groups'][read_group]['filtered']) and (combined_datasets_json['barcode_filters']['filter_errors_hist'] > 0):
-                    av_errors = (combined_datasets_json['read_groups'][read_group]['barcode_errors_hist'][1] + 2*combined_datasets_json['read_groups'][read_group]['barcode_errors_hist'][2]) / combined_datasets_json['read_groups'][read_group]['read_count']
-                    combined_datasets_json['read_groups'][read_group]['filtered'] = (av_errors > combined_datasets_json['barcode_filters']['filter_errors_hist'])
-    # ----------------------------------------------------------------------
-        
+def dataset_key(idx, dataset):
+    # datasets are matched across blocks by file prefix, position only as a fallback
+    return dataset.get('file_prefix', dataset.get('dataset_name', idx))
+
+
+def load_datasets_basecaller_block(dir, BASECALLER_RESULTS):
+    '''Reads datasets_basecaller.json of one block into a partial result for DatasetsBasecallerReducer'''
+
+    current_datasets_path = os.path.join(dir,BASECALLER_RESULTS,'datasets_basecaller.json')
     try:
-        f = open(os.path.join(BASECALLER_RESULTS,'datasets_basecaller.json'),"w")
-        json.dump(combined_datasets_json, f, indent=4)
+        f = open(current_datasets_path,'r')
+        block_json = json.load(f)
         f.close()
     except:
-        printtime("ERROR: Failed to write merged datasets_basecaller.json")
-        traceback.print_exc()
+        printtime("ERROR: skipped %s" % current_datasets_path)
+        return None
+
+    read_groups = sorted(block_json.get('read_groups',{}).keys())
+    rgs = [block_json['read_groups'][read_group] for read_group in read_groups]
+
+    # filtered: 1 = True, 0 = False, -1 = not reported by this block
+    filtered = numpy.array([{True:1,False:0}.get(rg.get('filtered'),-1) for rg in rgs], dtype=numpy.int8)
+
+    errors_hist = numpy.zeros((len(rgs),BARCODE_ERRORS_HIST_LENGTH), dtype=numpy.int64)
+    distance_hist = numpy.zeros((len(rgs),BARCODE_DISTANCE_HIST_LENGTH), dtype=numpy.int64)
+    bias = {}
+    for idx,rg in enumerate(rgs):
+        hist = rg.get("barcode_errors_hist",[])[:BARCODE_ERRORS_HIST_LENGTH]
+        errors_hist[idx,:len(hist)] = hist
+        hist = rg.get("barcode_distance_hist",[])[:BARCODE_DISTANCE_HIST_LENGTH]
+        distance_hist[idx,:len(hist)] = hist
+        barcode_bias = rg.get("barcode_bias",[-1])
+        if barcode_bias != [-1]:
+            bias[read_groups[idx]] = numpy.array(barcode_bias, dtype=float) * rg.get("read_count",0)
+
+    return {
+        'dir'                    : dir,
+        'json'                   : block_json,
+        'dataset_read_count'     : dict((dataset_key(idx,dataset), int(dataset.get("read_count",0)))
+                                        for idx,dataset in enumerate(block_json.get('datasets',[]))),
+        'read_groups'            : read_groups,
+        'Q20_bases'              : numpy.array([rg.get("Q20_bases",0) for rg in rgs], dtype=numpy.int64),
+        'total_bases'            : numpy.array([rg.get("total_bases",0) for rg in rgs], dtype=numpy.int64),
+        'read_count'             : numpy.array([rg.get("read_count",0) for rg in rgs], dtype=numpy.int64),
+        'barcode_match_filtered' : numpy.array([rg.get("barcode_match_filtered",0) for rg in rgs], dtype=numpy.int64),
+        'filtered'               : filtered,
+        'barcode_errors_hist'    : errors_hist,
+        'barcode_distance_hist'  : distance_hist,
+        'barcode_bias'           : bias,     # weighted by read count
+    }
 
 
-def merge_basecaller_stats(dirs, BASECALLER_RESULTS):
+class DatasetsBasecallerReducer(object):
+    '''Combines datasets_basecaller.json one block at a time.
+
+    Blocks can be folded in any order. The output is based on the json of the first valid
+    block in dirs order, the counters are matched by read group name and dataset key.
+    Per read group counters and histograms are kept as numpy arrays with one row per read
+    group seen so far, so folding a block is a set of vector additions.
+    The combined json, including the barcode filters, is generated once by result().
+    '''
+
+    COUNTERS = ('Q20_bases', 'total_bases', 'read_count', 'barcode_match_filtered',
+                'num_blocks_filtered', 'barcode_errors_hist', 'barcode_distance_hist')
+
+    def __init__(self, dirs=()):
+        self.rank = dict((dir,idx) for idx,dir in enumerate(dirs))
+        self.template = None
+        self.template_rank = None
+        self.num_blocks = 0
+        self.read_groups = []
+        self.rg_index = {}
+        self.dataset_read_count = {}
+        self.Q20_bases = numpy.zeros(0, dtype=numpy.int64)
+        self.total_bases = numpy.zeros(0, dtype=numpy.int64)
+        self.read_count = numpy.zeros(0, dtype=numpy.int64)
+        self.barcode_match_filtered = numpy.zeros(0, dtype=numpy.int64)
+        self.num_blocks_filtered = numpy.zeros(0, dtype=numpy.int64)
+        self.barcode_errors_hist = numpy.zeros((0,BARCODE_ERRORS_HIST_LENGTH), dtype=numpy.int64)
+        self.barcode_distance_hist = numpy.zeros((0,BARCODE_DISTANCE_HIST_LENGTH), dtype=numpy.int64)
+        self.not_unfiltered = numpy.zeros(0, dtype=bool)   # no block reported filtered=False
+        self.barcode_bias = {}
+
+    def _rows(self, read_groups):
+        # blocks normally report the same read groups, grow the counters only for new ones
+        new = [rg for rg in read_groups if rg not in self.rg_index]
+        if new:
+            for rg in new:
+                self.rg_index[rg] = len(self.read_groups)
+                self.read_groups.append(rg)
+            for key in self.COUNTERS:
+                counter = getattr(self, key)
+                setattr(self, key, numpy.concatenate((counter, numpy.zeros((len(new),)+counter.shape[1:], dtype=counter.dtype))))
+            self.not_unfiltered = numpy.concatenate((self.not_unfiltered, numpy.ones(len(new), dtype=bool)))
+        return numpy.array([self.rg_index[rg] for rg in read_groups], dtype=numpy.intp)
+
+    def add(self, partial):
+        '''Fold the partial result of one block, as returned by load_datasets_basecaller_block()'''
+        if partial is None:
+            return
+        if ('datasets' not in partial['json']) or ('read_groups' not in partial['json']):
+            printtime("merge_basecaller_results: skipping block without valid datasets_basecaller.json")
+            return
+        rank = self.rank.get(partial['dir'], len(self.rank))
+        if self.template is None or rank < self.template_rank:
+            self.template = partial['json']
+            self.template_rank = rank
+        self.num_blocks += 1
+
+        for key,read_count in partial['dataset_read_count'].iteritems():
+            self.dataset_read_count[key] = self.dataset_read_count.get(key,0) + read_count
+
+        rows = self._rows(partial['read_groups'])
+        filtered = partial['filtered']
+        partial = dict(partial, num_blocks_filtered=(filtered == 1))
+        for key in self.COUNTERS:
+            # read group names are unique within a block, rows has no duplicates
+            counter = getattr(self, key)
+            counter[rows] += partial[key].astype(counter.dtype)
+        self.not_unfiltered[rows] &= (filtered != 0)
+        for rg,bias in partial['barcode_bias'].iteritems():
+            if rg not in self.barcode_bias:
+                self.barcode_bias[rg] = numpy.zeros(len(bias))
+            n = min(len(bias), len(self.barcode_bias[rg]))
+            self.barcode_bias[rg][:n] += bias[:n]
+
+    def result(self):
+        '''Combined datasets_basecaller.json, None if no block contained a valid file'''
+        if self.template is None:
+            return None
+
+        combined_datasets_json = self.template
+
+        for dataset_idx,dataset in enumerate(combined_datasets_json['datasets']):
+            dataset['read_count'] = self.dataset_read_count.get(dataset_key(dataset_idx,dataset),0)
+
+        barcode_read_counts = []
+        for read_group in sorted(combined_datasets_json['read_groups']):
+            rg = combined_datasets_json['read_groups'][read_group]
+            idx = self.rg_index[read_group]
+            is_barcode = 'barcode_sequence' in rg
+            rg['Q20_bases'] = int(self.Q20_bases[idx])
+            rg['total_bases'] = int(self.total_bases[idx])
+            rg['read_count'] = int(self.read_count[idx])
+            rg['filtered'] = is_barcode and bool(self.not_unfiltered[idx])
+            if is_barcode:
+                barcode_read_counts.append(rg['read_count'])
+                rg['barcode_match_filtered'] = int(self.barcode_match_filtered[idx])
+                rg['num_blocks_filtered'] = int(self.num_blocks_filtered[idx])
+                rg['barcode_errors_hist'] = self.barcode_errors_hist[idx].tolist()
+                rg['barcode_distance_hist'] = self.barcode_distance_hist[idx].tolist()
+                if read_group not in self.barcode_bias:
+                    rg['barcode_bias'] = [0]
+                elif rg['read_count'] > 0:
+                    rg['barcode_bias'] = (self.barcode_bias[read_group] / rg['read_count']).tolist()
+                else:
+                    rg['barcode_bias'] = self.barcode_bias[read_group].tolist()
+
+        # Barcode filters -------------------------------------------------------
+        # Potential filters 1) frequency filter 2) minreads filter 3) error histogram filter
+        # No use to attempt filtering here if filtering is done per block or json entries are missing
+        if "barcode_filters" in combined_datasets_json and (combined_datasets_json['barcode_filters']['filter_postpone'] != 0):
+            # Loop through read groups to compute combined filtering threshold
+            max_reads = 0
+            if barcode_read_counts:
+                max_reads = max(barcode_read_counts)
+            filter_threshold = combined_datasets_json['barcode_filters']['filter_minreads']
+            filter_threshold = max(filter_threshold, math.floor(max_reads*combined_datasets_json['barcode_filters']['filter_frequency']))
+
+            # Doing the actual filtering - exclude no-match read group
+            for read_group in combined_datasets_json['read_groups']:
+                filter_me = (combined_datasets_json['read_groups'][read_group]['sample'] == 'none')
+                if ("barcode_sequence" in combined_datasets_json['read_groups'][read_group]) and filter_me:
+                    if combined_datasets_json['read_groups'][read_group]['read_count'] <= filter_threshold:
+                        combined_datasets_json['read_groups'][read_group]['filtered'] = True
+                    if (not combined_datasets_json['read_groups'][read_group]['filtered']) and (combined_datasets_json['barcode_filters']['filter_errors_hist'] > 0):
+                        av_errors = (combined_datasets_json['read_groups'][read_group]['barcode_errors_hist'][1] + 2*combined_datasets_json['read_groups'][read_group]['barcode_errors_hist'][2]) / combined_datasets_json['read_groups'][read_group]['read_count']
+                        combined_datasets_json['read_groups'][read_group]['filtered'] = (av_errors > combined_datasets_json['barcode_filters']['filter_errors_hist'])
+        # ----------------------------------------------------------------------
+
+        return combined_datasets_json
+
+    def write(self, BASECALLER_RESULTS):
+        combined_datasets_json = self.result()
+        if combined_datasets_json is None:
+            printtime("merge_basecaller_results: no block contained a valid datasets_basecaller.json, aborting")
+            return
+        try:
+            f = open(os.path.join(BASECALLER_RESULTS,'datasets_basecaller.json'),"w")
+            json.dump(combined_datasets_json, f, indent=4)
+            f.close()
+        except:
+            printtime("ERROR: Failed to write merged datasets_basecaller.json")
+            traceback.print_exc()
 
-    merge_datasets_basecaller_json(dirs, BASECALLER_RESULTS)
+
+def fold_datasets_basecaller(reducer, partial):
+    '''BlockReduction fold step'''
+    reducer.add(partial)
+    return reducer
+
+
+def write_datasets_basecaller(reducer, BASECALLER_RESULTS):
+    '''BlockReduction finish step'''
+    reducer.write(BASECALLER_RESULTS)
+
+
+def datasets_basecaller_reduction(dirs, BASECALLER_RESULTS):
+    '''merge_datasets_basecaller_json as a per-block reduction for the merge graph'''
+    return blockmerge.BlockReduction(os.path.join(BASECALLER_RESULTS,'datasets_basecaller.json'),
+        load_datasets_basecaller_block, fold_datasets_basecaller, write_datasets_basecaller,
+        initial=DatasetsBasecallerReducer(dirs), load_args=(BASECALLER_RESULTS,), finish_args=(BASECALLER_RESULTS,))
+
+
+def merge_datasets_basecaller_json(dirs, BASECALLER_RESULTS):
+
+    ########################################################
+    # Merge datasets_basecaller.json                       #
+    ########################################################
+
+    reducer = DatasetsBasecallerReducer(dirs)
+    for dir in dirs:
+        reducer.add(load_datasets_basecaller_block(dir, BASECALLER_RESULTS))
+    reducer.write(BASECALLER_RESULTS)
+
+
+def write_composite_return_code(dirs, BASECALLER_RESULTS):
 
     ########################################################
     # write composite return code                          #
@@ -337,25 +464,53 @@ def merge_basecaller_stats(dirs, BASECALLER_RESULTS):
         traceback.print_exc()
 
 
+def load_basecaller_json_block(subdir, BASECALLER_RESULTS):
+    subdir = os.path.join(BASECALLER_RESULTS,subdir)
+    if isbadblock(subdir, "Merging BaseCaller.json files"):
+        return None
+    basecallerjson = os.path.join(subdir,'BaseCaller.json')
+    if not os.path.exists(basecallerjson):
+        printtime("ERROR: Merging BaseCaller.json files: skipped %s" % basecallerjson)
+        return None
+    return mergeBaseCallerJson.load_block(subdir)
+
+
+def basecaller_json_reduction(BASECALLER_RESULTS):
+    '''BaseCaller.json merge as a per-block reduction for the merge graph'''
+    return blockmerge.BlockReduction(os.path.join(BASECALLER_RESULTS,'BaseCaller.json'),
+        load_basecaller_json_block, mergeBaseCallerJson.fold, mergeBaseCallerJson.write,
+        load_args=(BASECALLER_RESULTS,), finish_args=(BASECALLER_RESULTS,))
+
+
+def add_basecaller_stats_merge(graph, dirs, BASECALLER_RESULTS, ready=None):
+    '''Register the merge_basecaller_stats steps on a merge graph, returns the task names'''
+    tasks = [
+        graph.add_reduction(datasets_basecaller_reduction(dirs, BASECALLER_RESULTS), dirs, ready=ready).name,
+        graph.add_reduction(basecaller_json_reduction(BASECALLER_RESULTS), dirs, ready=ready).name,
+        graph.add_task('composite_return_code', write_composite_return_code, (dirs, BASECALLER_RESULTS)).name,
+    ]
+    return tasks
+
+
+def merge_basecaller_stats(dirs, BASECALLER_RESULTS):
+
+    merge_datasets_basecaller_json(dirs, BASECALLER_RESULTS)
+
+    write_composite_return_code(dirs, BASECALLER_RESULTS)
+
     ###############################################
     # Merge BaseCaller.json files                 #
     ###############################################
     printtime("Merging BaseCaller.json files")
 
     try:
-        basecallerfiles = []
+        reducer = mergeBaseCallerJson.BaseCallerJsonReducer()
         for subdir in dirs:
-            subdir = os.path.join(BASECALLER_RESULTS,subdir)
-            printtime("DEBUG: %s:" % subdir)
-            if isbadblock(subdir, "Merging BaseCaller.json files"):
-                continue
-            basecallerjson = os.path.join(subdir,'BaseCaller.json')
-            if os.path.exists(basecallerjson):
-                basecallerfiles.append(subdir)
-            else:
-                printtime("ERROR: Merging BaseCaller.json files: skipped %s" % basecallerjson)
-
-        mergeBaseCallerJson.merge(basecallerfiles,BASECALLER_RESULTS)
+            printtime("DEBUG: %s:" % os.path.join(BASECALLER_RESULTS,subdir))
+            partial = load_basecaller_json_block(subdir, BASECALLER_RESULTS)
+            if partial is not None:
+                reducer.add(partial)
+        reducer.write(BASECALLER_RESULTS)
     except:
         traceback.print_exc()
         printtime("Merging BaseCaller.json files failed")
@@ -363,8 +518,9 @@ def merge_basecaller_stats(dirs, BASECALLER_RESULTS):
     printtime("Finished merging basecaller stats")
 
 
-def merge_bams(dirs, BASECALLER_RESULTS, basecaller_datasets, method):
+def merge_bams(dirs, BASECALLER_RESULTS, basecaller_datasets, method, processes=None):
 
+    merges = []
     for dataset in basecaller_datasets['datasets']:
 
         try:
@@ -376,14 +532,45 @@ def merge_bams(dirs, BASECALLER_RESULTS, basecaller_datasets, method):
             if block_bam_list:
                 composite_bai_filepath=""
                 mark_duplicates=False
-                blockprocessing.merge_bam_files(block_bam_list, composite_bam_filepath, composite_bai_filepath, mark_duplicates, method)
+                merges.append((block_bam_list, composite_bam_filepath, composite_bai_filepath, mark_duplicates, method))
         except:
             traceback.print_exc()
             printtime("ERROR: merging %s unsuccessful" % bamfile)
 
+    printtime("Merging basecaller BAM files of %d datasets" % len(merges))
+    blockmerge.merge_bam_datasets(merges, processes)
     printtime("Finished merging basecaller BAM files")
 
 
+def merge_unfiltered_bams(dirs, BASECALLER_RESULTS, unfiltered_directory, method):
+    '''Merge the block BAMs of an unfiltered.* directory'''
+
+    # block BAM names follow the main datasets_basecaller.json
+    basecaller_datasets = blockprocessing.get_datasets_basecaller(BASECALLER_RESULTS)
+    merge_bams(dirs, unfiltered_directory, basecaller_datasets, method)
+
+
+def merge_hpmodels():
+    '''Merge the block recalibration HP models, raises if calibrate fails'''
+    cmd = "calibrate --hpmodelMerge"
+    printtime("DEBUG: Calling '%s':" % cmd)
+    ret = subprocess.call(cmd, shell=True)
+    if ret != 0:
+        raise Exception("'%s' failed with exit status %d" % (cmd, ret))
+
+
+def merge_rawtf_bams(dirs, BASECALLER_RESULTS):
+    '''Merge the rawtf.basecaller.bam of the blocks which have one, raises if the merge fails'''
+    block_bam_list = [os.path.join(adir, BASECALLER_RESULTS, 'rawtf.basecaller.bam') for adir in dirs]
+    block_bam_list = [block_bam_filename for block_bam_filename in block_bam_list if os.path.exists(block_bam_filename)]
+    if not block_bam_list:
+        printtime("INFO: no rawtf.basecaller.bam to merge")
+        return
+    printtime("INFO: merging rawtf.basecaller.bam of %d blocks" % len(block_bam_list))
+    composite_bam_filename = os.path.join(BASECALLER_RESULTS, 'rawtf.basecaller.bam')
+    if blockprocessing.merge_bam_files(block_bam_list, composite_bam_filename, "", False, 'picard'):
+        raise Exception("merging %s unsuccessful" % composite_bam_filename)
+
 
 def generate_datasets_json(
         barcodeId,
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+# Copyright (C) 2014 Ion Torrent Systems, Inc. All Rights Reserved
+
+'''
+Memory-mapped access to bfmask.bin / analysis.bfmask.bin.
+
+The file is two int32 values (rows, cols) followed by one int16 of flags per
+well, row by row. The mask is mapped with numpy.memmap and reduced in tiles of
+whole rows, so a full Proton chip is never loaded at once.
+'''
+
+import math
+import struct
+import numpy
+
+HEADER_SIZE = 8
+# the second bit flags a loaded well (bead)
+MASK_BEAD = 2
+# wells per tile, 32MB of int16 flags
+TILE_WELLS = 16 * 1024 * 1024
+
+
+def read_shape(filename):
+    '''Returns (rows, cols) of a bfmask.bin'''
+    with open(filename, 'rb') as f:
+        return struct.unpack('ii', f.read(HEADER_SIZE))
+
+
+def open_mask(filename):
+    '''Read-only (rows, cols) int16 memmap of the well flags'''
+    rows, cols = read_shape(filename)
+    return numpy.memmap(filename, dtype=numpy.int16, mode='r', offset=HEADER_SIZE, shape=(rows, cols))
+
+
+def tiles(mask, multiple=1, tile_wells=TILE_WELLS):
+    '''Yields (first row, tile) of whole rows, tile heights are a multiple of multiple'''
+    rows, cols = mask.shape
+    tile_rows = max(1, tile_wells // (max(cols, 1) * multiple)) * multiple
+    for start in range(0, rows, tile_rows):
+        yield start, numpy.asarray(mask[start:start+tile_rows])
+
+
+def count_wells(filename, flag=MASK_BEAD):
+    '''Number of wells with flag set'''
+    total = 0
+    for start, tile in tiles(open_mask(filename)):
+        total += int(numpy.count_nonzero(tile & flag))
+    return total
+
+
+def binned_density(filename, bin_size=10, flag=MASK_BEAD, tile_wells=TILE_WELLS):
+    '''Percentage of wells with flag set (loading density for MASK_BEAD) in
+    bin_size x bin_size bins. Bins on the chip edge cover the remaining wells.
+    Returns a float32 array of ceil(rows/bin_size) x ceil(cols/bin_size).'''
+    mask = open_mask(filename)
+    rows, cols = mask.shape
+    bin_rows = int(math.ceil(rows / float(bin_size)))
+    bin_cols = int(math.ceil(cols / float(bin_size)))
+    counts = numpy.zeros((bin_rows, bin_cols), dtype=numpy.float32)
+    col_starts = numpy.arange(0, cols, bin_size)
+
+    for start, tile in tiles(mask, bin_size, tile_wells):
+        # 0/1 per well, int16 holds the sums of bins up to 181x181
+        loaded = (tile & flag) != 0
+        row_starts = numpy.arange(0, tile.shape[0], bin_size)
+        per_row_bin = numpy.add.reduceat(loaded.astype(numpy.int16), row_starts, axis=0)
+        del loaded
+        per_bin = numpy.add.reduceat(per_row_bin.astype(numpy.int32), col_starts, axis=1)
+        first = start // bin_size
+        counts[first:first+per_bin.shape[0]] = per_bin
+
+    # wells per bin, smaller on the last row and column
+    well_rows = numpy.minimum(bin_size, rows - numpy.arange(bin_rows) * bin_size)
+    well_cols = numpy.minimum(bin_size, cols - numpy.arange(bin_cols) * bin_size)
+    counts *= 100.0 / numpy.outer(well_rows, well_cols)
+    return counts
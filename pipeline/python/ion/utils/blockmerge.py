@@ -0,0 +1,327 @@
+#!/usr/bin/python
+# Copyright (C) 2014 Ion Torrent Systems, Inc. All Rights Reserved
+
+'''
+Merge engine for composite (multi-block) reports.
+
+All merge work of a MergeTLScript stage is registered in one dependency graph.
+Tasks whose dependencies are satisfied run concurrently on a process pool.
+Per-block reductions are split into one load task per block, which is started
+as soon as that block has finished, and a fold step which runs in the parent
+process as each block result comes back.
+'''
+
+import os
+import sys
+import time
+import traceback
+import multiprocessing
+
+from ion.utils.sysutils import printtime, available_memory
+
+
+GB = 1024 * 1024 * 1024
+BAM_MERGE_IO_SLOTS = 6
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+def block_finished(blockdir, processes):
+    '''True once BlockTLScript recorded a result for one of processes in blockstatus.txt,
+    or any of its steps failed'''
+    try:
+        with open(os.path.join(blockdir, 'blockstatus.txt'), 'r') as f:
+            for line in f:
+                process, sep, status = line.partition('=')
+                if not sep:
+                    continue
+                if process in processes or not status.strip().startswith('0'):
+                    return True
+    except IOError:
+        pass
+    return False
+
+
+def _run_task(func, args, kwargs):
+    # executed in the pool worker, exceptions are returned to the parent as text
+    # because traceback objects do not pickle
+    try:
+        return True, func(*args, **kwargs)
+    except:
+        return False, traceback.format_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
+class MergeTask(object):
+
+    def __init__(self, name, func, args=(), kwargs=None, depends=(), ready=None, after=()):
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.kwargs = kwargs or {}
+        self.depends = list(depends)
+        self.after = list(after)
+        self.ready = ready
+        self.status = PENDING
+        self.result = None
+        self.async_result = None
+        self.start_time = None
+        self.reduction = None
+
+    def __repr__(self):
+        return "<MergeTask %s %s>" % (self.name, self.status)
+
+
+class BlockReduction(object):
+    '''Folds per-block results into an accumulator as the blocks come in.
+
+    load(blockdir, *args) runs in a pool worker and returns a partial result or None,
+    fold(accumulator, partial) runs in the parent process and returns the new accumulator,
+    finish(accumulator, *args) runs in a pool worker after the last block has been folded.
+    '''
+
+    def __init__(self, name, load, fold, finish, initial=None, load_args=(), finish_args=()):
+        self.name = name
+        self.load = load
+        self.fold = fold
+        self.finish = finish
+        self.accumulator = initial
+        self.load_args = tuple(load_args)
+        self.finish_args = tuple(finish_args)
+        self.blocks_folded = 0
+
+
+class MergeGraph(object):
+    '''Dependency graph of merge tasks, executed on a process pool'''
+
+    def __init__(self, processes=None, poll_interval=0.5, block_timeout=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.poll_interval = poll_interval
+        self.block_timeout = block_timeout
+        self.tasks = {}
+        self.order = []
+
+    def add_task(self, name, func, args=(), kwargs=None, depends=(), ready=None, after=()):
+        '''Register func(*args, **kwargs) to run after all tasks listed in depends.
+        Tasks listed in after only have to have ended, successfully or not.
+        ready is an optional predicate, evaluated in the parent, that has to return True
+        before the task is started (e.g. the block the task reads from has finished).'''
+        if name in self.tasks:
+            raise ValueError("duplicate merge task '%s'" % name)
+        task = MergeTask(name, func, args, kwargs, depends, ready, after)
+        self.tasks[name] = task
+        self.order.append(name)
+        return task
+
+    def add_reduction(self, reduction, dirs, depends=(), ready=None):
+        '''Register one load task per block and a final task named after the reduction.
+        ready(blockdir) gates each block's load task.'''
+        load_names = []
+        for blockdir in dirs:
+            block_ready = (lambda d=blockdir: ready(d)) if ready else None
+            task = self.add_task("%s:%s" % (reduction.name, blockdir),
+                                 reduction.load, (blockdir,) + reduction.load_args,
+                                 depends=depends, ready=block_ready)
+            task.reduction = reduction
+            load_names.append(task.name)
+        # finish arguments are bound when the task is started, after the last fold
+        final = self.add_task(reduction.name, reduction.finish, depends=list(depends) + load_names)
+        final.reduction = reduction
+        return final
+
+    def status(self, name):
+        return self.tasks[name].status
+
+    def result(self, name):
+        return self.tasks[name].result
+
+    def _check(self):
+        for name in self.order:
+            for dep in self.tasks[name].depends + self.tasks[name].after:
+                if dep not in self.tasks:
+                    raise ValueError("merge task '%s' depends on unknown task '%s'" % (name, dep))
+
+    def _runnable(self, task):
+        if task.status != PENDING:
+            return False
+        for dep in task.depends:
+            dep_task = self.tasks[dep]
+            if dep_task.status in (FAILED, SKIPPED):
+                # block load failures only drop that block from the reduction
+                if dep_task.reduction is not None and dep_task.reduction is task.reduction:
+                    continue
+                task.status = SKIPPED
+                printtime("ERROR: merge task %s skipped, dependency %s %s" % (task.name, dep, dep_task.status))
+                return False
+            if dep_task.status != DONE:
+                return False
+        for dep in task.after:
+            if self.tasks[dep].status in (PENDING, RUNNING):
+                return False
+        if task.ready is not None and not task.ready():
+            return False
+        return True
+
+    def _start(self, pool, task):
+        args = task.args
+        if task.reduction is not None and task.name == task.reduction.name:
+            args = (task.reduction.accumulator,) + task.reduction.finish_args
+        task.status = RUNNING
+        task.start_time = time.time()
+        task.async_result = pool.apply_async(_run_task, (task.func, args, task.kwargs))
+
+    def _complete(self, task):
+        ok, value = task.async_result.get()
+        task.async_result = None
+        elapsed = time.time() - task.start_time
+        if not ok:
+            task.status = FAILED
+            printtime("ERROR: merge task %s failed after %.1f sec" % (task.name, elapsed))
+            print value
+            return
+        task.status = DONE
+        task.result = value
+        reduction = task.reduction
+        if reduction is not None and task.name != reduction.name and value is not None:
+            try:
+                reduction.accumulator = reduction.fold(reduction.accumulator, value)
+                reduction.blocks_folded += 1
+            except:
+                task.status = FAILED
+                printtime("ERROR: merge task %s: folding block result failed" % task.name)
+                traceback.print_exc()
+                return
+        finished = len([n for n in self.order if self.tasks[n].status in (DONE, FAILED, SKIPPED)])
+        printtime("DEBUG: merge task %s finished in %.1f sec (%d of %d)" % (task.name, elapsed, finished, len(self.order)))
+
+    def _expire_blocks(self):
+        # give up on tasks still waiting for their block after block_timeout
+        for name in self.order:
+            task = self.tasks[name]
+            if task.status == PENDING and task.ready is not None and not task.ready():
+                task.status = SKIPPED
+                printtime("ERROR: merge task %s skipped, block not finished" % task.name)
+
+    def run(self):
+        '''Execute all tasks, returns True if every task finished successfully'''
+        self._check()
+        printtime("Merge graph: %d tasks on %d processes" % (len(self.order), self.processes))
+        start = time.time()
+        pool = multiprocessing.Pool(processes=self.processes)
+        try:
+            while True:
+                running = [self.tasks[n] for n in self.order if self.tasks[n].status == RUNNING]
+                for task in running:
+                    if task.async_result.ready():
+                        self._complete(task)
+
+                for name in self.order:
+                    task = self.tasks[name]
+                    if self._runnable(task):
+                        self._start(pool, task)
+
+                statuses = [self.tasks[n].status for n in self.order]
+                if RUNNING not in statuses:
+                    if PENDING not in statuses:
+                        break
+                    waiting = [self.tasks[n] for n in self.order if self.tasks[n].status == PENDING]
+                    if not [t for t in waiting if t.ready is not None]:
+                        # nothing is running and nothing waits on a block: the rest can never start
+                        for task in waiting:
+                            task.status = SKIPPED
+                            printtime("ERROR: merge task %s skipped, unresolved dependencies" % task.name)
+                        break
+                    if self.block_timeout is not None and time.time() - start > self.block_timeout:
+                        self._expire_blocks()
+                        continue
+
+                time.sleep(self.poll_interval)
+        finally:
+            pool.close()
+            pool.join()
+
+        failed = [n for n in self.order if self.tasks[n].status != DONE]
+        printtime("Merge graph finished in %.1f sec, %d of %d tasks failed or skipped" %
+                  (time.time() - start, len(failed), len(self.order)))
+        return not failed
+
+
+def bam_merge_resources():
+    '''Budget of one concurrent BAM merge by method, (memory, cores):
+    picard runs with a PICARD_MERGE_HEAP_GB java heap plus the JVM's own memory,
+    samtools merge buffers every input file and compresses with SAMTOOLS_MERGE_THREADS'''
+    # blockprocessing needs the server settings, import it only where BAM merges run
+    from ion.utils import blockprocessing
+    return {
+        'picard': ((blockprocessing.PICARD_MERGE_HEAP_GB + 1) * GB, 1),
+        'samtools': (1 * GB, blockprocessing.SAMTOOLS_MERGE_THREADS),
+    }
+
+
+def bam_merge_processes(methods=('samtools',), io_slots=BAM_MERGE_IO_SLOTS):
+    '''Number of BAM merges to run side by side, bounded by cores, memory and I/O,
+    each merge budgeted at the largest needs of methods'''
+    resources = bam_merge_resources()
+    memory_per_merge = max(resources[method][0] for method in methods)
+    cores_per_merge = max(resources[method][1] for method in methods)
+    processes = min(multiprocessing.cpu_count() // cores_per_merge, io_slots)
+    memory = available_memory()
+    if memory is not None:
+        processes = min(processes, memory // memory_per_merge)
+    return max(1, int(processes))
+
+
+def _merge_bam_dataset(bamfilelist, composite_bam_filepath, composite_bai_filepath, mark_duplicates, method):
+    from ion.utils import blockprocessing
+    if blockprocessing.merge_bam_files(bamfilelist, composite_bam_filepath, composite_bai_filepath, mark_duplicates, method):
+        raise Exception("merging %s unsuccessful" % composite_bam_filepath)
+
+
+def _input_size(bamfilelist):
+    size = 0
+    for bamfile in bamfilelist:
+        try:
+            size += os.path.getsize(bamfile)
+        except OSError:
+            pass
+    return size
+
+
+def merge_bam_datasets(merges, processes=None):
+    '''Merge the block BAMs of several datasets concurrently.
+
+    merges is a list of (bamfilelist, composite_bam_filepath, composite_bai_filepath,
+    mark_duplicates, method) tuples, the arguments of blockprocessing.merge_bam_files.
+    The datasets with the most input data are started first, so that a large barcode
+    does not start last and hold up the whole stage.
+    Returns True if all datasets were merged successfully.
+    '''
+    if not merges:
+        return True
+    merges = sorted(merges, key=lambda merge: _input_size(merge[0]), reverse=True)
+    if processes is None:
+        processes = bam_merge_processes(set(merge[4] for merge in merges))
+
+    if processes == 1 or multiprocessing.current_process().daemon:
+        # pool workers cannot start a pool of their own
+        success = True
+        for idx, merge in enumerate(merges):
+            start = time.time()
+            ok, value = _run_task(_merge_bam_dataset, merge, {})
+            if not ok:
+                success = False
+                printtime("ERROR: merging %s unsuccessful" % merge[1])
+                print value
+            printtime("DEBUG: merged %s in %.1f sec (%d of %d)" % (merge[1], time.time() - start, idx + 1, len(merges)))
+        return success
+
+    graph = MergeGraph(processes=processes)
+    for merge in merges:
+        graph.add_task(merge[1], _merge_bam_dataset, merge)
+    return graph.run()
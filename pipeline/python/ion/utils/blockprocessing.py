@@ -23,6 +23,8 @@ from collections import deque
 
 from ion.plugin.remote import call_launchPluginsXMLRPC
 from ion.plugin.constants import RunLevel, RunType
+from ion.utils import bamheader
+from ion.utils.sysutils import printtime
 
 from ion.reports.plotters import *
 from ion.utils.aggregate_alignment import *
@@ -43,13 +45,6 @@ class MyConfigParser(ConfigParser.RawConfigParser):
             afile = StringIO.StringIO("[global]\n" + text)
             self.readfp(afile, filename)
 
-def printtime(message, *args):
-    if args:
-        message = message % args
-    print "[ " + time.strftime('%X') + " ] " + message
-    sys.stdout.flush()
-    sys.stderr.flush()
-
 def write_version():
     a = subprocess.Popen('ion_versionCheck.py --ion', shell=True, stdout=subprocess.PIPE)
     ret = a.stdout.readlines()
@@ -274,32 +269,27 @@ def runplugins(plugins, env, level = RunLevel.DEFAULT, params={}):
     return plugins  
 
 
+# resources of one BAM merge, blockmerge schedules concurrent merges by these
+SAMTOOLS_MERGE_THREADS = 8
+PICARD_MERGE_HEAP_GB = 8
+
+
 def merge_bam_files(bamfilelist,composite_bam_filepath,composite_bai_filepath,mark_duplicates,method="samtools"):
+    '''Returns 0 on success, the exit status of the failed merge command otherwise'''
 
     if method=='samtools':
-        merge_bam_files_samtools(bamfilelist,composite_bam_filepath,composite_bai_filepath,mark_duplicates)
+        return merge_bam_files_samtools(bamfilelist,composite_bam_filepath,composite_bai_filepath,mark_duplicates)
 
     if method=='picard':
-        merge_bam_files_picard(bamfilelist,composite_bam_filepath,composite_bai_filepath,mark_duplicates)
+        return merge_bam_files_picard(bamfilelist,composite_bam_filepath,composite_bai_filepath,mark_duplicates)
 
 
 def merge_bam_files_samtools(bamfilelist,composite_bam_filepath,composite_bai_filepath,mark_duplicates):
 
     try:
-        for bamfile in bamfilelist:
-            cmd = 'samtools view -H %s > %s.header.sam' % (bamfile,bamfile,)
-            printtime("DEBUG: Calling '%s'" % cmd)
-            subprocess.call(cmd,shell=True)
-
-        cmd = 'java -Xmx8g -jar /opt/picard/picard-tools-current/MergeSamFiles.jar'
-        for bamfile in bamfilelist:
-            cmd = cmd + ' I=%s.header.sam' % bamfile
-        cmd = cmd + ' O=%s.header.sam' % (composite_bam_filepath)
-        cmd = cmd + ' VERBOSITY=WARNING' # suppress INFO on stderr
-        cmd = cmd + ' QUIET=true' # suppress job-summary on stderr
-        cmd = cmd + ' VALIDATION_STRINGENCY=SILENT'
-        printtime("DEBUG: Calling '%s'" % cmd)
-        subprocess.call(cmd,shell=True)
+        # merge the headers in-process, same result as picard MergeSamFiles on the header SAM files
+        printtime("DEBUG: merging %d BAM headers into %s.header.sam" % (len(bamfilelist), composite_bam_filepath))
+        bamheader.merge_bam_headers(bamfilelist, '%s.header.sam' % composite_bam_filepath)
 
         if len(bamfilelist) == 1:
             # Usage: samtools reheader <in.header.sam> <in.bam>
@@ -309,7 +299,7 @@ def merge_bam_files_samtools(bamfilelist,composite_bam_filepath,composite_bai_fi
                 cmd = 'samtools reheader %s.header.sam %s > %s' % (composite_bam_filepath, bamfilelist[0], composite_bam_filepath)
         else:
             # Usage: samtools merge [-nr] [-h inh.sam] <out.bam> <in1.bam> <in2.bam> [...]
-            cmd = 'samtools merge -l1 -p8'
+            cmd = 'samtools merge -l1 -p%d' % SAMTOOLS_MERGE_THREADS
             if mark_duplicates:
                 cmd += ' - '
             else:
@@ -323,7 +313,11 @@ def merge_bam_files_samtools(bamfilelist,composite_bam_filepath,composite_bai_fi
             cmd += ' | BamDuplicates -i stdin -o %s -j %s' % (composite_bam_filepath, json_name)
         
         printtime("DEBUG: Calling '%s'" % cmd)
-        subprocess.call(cmd,shell=True)
+        # pipefail: a failed samtools in front of BamDuplicates fails the merge
+        ret = subprocess.call('set -o pipefail; ' + cmd, shell=True, executable='/bin/bash')
+        if ret != 0:
+            printtime("ERROR: bam file merge failed with exit status %d: %s" % (ret, cmd))
+            return ret
 
         if composite_bai_filepath:
             create_index_file(composite_bam_filepath, composite_bai_filepath)
@@ -331,15 +325,16 @@ def merge_bam_files_samtools(bamfilelist,composite_bam_filepath,composite_bai_fi
         printtime("bam file merge failed")
         traceback.print_exc()
         return 1
+    return 0
 
 def merge_bam_files_picard(bamfilelist,composite_bam_filepath,composite_bai_filepath,mark_duplicates):
 
     try:
 #        cmd = 'picard-tools MergeSamFiles'
         if mark_duplicates:
-            cmd = 'java -Xmx8g -jar /usr/local/bin/MarkDuplicates.jar M=%s.markduplicates.metrics.txt' % composite_bam_filepath
+            cmd = 'java -Xmx%dg -jar /usr/local/bin/MarkDuplicates.jar M=%s.markduplicates.metrics.txt' % (PICARD_MERGE_HEAP_GB, composite_bam_filepath)
         else:
-            cmd = 'java -Xmx8g -jar /opt/picard/picard-tools-current/MergeSamFiles.jar'
+            cmd = 'java -Xmx%dg -jar /opt/picard/picard-tools-current/MergeSamFiles.jar' % PICARD_MERGE_HEAP_GB
 
         for bamfile in bamfilelist:
             cmd = cmd + ' I=%s' % bamfile
@@ -352,7 +347,10 @@ def merge_bam_files_picard(bamfilelist,composite_bam_filepath,composite_bai_file
         cmd = cmd + ' QUIET=true' # suppress job-summary on stderr
         cmd = cmd + ' VALIDATION_STRINGENCY=SILENT'
         printtime("DEBUG: Calling '%s'" % cmd)
-        subprocess.call(cmd,shell=True)
+        ret = subprocess.call(cmd,shell=True)
+        if ret != 0:
+            printtime("ERROR: bam file merge failed with exit status %d: %s" % (ret, cmd))
+            return ret
     except:
         printtime("bam file merge failed")
         traceback.print_exc()
@@ -370,6 +368,7 @@ def merge_bam_files_picard(bamfilelist,composite_bam_filepath,composite_bai_file
     except:
         traceback.print_exc()
         return 1
+    return 0
 
 def remove_unneeded_block_files(blockdirs):
     return
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# Copyright (C) 2014 Ion Torrent Systems, Inc. All Rights Reserved
+
+'''
+Wait for files to appear without sleeping in fixed intervals.
+
+FileWatcher puts an inotify watch on the closest existing directory of every file
+it waits for and returns as soon as one of them exists. All files are re-checked
+every rescan_interval seconds as well, which covers file systems that do not
+deliver inotify events (NFS) and systems where inotify is not available.
+'''
+
+import os
+import time
+import errno
+import select
+import ctypes
+import ctypes.util
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init
+        libc.inotify_add_watch
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+class FileWatcher(object):
+
+    def __init__(self, filepaths, rescan_interval=10):
+        self.pending = set(filepaths)
+        self.rescan_interval = rescan_interval
+        self.watches = {}
+        self.fd = None
+        self.libc = _load_libc()
+        if self.libc is not None:
+            fd = self.libc.inotify_init()
+            if fd >= 0:
+                self.fd = fd
+
+    def _closest_directory(self, filepath):
+        directory = os.path.dirname(os.path.abspath(filepath))
+        while not os.path.isdir(directory):
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                break
+            directory = parent
+        return directory
+
+    def _add_watches(self):
+        # directories on the way to a file may be created while waiting
+        for filepath in self.pending:
+            directory = self._closest_directory(filepath)
+            if directory in self.watches:
+                continue
+            wd = self.libc.inotify_add_watch(self.fd, directory, WATCH_MASK)
+            self.watches[directory] = wd
+
+    def _scan(self):
+        found = set(filepath for filepath in self.pending if os.path.exists(filepath))
+        self.pending -= found
+        return found
+
+    def _drain(self):
+        # the events themselves are not needed, the pending files are re-checked
+        try:
+            os.read(self.fd, 64 * 1024)
+        except OSError as err:
+            if err.errno not in (errno.EAGAIN, errno.EINTR):
+                raise
+
+    def wait(self, timeout=None):
+        '''Block until at least one of the pending files exists or timeout seconds passed.
+        Returns the set of files found, they are not watched anymore.'''
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            if self.fd is not None:
+                self._add_watches()
+            found = self._scan()
+            if found or not self.pending:
+                return found
+
+            wait_time = self.rescan_interval
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return found
+                wait_time = min(wait_time, remaining)
+
+            if self.fd is not None:
+                try:
+                    readable, _, _ = select.select([self.fd], [], [], wait_time)
+                except select.error as err:
+                    if err.args[0] != errno.EINTR:
+                        raise
+                    readable = []
+                if readable:
+                    self._drain()
+            else:
+                time.sleep(wait_time)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            self.watches = {}
@@ -11,6 +11,7 @@ import ConfigParser
 from ion.reports import beadDensityPlot, StatsMerge, plotKey
 from ion.utils.blockprocessing import printtime, isbadblock
 from ion.utils import blockprocessing
+from ion.utils import blockmerge
 
 def beadfind_cmd(beadfindArgs, libKey, tfKey, pathtorawblock, SIGPROC_RESULTS):
     if beadfindArgs:
@@ -107,10 +108,7 @@ def generate_raw_data_traces(libKey, tfKey, floworder, SIGPROC_RESULTS):
         printtime("ERROR: %s is missing" % libRawPath)
 
 
-def mergeSigProcResults(dirs, SIGPROC_RESULTS, plot_title, exclusionMask=''):
-
-    bfmaskPath = os.path.join(SIGPROC_RESULTS,'analysis.bfmask.bin')
-    bfmaskstatspath = os.path.join(SIGPROC_RESULTS,'analysis.bfmask.stats')
+def write_sigproc_return_code(dirs, SIGPROC_RESULTS):
 
     ########################################################
     # write composite return code                          #
@@ -141,6 +139,11 @@ def mergeSigProcResults(dirs, SIGPROC_RESULTS, plot_title, exclusionMask=''):
     except:
         traceback.print_exc()
 
+
+def merge_bfmasks(dirs, SIGPROC_RESULTS, exclusionMask=''):
+
+    bfmaskPath = os.path.join(SIGPROC_RESULTS,'analysis.bfmask.bin')
+
     ######################################################################
     # Merge individual block bead metrics files and generate bead stats  #
     ######################################################################
@@ -191,6 +194,12 @@ def mergeSigProcResults(dirs, SIGPROC_RESULTS, plot_title, exclusionMask=''):
         traceback.print_exc()
     '''
 
+
+def merge_heatmap(SIGPROC_RESULTS, plot_title):
+
+    bfmaskPath = os.path.join(SIGPROC_RESULTS,'analysis.bfmask.bin')
+    bfmaskstatspath = os.path.join(SIGPROC_RESULTS,'analysis.bfmask.stats')
+
     ########################################################
     #Make Bead Density Plots                               #
     ########################################################
@@ -205,6 +214,26 @@ def mergeSigProcResults(dirs, SIGPROC_RESULTS, plot_title, exclusionMask=''):
     else:
         printtime("Warning: no heatmap generated.")
 
+
+def add_sigproc_merge(graph, dirs, SIGPROC_RESULTS, plot_title, exclusionMask='', ready=None):
+    '''Register the mergeSigProcResults steps on a merge graph, returns the task names.
+    ready gates the steps which read the blocks.'''
+    tasks = [
+        graph.add_task('sigproc_return_code', write_sigproc_return_code, (dirs, SIGPROC_RESULTS), ready=ready).name,
+        graph.add_task('bfmask_merge', merge_bfmasks, (dirs, SIGPROC_RESULTS, exclusionMask), ready=ready).name,
+    ]
+    tasks.append(graph.add_task('bead_heatmap', merge_heatmap, (SIGPROC_RESULTS, plot_title), depends=['bfmask_merge']).name)
+    return tasks
+
+
+def mergeSigProcResults(dirs, SIGPROC_RESULTS, plot_title, exclusionMask=''):
+
+    write_sigproc_return_code(dirs, SIGPROC_RESULTS)
+
+    merge_bfmasks(dirs, SIGPROC_RESULTS, exclusionMask)
+
+    merge_heatmap(SIGPROC_RESULTS, plot_title)
+
     printtime("Finished mergeSigProcResults")
 
 
@@ -233,6 +262,43 @@ def mergeRawPeakSignals(dirs):
 
     printtime("Finished mergeRawPeakSignals")
 
+def load_avg_nuke_trace(subdir, SIGPROC_RESULTS, key, beads):
+    '''Read one block's avgNukeTrace, returns (labels, trace weighted by number of wells, wells)'''
+    input_trace_file = os.path.join(subdir,SIGPROC_RESULTS,'avgNukeTrace_%s.txt' % key)
+    if not os.path.exists(input_trace_file):
+        return None
+    config = ConfigParser.RawConfigParser()
+    config.read(os.path.join(subdir,SIGPROC_RESULTS,'bfmask.stats'))
+    wells = config.getint('global', beads)
+    labels = numpy.genfromtxt(input_trace_file, delimiter=' ',  usecols=[0], dtype=str)
+    currentAvgNukeTraceData = numpy.genfromtxt(input_trace_file, delimiter=' ')[:,1:]
+    return (labels, currentAvgNukeTraceData * wells, wells)
+
+
+def fold_avg_nuke_trace(accumulator, partial):
+    if accumulator is None:
+        return partial
+    labels, sumAvgNukeTraceData, sumWells = accumulator
+    return (labels, sumAvgNukeTraceData + partial[1], sumWells + partial[2])
+
+
+def write_avg_nuke_trace(accumulator, SIGPROC_RESULTS, key):
+    output_trace_file = os.path.join(SIGPROC_RESULTS,'avgNukeTrace_%s.txt' % key)
+    labels, sumAvgNukeTraceData, sumWells = accumulator
+    AvgNukeTraceData = sumAvgNukeTraceData / sumWells
+    AvgNukeTraceTable = numpy.column_stack((labels,AvgNukeTraceData.astype('|S10')))
+    numpy.savetxt(output_trace_file, AvgNukeTraceTable, fmt='%s')
+    printtime("Finished mergeAvgNukeTraces")
+
+
+def avg_nuke_trace_reduction(SIGPROC_RESULTS, key, beads):
+    '''mergeAvgNukeTraces as a per-block reduction for the merge graph'''
+    return blockmerge.BlockReduction('avgNukeTrace_%s' % key,
+        load_avg_nuke_trace, fold_avg_nuke_trace, write_avg_nuke_trace,
+        load_args=(SIGPROC_RESULTS, key, beads),
+        finish_args=(SIGPROC_RESULTS, key))
+
+
 def mergeAvgNukeTraces(dirs, SIGPROC_RESULTS, key, beads):
 
     ###############################################
@@ -242,36 +308,19 @@ def mergeAvgNukeTraces(dirs, SIGPROC_RESULTS, key, beads):
 
     try:
         output_trace_file = os.path.join(SIGPROC_RESULTS,'avgNukeTrace_%s.txt' % key)
-        sumAvgNukeTraceData = None
-        sumWells = 0
-        config = ConfigParser.RawConfigParser()
+        accumulator = None
 
         for subdir in dirs:
             try:
-                input_trace_file = os.path.join(subdir,SIGPROC_RESULTS,'avgNukeTrace_%s.txt' % key)
-                if os.path.exists(input_trace_file):
-                    config.read(os.path.join(subdir,SIGPROC_RESULTS,'bfmask.stats'))
-                    wells = config.getint('global', beads)
-                    labels = numpy.genfromtxt(input_trace_file, delimiter=' ',  usecols=[0], dtype=str)
-                    currentAvgNukeTraceData = numpy.genfromtxt(input_trace_file, delimiter=' ')[:,1:]
-                else:
-                    continue 
+                partial = load_avg_nuke_trace(subdir, SIGPROC_RESULTS, key, beads)
             except:
                 traceback.print_exc()
                 continue
+            if partial is not None:
+                accumulator = fold_avg_nuke_trace(accumulator, partial)
 
-            if sumAvgNukeTraceData == None:
-                sumAvgNukeTraceData = currentAvgNukeTraceData * wells
-            else:
-                sumAvgNukeTraceData += currentAvgNukeTraceData * wells
-            sumWells += wells
-
-        AvgNukeTraceData = sumAvgNukeTraceData / sumWells
-        AvgNukeTraceTable = numpy.column_stack((labels,AvgNukeTraceData.astype('|S10'))) 
-        numpy.savetxt(output_trace_file, AvgNukeTraceTable, fmt='%s')
+        write_avg_nuke_trace(accumulator, SIGPROC_RESULTS, key)
 
     except:
         traceback.print_exc()
         printtime("ERROR: Merging %s failed" % output_trace_file)
-
-    printtime("Finished mergeAvgNukeTraces")
@@ -0,0 +1,33 @@
+#!/usr/bin/python
+# Copyright (C) 2014 Ion Torrent Systems, Inc. All Rights Reserved
+
+'''
+Helpers shared by the pipeline scripts and the job server,
+without the server settings blockprocessing needs.
+'''
+
+import sys
+import time
+
+
+def printtime(message, *args):
+    if args:
+        message = message % args
+    print "[ " + time.strftime('%X') + " ] " + message
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+
+def available_memory():
+    '''Memory in bytes that can be used without swapping, None if unknown'''
+    try:
+        meminfo = {}
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                name, value = line.split(':', 1)
+                meminfo[name] = int(value.split()[0]) * 1024
+        if 'MemAvailable' in meminfo:
+            return meminfo['MemAvailable']
+        return meminfo['MemFree'] + meminfo.get('Buffers', 0) + meminfo.get('Cached', 0)
+    except:
+        return None
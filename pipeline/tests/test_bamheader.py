@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# Copyright (C) 2014 Ion Torrent Systems, Inc. All Rights Reserved
+
+import unittest
+import sys
+import os.path
+import gzip
+import struct
+import shutil
+import tempfile
+
+test_dir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.normpath(os.path.join(test_dir, "../python")))
+
+from ion.utils import bamheader
+
+
+def write_bam_header(filepath, text, references):
+    # header only BAM, compressed as a single gzip member
+    data = 'BAM\1' + struct.pack('<i', len(text)) + text + struct.pack('<i', len(references))
+    for name, length in references:
+        data += struct.pack('<i', len(name) + 1) + name + '\0' + struct.pack('<i', length)
+    f = gzip.GzipFile(filepath, 'wb')
+    f.write(data)
+    f.close()
+
+
+class BamHeader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def bam(self, name, text, references=()):
+        filepath = os.path.join(self.tmpdir, name)
+        write_bam_header(filepath, text, references)
+        return filepath
+
+    def test_read_header(self):
+        text = "@HD\tVN:1.5\tSO:coordinate\n@SQ\tSN:chr1\tLN:100\n@RG\tID:A.IonXpress_001\tSM:s1\n"
+        bam = self.bam('a.bam', text, [('chr1', 100)])
+        self.assertEqual(bamheader.read_bam_header(bam), (text, [('chr1', 100)]))
+
+    def test_sq_from_binary_references(self):
+        bam = self.bam('a.bam', "@HD\tVN:1.5\n", [('chr1', 100), ('chr2', 50)])
+        header = bamheader.SamHeader.from_bam(bam)
+        self.assertEqual(header.sq, [[('SN', 'chr1'), ('LN', '100')], [('SN', 'chr2'), ('LN', '50')]])
+
+    def test_merge_identical_blocks(self):
+        text = ("@HD\tVN:1.5\tSO:unsorted\n@RG\tID:A\tSM:s1\tPL:IONTORRENT\n"
+                "@PG\tID:bc\tPN:BaseCaller\tVN:4.4\n@CO\tBC:fancy\n")
+        bams = [self.bam('block_%d.bam' % i, text) for i in range(3)]
+        output = os.path.join(self.tmpdir, 'merged.header.sam')
+        bamheader.merge_bam_headers(bams, output)
+        self.assertEqual(open(output).read(),
+                         "@HD\tVN:1.5\tSO:coordinate\n@RG\tID:A\tSM:s1\tPL:IONTORRENT\n"
+                         "@PG\tID:bc\tPN:BaseCaller\tVN:4.4\n@CO\tBC:fancy\n")
+
+    def test_merge_id_collision(self):
+        a = bamheader.SamHeader.parse("@RG\tID:B\tSM:s1\n@PG\tID:tmap\tCL:x\n@PG\tID:bc\tPP:tmap\n")
+        b = bamheader.SamHeader.parse("@RG\tID:B\tSM:s2\n@RG\tID:A\tSM:s3\n@PG\tID:tmap\tCL:y\n@PG\tID:bc\tPP:tmap\n")
+        merged = bamheader.merge_headers([a, b])
+        self.assertEqual([dict(rg)['ID'] for rg in merged.rg], ['A', 'B', 'B.1'])
+        self.assertEqual(dict(merged.rg[2])['SM'], 's2')
+        self.assertEqual([(dict(pg)['ID'], dict(pg).get('PP')) for pg in merged.pg],
+                         [('bc', 'tmap'), ('bc.1', 'tmap.1'), ('tmap', None), ('tmap.1', None)])
+
+    def test_conflicting_sequence_length(self):
+        a = bamheader.SamHeader.parse("@SQ\tSN:chr1\tLN:100\n")
+        b = bamheader.SamHeader.parse("@SQ\tSN:chr1\tLN:200\n")
+        self.assertRaises(bamheader.BamHeaderError, bamheader.merge_headers, [a, b])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# Copyright (C) 2014 Ion Torrent Systems, Inc. All Rights Reserved
+
+import unittest
+import sys
+import os.path
+import shutil
+import tempfile
+
+test_dir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.normpath(os.path.join(test_dir, "../python")))
+
+from ion.utils import blockmerge
+
+
+# merge tasks run in pool workers, they have to be module level functions to pickle
+
+def write_file(filepath, text):
+    with open(filepath, 'w') as f:
+        f.write(text)
+    return text
+
+
+def read_file(filepath):
+    with open(filepath, 'r') as f:
+        return f.read()
+
+
+def fail():
+    raise Exception("merge failed")
+
+
+def load_block(blockdir):
+    return int(read_file(os.path.join(blockdir, 'count.txt')))
+
+
+def fold_sum(accumulator, count):
+    return accumulator + count
+
+
+def finish_total(accumulator, scale):
+    return accumulator * scale
+
+
+class Ready(object):
+    '''ready predicate which turns True after a number of calls'''
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def __call__(self, *args):
+        self.calls -= 1
+        return self.calls < 0
+
+
+class MergeGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.graph = blockmerge.MergeGraph(processes=2, poll_interval=0.01)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def block(self, name, count):
+        blockdir = self.path(name)
+        os.mkdir(blockdir)
+        if count is not None:
+            write_file(os.path.join(blockdir, 'count.txt'), str(count))
+        return blockdir
+
+    def test_dependency_order(self):
+        self.graph.add_task('read', read_file, (self.path('a.txt'),), depends=['write'])
+        self.graph.add_task('write', write_file, (self.path('a.txt'), 'merged'))
+        self.assertTrue(self.graph.run())
+        self.assertEqual(self.graph.status('read'), blockmerge.DONE)
+        self.assertEqual(self.graph.result('read'), 'merged')
+
+    def test_failed_dependency(self):
+        self.graph.add_task('fail', fail)
+        self.graph.add_task('after', write_file, (self.path('after.txt'), ''), depends=['fail'])
+        self.graph.add_task('after_after', write_file, (self.path('after_after.txt'), ''), depends=['after'])
+        self.graph.add_task('independent', write_file, (self.path('independent.txt'), 'ok'))
+        self.assertFalse(self.graph.run())
+        self.assertEqual(self.graph.status('fail'), blockmerge.FAILED)
+        self.assertEqual(self.graph.status('after'), blockmerge.SKIPPED)
+        self.assertEqual(self.graph.status('after_after'), blockmerge.SKIPPED)
+        self.assertEqual(self.graph.status('independent'), blockmerge.DONE)
+        self.assertFalse(os.path.exists(self.path('after.txt')))
+
+    def test_after_failed_task(self):
+        self.graph.add_task('fail', fail)
+        self.graph.add_task('write', write_file, (self.path('a.txt'), 'merged'))
+        self.graph.add_task('read', read_file, (self.path('a.txt'),), after=['fail', 'write'])
+        self.assertFalse(self.graph.run())
+        self.assertEqual(self.graph.status('read'), blockmerge.DONE)
+        self.assertEqual(self.graph.result('read'), 'merged')
+
+    def test_unknown_dependency(self):
+        self.graph.add_task('read', read_file, (self.path('a.txt'),), depends=['missing'])
+        self.assertRaises(ValueError, self.graph.run)
+
+    def test_duplicate_task(self):
+        self.graph.add_task('write', write_file, (self.path('a.txt'), ''))
+        self.assertRaises(ValueError, self.graph.add_task, 'write', write_file, (self.path('b.txt'), ''))
+
+    def test_reduction(self):
+        dirs = [self.block('block_%d' % i, i) for i in range(1, 5)]
+        reduction = blockmerge.BlockReduction('total', load_block, fold_sum, finish_total, initial=0, finish_args=(10,))
+        self.graph.add_reduction(reduction, dirs)
+        self.assertTrue(self.graph.run())
+        self.assertEqual(self.graph.result('total'), 100)
+        self.assertEqual(reduction.blocks_folded, 4)
+
+    def test_reduction_failed_block(self):
+        dirs = [self.block('block_1', 1), self.block('block_2', None), self.block('block_3', 3)]
+        reduction = blockmerge.BlockReduction('total', load_block, fold_sum, finish_total, initial=0, finish_args=(1,))
+        self.graph.add_reduction(reduction, dirs)
+        self.assertFalse(self.graph.run())
+        self.assertEqual(self.graph.status('total:%s' % dirs[1]), blockmerge.FAILED)
+        self.assertEqual(self.graph.status('total'), blockmerge.DONE)
+        self.assertEqual(self.graph.result('total'), 4)
+
+    def test_ready_delays_task(self):
+        ready = Ready(3)
+        self.graph.add_task('write', write_file, (self.path('a.txt'), 'ok'), ready=ready)
+        self.assertTrue(self.graph.run())
+        self.assertEqual(self.graph.result('write'), 'ok')
+        self.assertTrue(ready.calls < 0)
+
+    def test_block_timeout(self):
+        graph = blockmerge.MergeGraph(processes=1, poll_interval=0.01, block_timeout=0.1)
+        graph.add_task('never', write_file, (self.path('never.txt'), ''), ready=lambda: False)
+        graph.add_task('after', write_file, (self.path('after.txt'), ''), depends=['never'])
+        self.assertFalse(graph.run())
+        self.assertEqual(graph.status('never'), blockmerge.SKIPPED)
+        self.assertEqual(graph.status('after'), blockmerge.SKIPPED)
+
+
+class BlockFinishedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def status(self, text):
+        write_file(os.path.join(self.tmpdir, 'blockstatus.txt'), text)
+
+    def test_no_status(self):
+        self.assertFalse(blockmerge.block_finished(self.tmpdir, ['Basecaller']))
+
+    def test_running(self):
+        self.status('Beadfind=0 \nAnalysis=0 \n')
+        self.assertFalse(blockmerge.block_finished(self.tmpdir, ['Basecaller']))
+
+    def test_finished(self):
+        self.status('Beadfind=0 \nAnalysis=0 \nBasecaller=0 \n')
+        self.assertTrue(blockmerge.block_finished(self.tmpdir, ['Basecaller']))
+
+    def test_failed_step(self):
+        self.status('Beadfind=0 \nAnalysis=1 Analysis failed\n')
+        self.assertTrue(blockmerge.block_finished(self.tmpdir, ['Basecaller']))
+
+
+if __name__ == '__main__':
+    unittest.main()